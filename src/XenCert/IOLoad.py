@@ -0,0 +1,203 @@
+# Copyright (c) 2005-2022 Citrix Systems Inc.
+# Copyright (c) 2022-2023 Cloud Software Group, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Continuous multi-stream IO load on a device, with the time of every IO"""
+import os
+import mmap
+import random
+import time
+from array import array
+from threading import Thread, Lock, Event
+from XenCertLog import xencert_print
+
+LOAD_STREAMS = 4  # IOs in flight at once, one per stream
+LOAD_BLOCK_SIZE = 64 * 1024  # bytes of one IO
+LOAD_READ_PERCENT = 70  # share of the IOs that are reads, the rest are writes
+LOAD_SPAN = 1024 * 1024 * 1024  # bytes at the start of the device the IOs are spread over
+LOAD_STALL_THRESHOLD = 1.0  # seconds without any IO completing that count as a stall
+LOAD_SERIES_INTERVAL = 0.1  # seconds of one point of the IO series
+LOAD_STOP_TIMEOUT = 60  # seconds stop() waits for the IOs in flight to complete
+
+OP_READ = 0
+OP_WRITE = 1
+
+
+class IOLoadGenerator(object):
+    """Keeps streams of direct IOs on a device, from start() to stop() or for test_time seconds.
+
+    Each stream is a thread with one IO in flight at a time, at random offsets in the first LOAD_SPAN bytes of the
+    device, reading or writing as drawn from read_percent. Every completed IO is recorded in arrays shared by
+    the streams: its start on the monotonic clock, its latency, whether it read or wrote and its result, so the
+    throughput dips and the stalls of a failover can be told from the records afterwards. An IO stalled by a
+    path failure is recorded when it completes, and stop() waits for it up to a timeout.
+    """
+
+    def __init__(self, device, streams=LOAD_STREAMS, block_size=LOAD_BLOCK_SIZE, read_percent=LOAD_READ_PERCENT,
+                 test_time=0, span=LOAD_SPAN):
+        self.device = device
+        self.streams = streams
+        self.block_size = block_size
+        self.read_percent = read_percent
+        self.test_time = test_time
+        self.span = span
+        self.lock = Lock()
+        self.stopping = Event()
+        self.threads = []
+        self.start_ns = 0  # monotonic clock at start(), the records are relative to it
+        self.end_ns = 0
+        self.submits = array('Q')  # nanoseconds from start_ns to the submission of each IO
+        self.latencies = array('Q')  # nanoseconds
+        self.ops = array('B')  # OP_READ or OP_WRITE
+        self.results = array('l')  # bytes transferred or -errno
+        self.failures = []
+
+    def start(self):
+        self.start_ns = time.monotonic_ns()
+        for i in range(self.streams):
+            thread = Thread(target=self._stream, args=(i,))
+            thread.daemon = True
+            self.threads.append(thread)
+            thread.start()
+
+    def _stream(self, index):
+        try:
+            fd = os.open(self.device, os.O_RDWR | os.O_DIRECT)
+        except OSError as e:
+            with self.lock:
+                self.failures.append("Cannot open %s: %s" % (self.device, str(e)))
+            return
+        buf = mmap.mmap(-1, self.block_size)
+        rand = random.Random(index)
+        try:
+            blocks = max(1, min(self.span, os.lseek(fd, 0, os.SEEK_END)) // self.block_size)
+            deadline = self.start_ns + self.test_time * 1000000000
+            with memoryview(buf) as view:
+                while not self.stopping.is_set() and not (self.test_time and time.monotonic_ns() >= deadline):
+                    op = OP_READ if rand.randrange(100) < self.read_percent else OP_WRITE
+                    offset = rand.randrange(blocks) * self.block_size
+                    submit = time.monotonic_ns()
+                    try:
+                        if op == OP_READ:
+                            result = os.preadv(fd, [view], offset)
+                        else:
+                            result = os.pwritev(fd, [view], offset)
+                    except OSError as e:
+                        result = -e.errno
+                    latency = time.monotonic_ns() - submit
+                    with self.lock:
+                        self.submits.append(submit - self.start_ns)
+                        self.latencies.append(latency)
+                        self.ops.append(op)
+                        self.results.append(result)
+        finally:
+            os.close(fd)
+            buf.close()
+
+    def stop(self, timeout=LOAD_STOP_TIMEOUT):
+        """Stop the streams and wait up to timeout seconds for their IOs in flight, returns whether they all
+        completed. May be called more than once."""
+        self.stopping.set()
+        return self.join(timeout)
+
+    def join(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self.threads:
+            thread.join(None if deadline is None else max(0, deadline - time.monotonic()))
+        alive = sum(1 for thread in self.threads if thread.is_alive())
+        if alive:
+            # A stream stuck in an IO keeps its device open until the IO completes, it cannot be interrupted
+            xencert_print("%d IO load streams on %s are still in an IO after %d seconds"
+                          % (alive, self.device, timeout))
+        with self.lock:
+            if not self.end_ns:
+                self.end_ns = time.monotonic_ns()
+        return alive == 0
+
+    @property
+    def start_time(self):
+        """Monotonic time in seconds the load started at"""
+        return self.start_ns / 1e9
+
+    @property
+    def ios(self):
+        return len(self.latencies)
+
+    @property
+    def errors(self):
+        with self.lock:
+            return sum(1 for result in self.results if result < 0)
+
+    @property
+    def bytes(self):
+        with self.lock:
+            return sum(result for result in self.results if result > 0)
+
+    @property
+    def elapsed(self):
+        """Seconds the load ran for"""
+        return ((self.end_ns or time.monotonic_ns()) - self.start_ns) / 1e9
+
+    @property
+    def rc(self):
+        # The load failed if a stream could not open the device, any IO failed or none completed
+        return 1 if self.failures or self.errors or not self.ios else 0
+
+    def max_latency(self, since=0.0):
+        """Returns the longest IO completed after since seconds from the start of the load in seconds, and when it
+        started in seconds from the start of the load. Can be called while the load runs."""
+        longest, longest_at = 0, 0
+        with self.lock:
+            for submit, latency in zip(self.submits, self.latencies):
+                if latency > longest and submit + latency >= since * 1e9:
+                    longest, longest_at = latency, submit
+        return longest / 1e9, longest_at / 1e9
+
+    def completions(self):
+        """Returns the sorted completion times of the IOs, in nanoseconds from the start of the load"""
+        with self.lock:
+            return sorted(array('Q', map(sum, zip(self.submits, self.latencies))))
+
+    def stalls(self, threshold=LOAD_STALL_THRESHOLD):
+        """Returns the (start, length) in seconds of the periods longer than threshold without any IO completing"""
+        stalls = []
+        last = 0
+        for done in self.completions() + [(self.end_ns or time.monotonic_ns()) - self.start_ns]:
+            if done - last > threshold * 1e9:
+                stalls.append((last / 1e9, (done - last) / 1e9))
+            last = max(last, done)
+        return stalls
+
+    def throughput(self, window=1.0):
+        """Returns the bytes per second completed in each whole window seconds of the load"""
+        buckets = array('d', [0.0] * int(self.elapsed / window))
+        with self.lock:
+            for submit, latency, result in zip(self.submits, self.latencies, self.results):
+                bucket = int((submit + latency) / 1e9 / window)
+                if result > 0 and bucket < len(buckets):
+                    buckets[bucket] += result / window
+        return buckets
+
+    def series(self, interval=LOAD_SERIES_INTERVAL):
+        """Returns the IOs, bytes and longest IO in nanoseconds completed in each interval seconds of the load"""
+        size = int(self.elapsed / interval) + 1
+        ios, nbytes, longest = array('L', [0] * size), array('Q', [0] * size), array('Q', [0] * size)
+        with self.lock:
+            for submit, latency, result in zip(self.submits, self.latencies, self.results):
+                bucket = min(size - 1, int((submit + latency) / 1e9 / interval))
+                ios[bucket] += 1
+                nbytes[bucket] += max(0, result)
+                longest[bucket] = max(longest[bucket], latency)
+        return ios, nbytes, longest
@@ -0,0 +1,82 @@
+# Copyright (c) 2005-2022 Citrix Systems Inc.
+# Copyright (c) 2022-2023 Cloud Software Group, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Live progress line, with the throughput and ETA, of long running IO phases"""
+import time
+from threading import Lock
+from XenCertLog import print_on_same_line
+
+PROGRESS_INTERVAL = 2  # seconds between two refreshes of the progress line at most
+PROGRESS_EWMA_ALPHA = 0.3  # weight of the latest interval in the throughput estimate
+MiB = 1024 * 1024
+
+
+def format_eta(seconds):
+    seconds = int(seconds)
+    return "%d:%02d:%02d" % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+class ProgressTracker(object):
+    """Tracks the bytes done out of a total and shows them on one line, refreshed in place.
+
+    The throughput is an exponentially weighted moving average of the throughput of each refresh interval,
+    so the ETA follows a device that slows down or speeds up without jumping at every hiccup. add() may be
+    called from several threads, and as often as wanted: the line is only rewritten every interval seconds.
+    """
+
+    def __init__(self, label, total, interval=PROGRESS_INTERVAL, alpha=PROGRESS_EWMA_ALPHA):
+        self.label = label
+        self.total = total
+        self.interval = interval
+        self.alpha = alpha
+        self.done = 0
+        self.rate = None
+        self.width = 0
+        self.lock = Lock()
+        self.last_time = time.monotonic()
+        self.last_done = 0
+
+    def add(self, count):
+        """Account count more bytes done"""
+        with self.lock:
+            self.done += count
+            now = time.monotonic()
+            if now - self.last_time < self.interval:
+                return
+            interval_rate = (self.done - self.last_done) / (now - self.last_time)
+            if self.rate is None:
+                self.rate = interval_rate
+            else:
+                self.rate = self.alpha * interval_rate + (1 - self.alpha) * self.rate
+            self.last_time = now
+            self.last_done = self.done
+            self._show()
+
+    def _show(self):
+        line = "        %s: %d of %d MB (%d%%), %.1f MB/s" % (self.label, self.done // MiB, self.total // MiB,
+                                                          100 * self.done // self.total if self.total else 100,
+                                                          self.rate / MiB)
+        if self.rate > 0 and self.done < self.total:
+            line += ", ETA %s" % format_eta((self.total - self.done) / self.rate)
+        self.width = max(self.width, len(line))
+        print_on_same_line("\r" + line.ljust(self.width))
+
+    def finish(self):
+        """Clear the progress line, so that the next output starts on a clean line"""
+        with self.lock:
+            if self.width:
+                print_on_same_line("\r" + " " * self.width + "\r")
+            self.width = 0
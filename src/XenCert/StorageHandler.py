@@ -23,9 +23,9 @@ import subprocess
 import glob
 import random
 import operator
-import re
 from xml.dom import minidom
 import StorageHandlerUtil
+import IOLoad
 from XenCertLog import printout, print_on_same_line, xencert_print
 from XenCertCommon import display_operation_status, get_config_with_hidden_password, hide_path_info_password
 from sm import scsiutil, iscsilib, util, nfs, metadata
@@ -33,10 +33,6 @@ from sm.lvutil import MDVOLUME_NAME, remove, rename
 from sm.srmetadata import LVMMetadataHandler, updateLengthInHeader, open_file
 
 
-retValIO = 0
-timeTaken = '' 
-bytesCopied = ''
-speedOfCopy = ''
 pathsFailed = False
 failoverTime = 0
 DEFAULT_PORT = 3260
@@ -44,6 +40,10 @@ RPCINFO_BIN = "/usr/sbin/rpcinfo"
 VG_LOCATION = "/dev"
 VG_PREFIX = "VG_XenStorage-"
 TESTED_SIZE_MB = 10240
+PROBE_TIME = 3  # seconds of IO load on a healthy multipath device
+MiB = 1024 * 1024
+FAILOVER_TIMEOUT = 50  # seconds for the blocked paths to fail over
+FAILOVER_RECHECK_INTERVAL = 10  # seconds between two checks with multipathd, when following the path uevents
 
 # simple tracer
 def report(predicate, condition):
@@ -61,47 +61,41 @@ def check_result(result, exception):
     if not result:
         raise Exception(exception)
 
-class TimedDeviceIO(Thread):
-    def __init__(self, device):
-        Thread.__init__(self)
-        self.device = device
-
-    def run(self):
-        # Sleep for a period of time before checking for any incomplete snapshots to clean.
-        devicename = '/dev/' + self.device
-        dd_out_file = 'of=' + devicename
-        xencert_print("Now copy data from /dev/zero to this device and record the time taken to copy it." )
-        cmd = ['dd', 'if=/dev/zero', dd_out_file, 'bs=1M', 'count=1', 'oflag=direct']
-        try:
-            global retValIO
-            global bytesCopied
-            global timeTaken
-            global speedOfCopy
-            retValIO = 0
-            timeTaken = '' 
-            bytesCopied = ''
-            speedOfCopy = ''
-
-            (retValIO, stdout, stderr) = util.doexec(cmd,'')
-            if retValIO != 0:
-                raise Exception("Disk IO failed for device: %s." % self.device)
-            list = stderr.split('\n')
-            
-            bytesCopied = list[2].split(',')[0]
-            timeTaken = list[2].split(',')[1]
-            speedOfCopy = list[2].split(',')[2]
-
-            xencert_print("The IO test returned rc: %s stdout: %s, stderr: %s" % (retValIO, stdout, list))
-        except Exception as e:
-            xencert_print("Could not write through the allocated disk space on test disk, please check the storage configuration manually. Exception: %s" % str(e))
+def report_io_load(load, since=0.0):
+    # The longest IO and stall after since seconds from the start of the load, and the lowest throughput in a second
+    (latency, latency_at) = load.max_latency(since)
+    stalls = [stall for stall in load.stalls() if stall[0] + stall[1] >= since]
+    throughput = load.throughput()
+    xencert_print("IO load on %s: %d IOs, %d failed, %d bytes in %.3f seconds, maximum IO time %.3f seconds at %.3f seconds."
+                  % (load.device, load.ios, load.errors, load.bytes, load.elapsed, latency, latency_at))
+    line = "    - IO load: %d IOs of %d KB from %d streams. IOPS: %.1f. Throughput: %.1f MB/s" % (
+        load.ios, load.block_size // 1024, load.streams, load.ios / load.elapsed if load.elapsed else 0,
+        load.bytes / MiB / load.elapsed if load.elapsed else 0)
+    if throughput:
+        line += ", lowest %.1f MB/s over a second" % (min(throughput) / MiB)
+    printout(line + ".")
+    if stalls:
+        longest = max(stalls, key=operator.itemgetter(1))
+        printout("    - IO stalls: %d, the longest for %.3f seconds at %.3f seconds." % (len(stalls), longest[1], longest[0]))
 
 class WaitForFailover(Thread):
-    def __init__(self, session, scsiid, active_paths, no_of_paths, checkfunc):
+    # With a PathEventMonitor, the failover is timed from the path uevents to the millisecond, from the
+    # monotonic start time the paths were blocked at. Without one, multipathd is polled every second.
+    def __init__(self, session, scsiid, active_paths, no_of_paths, checkfunc, monitor=None, start_time=None):
         Thread.__init__(self)        
         self.scsiid = scsiid
         self.active_paths = active_paths
         self.no_of_paths = no_of_paths
         self.checkfunc = checkfunc
+        self.monitor = monitor
+        self.start_time = time.monotonic() if start_time is None else start_time
+
+    def paths_failed(self, valid_paths):
+        return self.checkfunc((int)(self.active_paths) - valid_paths, self.no_of_paths)
+
+    def check_multipathd(self):
+        (retval, list_path_config_new) = StorageHandlerUtil.get_path_status(self.scsiid, True)
+        return self.paths_failed(len(list_path_config_new))
 
     def run(self):
         # Here wait for the expected number of paths to fail.
@@ -109,16 +103,22 @@ class WaitForFailover(Thread):
         global failoverTime
         pathsFailed = False
         failoverTime = 0        
-        while not pathsFailed and failoverTime < 50:
-            try:
-                (retval, list_path_config_new) = StorageHandlerUtil.get_path_status(self.scsiid, True)
-                currno_of_paths = (int)(self.active_paths) - len(list_path_config_new)
-                if self.checkfunc(currno_of_paths, self.no_of_paths):
-                    pathsFailed = True
-                time.sleep(1)
-                failoverTime += 1                
-            except Exception as e:                
-                raise Exception(e)
+        deadline = self.start_time + FAILOVER_TIMEOUT
+        while not pathsFailed and time.monotonic() < deadline:
+            if self.monitor:
+                # multipathd is still asked now and then, in case uevents were dropped
+                failed_at = self.monitor.wait_for(self.paths_failed,
+                                                  min(deadline, time.monotonic() + FAILOVER_RECHECK_INTERVAL))
+                if failed_at is None and self.check_multipathd():
+                    xencert_print("Failover of %s seen by multipathd but not in the uevents" % self.scsiid)
+                    failed_at = time.monotonic()
+            else:
+                failed_at = time.monotonic() if self.check_multipathd() else None
+                if failed_at is None:
+                    time.sleep(1)
+            if failed_at is not None:
+                pathsFailed = True
+                failoverTime = max(0.0, failed_at - self.start_time)
             
 class StorageHandler(object):
     KEYS_NOT_POPULATED_BY_THE_STORAGE = ['allowed_operations',
@@ -139,6 +139,9 @@ class StorageHandler(object):
     def __init__(self, storage_conf):
         xencert_print("Reached Storagehandler constructor")
         self.storage_conf = storage_conf
+        StorageHandlerUtil.set_disk_data_test_limits(storage_conf.get('ratelimit'), storage_conf.get('iopslimit'))
+        StorageHandlerUtil.set_disk_data_test_concurrency(storage_conf.get('iopaths'), storage_conf.get('iopathsperlun'),
+                                                          storage_conf.get('iopathspergroup'))
         self.session = util.get_localAPI_session()
         self.sm_config = {}
         self.util_of_param = 'of=%s'
@@ -154,6 +157,21 @@ class StorageHandler(object):
             xencert_print("TRIM tests failed due to exception: %s" %(str(e)))
             return False
     
+    def block_size_sweep(self, device, size):
+        # Optional sub-phase of the functional tests (-B): throughput and latency of one path of a LUN over the
+        # block sizes from 4KB to 4MB. Returns True if the sweep ran and read back what it wrote.
+        print_on_same_line("        Block size sweep on device %s" % device)
+        try:
+            sweep = StorageHandlerUtil.disk_data_test_sweep(device, size)
+        except Exception as e:
+            printout("        Exception: %s" % str(e))
+            display_operation_status(False)
+            return False
+        printout("")
+        StorageHandlerUtil.report_disk_data_test_sweep(sweep)
+        display_operation_status(True)
+        return True
+
     def control_path_stress_tests(self):
         sr_ref = None 
         retval = True
@@ -214,7 +232,10 @@ class StorageHandler(object):
                 sr_type = self.session.xenapi.SR.get_type(sr_ref)
                 if sr_type in ['lvmoiscsi', 'lvmohba', 'lvmofcoe']:
                     printout("SR SPACE RECLAMATION TEST")
-                    # Perform TRIM before destroying SR
+                    # Time discards through a raw test VDI at several granularities, then TRIM the SR's free space
+                    total_checkpoints += 3
+                    (check_point_delta, _) = StorageHandlerUtil.perform_sr_discard_tests(self.session, sr_ref)
+                    checkpoint += check_point_delta
                     total_checkpoints += 1
                     trim_status = self.perform_sr_trim(sr_ref)
                     if trim_status:
@@ -248,6 +269,7 @@ class StorageHandler(object):
             sr_ref = None
             vdi_ref = None
             vbd_ref = None
+            timeline = None
             retval =True
             checkpoint = 0
             total_checkpoints = 6
@@ -310,117 +332,145 @@ class StorageHandler(object):
             (retval, vdi_ref, vbd_ref, vdi_size) = StorageHandlerUtil.create_max_size_vdi_and_vbd(self.session, sr_ref)
             checkpoint = check_result_for_checkpoint(retval, "Failed to create max size VDI and VBD.", checkpoint, 2)
            
-            global retValIO
-            global timeTaken
-            global bytesCopied
-            global speedOfCopy
             printout("")
             printout("Iteration 1:\n")
             printout(" -> No manual/script blocking of paths.")
-            s = TimedDeviceIO(self.session.xenapi.VBD.get_device(vbd_ref))
-            s.start()
-            s.join()
+            load_device = '/dev/' + self.session.xenapi.VBD.get_device(vbd_ref)
+            load = IOLoad.IOLoadGenerator(load_device, test_time=PROBE_TIME)
+            load.start()
+            load.join(PROBE_TIME + IOLoad.LOAD_STOP_TIMEOUT)
             
-            if retValIO != 0:
+            if load.rc != 0:
                 display_operation_status(False)
-                raise Exception(" IO tests failed for device: %s" % self.session.xenapi.VBD.get_device(vbd_ref))
+                raise Exception(" IO tests failed for device: %s. %s" % (load_device, " ".join(load.failures)))
             
-            initial_data_copy_time = float(timeTaken.split()[0])
-            if initial_data_copy_time > 3:
-                display_operation_status(False, timeTaken)
-                printout("    - The initial data copy is too slow at %s" % timeTaken)
+            (time_taken, time_taken_at) = load.max_latency()
+            if time_taken > 3:
+                display_operation_status(False, "%.3f seconds" % time_taken)
+                printout("    - The initial IO latency is too high at %.3f seconds" % time_taken)
             else:
-                printout("    - IO test passed. Time: %s. Data: %s. Throughput: %s" % (timeTaken, '1MB', speedOfCopy))
+                printout("    - IO test passed. Maximum IO time: %.3f seconds. Data: %d bytes. IOPS: %.1f" % (
+                    time_taken, load.bytes, load.ios / load.elapsed))
                 display_operation_status(True)
                 checkpoint += 1
 
             if len(self.listPathConfig) > 1:
+                timeline = StorageHandlerUtil.FailoverTimeline()
                 for i in range(2, iteration_count):
-                    max_time_taken = 0
-                    throughput_for_max_time = ''
                     total_checkpoints += 2
                     printout("Iteration %d:\n" % i)
 
-                    if is_man_block:
-                        printout(" -> Wait for manually blocking paths")
-                        self.wait_manual_block_unblock_paths()
-                        devices_to_fail = 1
-                        checkfunc = operator.ge
-                    else:
-                        if not self.RandomlyFailPaths():
-                            raise Exception("Failed to block paths.")
-
-                        xencert_print("Dev Path Config = '%s', no of Blocked switch Paths = '%s'" % (
-                        self.listPathConfig, self.no_of_paths))
-
-                        # Fail path calculation needs to be done only in case of hba SRs
-                        if "blockunblockhbapaths" in \
-                                self.storage_conf['pathHandlerUtil'].split('/')[-1]:
-                            # Calculate the number of devices to be found after the path block
-                            devices_to_fail = (len(self.listPathConfig) / self.noOfTotalPaths) * self.no_of_paths
-                            xencert_print("Expected devices to fail: %s" % devices_to_fail)
+                    # Follow the path uevents of the map from before the paths are blocked
+                    monitor = None
+                    try:
+                        monitor = StorageHandlerUtil.PathEventMonitor(device_config['SCSIid'])
+                        monitor.start()
+                    except OSError as e:
+                        xencert_print("Cannot follow the path uevents, polling multipathd instead: %s" % str(e))
+
+                    # Keep the IO load on the device from before the paths are blocked until they are restored.
+                    # Both are stopped however the iteration ends, before the VBD is unplugged.
+                    load = None
+                    try:
+                        load = IOLoad.IOLoadGenerator(load_device)
+                        load.start()
+
+                        if is_man_block:
+                            printout(" -> Wait for manually blocking paths")
+                            self.wait_manual_block_unblock_paths()
+                            failover_start = time.monotonic()
+                            devices_to_fail = 1
+                            checkfunc = operator.ge
                         else:
-                            devices_to_fail = self.no_of_paths
-                        checkfunc = operator.eq
-
-                    s = WaitForFailover(self.session, device_config['SCSIid'], len(self.listPathConfig), devices_to_fail, checkfunc)
-                    s.start()
+                            failover_start = time.monotonic()
+                            if not self.RandomlyFailPaths():
+                                raise Exception("Failed to block paths.")
+
+                            xencert_print("Dev Path Config = '%s', no of Blocked switch Paths = '%s'" % (
+                            self.listPathConfig, self.no_of_paths))
+
+                            # Fail path calculation needs to be done only in case of hba SRs
+                            if "blockunblockhbapaths" in \
+                                    self.storage_conf['pathHandlerUtil'].split('/')[-1]:
+                                # Calculate the number of devices to be found after the path block
+                                devices_to_fail = (len(self.listPathConfig) / self.noOfTotalPaths) * self.no_of_paths
+                                xencert_print("Expected devices to fail: %s" % devices_to_fail)
+                            else:
+                                devices_to_fail = self.no_of_paths
+                            checkfunc = operator.eq
 
-                    while s.is_alive():
-                        timeTaken = 0
-                        s1 = TimedDeviceIO(self.session.xenapi.VBD.get_device(vbd_ref))
-                        s1.start()
-                        s1.join()
+                        s = WaitForFailover(self.session, device_config['SCSIid'], len(self.listPathConfig), devices_to_fail, checkfunc,
+                                            monitor, failover_start)
+                        s.start()
+                        s.join()
 
-                        if retValIO != 0:
+                        if load.rc != 0:
                             display_operation_status(False)
                             raise Exception(
-                                "    - IO test failed for device %s." % self.session.xenapi.VBD.get_device(vbd_ref))
+                                "    - IO test failed for device %s. %s" % (load_device, " ".join(load.failures)))
+
+                        # The IOs of the failover are those completed since the paths were blocked
+                        failover_since = failover_start - load.start_time
+                        (time_taken, time_taken_at) = load.max_latency(failover_since)
+                        xencert_print("    - IO test passed. Maximum IO time: %.3f seconds. Data: %d bytes. IOPS: %.1f." % (
+                            time_taken, load.bytes, load.ios / load.elapsed))
+
+                        if pathsFailed:
+                            printout("    - Paths failover time: %.3f seconds" % failoverTime)
+                            printout("    - Maximum IO completion time: %.3f seconds, starting %.3f seconds into the failover. IOPS: %.1f" % (
+                            time_taken, max(0.0, time_taken_at - failover_since), load.ios / load.elapsed))
+                            display_operation_status(True)
+                            checkpoint += 1
                         else:
-                            xencert_print("    - IO test passed. Time: %s. Data: %s. Throughput: %s." % (
-                            timeTaken, '1MB', speedOfCopy))
-
-                        timeTaken_value = re.findall("\d+\.?\d*", str(timeTaken)) 
-                        max_time_taken_value = re.findall("\d+\.?\d*", str(max_time_taken))
-                        if float(timeTaken_value[0]) > float(max_time_taken_value[0]):
-                            max_time_taken = timeTaken
-                            throughput_for_max_time = speedOfCopy
-
-                    if pathsFailed:
-                        printout("    - Paths failover time: %s seconds" % failoverTime)
-                        printout("    - Maximum IO completion time: %s. Data: %s. Throughput: %s" % (
-                        max_time_taken, '1MB', throughput_for_max_time))
-                        display_operation_status(True)
-                        checkpoint += 1
-                    else:
-                        display_operation_status(False)
-                        if not is_man_block:
+                            load.stop()
+                            if monitor:
+                                monitor.stop()
+                            timeline.add_iteration(i, failover_start, load, monitor)
+                            timeline.save()
+                            display_operation_status(False)
+                            if not is_man_block:
+                                self.block_unblock_paths(False, self.storage_conf['pathHandlerUtil'], self.no_of_paths,
+                                                         self.blockedpathinfo)
+                            raise Exception("    - Paths did not failover within expected time.")
+
+                        if is_man_block:
+                            printout(" -> Wait for manually unblocking paths and restoration")
+                            self.wait_manual_block_unblock_paths()
+                            unblock_time = time.monotonic()
+                        else:
+                            unblock_time = time.monotonic()
                             self.block_unblock_paths(False, self.storage_conf['pathHandlerUtil'], self.no_of_paths,
                                                      self.blockedpathinfo)
-                        raise Exception("    - Paths did not failover within expected time.")
-
-                    if is_man_block:
-                        printout(" -> Wait for manually unblocking paths and restoration")
-                        self.wait_manual_block_unblock_paths()
-                    else:
-                        self.block_unblock_paths(False, self.storage_conf['pathHandlerUtil'], self.no_of_paths,
-                                                 self.blockedpathinfo)
-                        printout(" -> Unblocking paths, waiting for restoration.")
-
-                    count = 0
-                    paths_match = False
-                    while not paths_match and count < 120:
-                        paths_match = self.do_new_paths_match(device_config)
-                        time.sleep(1)
-                        count += 1
-
-                    if not paths_match:
-                        display_operation_status(False, "> 2 mins")
-                        retval = False
-                        raise Exception("The path restoration took more than 2 mins.")
-                    else:
-                        display_operation_status(True, " " + str(count) + " seconds")
-                        checkpoint += 1
+                            printout(" -> Unblocking paths, waiting for restoration.")
+
+                        count = 0
+                        paths_match = False
+                        restore_time = None
+                        while not paths_match and count < 120:
+                            paths_match = self.do_new_paths_match(device_config)
+                            if paths_match:
+                                restore_time = time.monotonic()
+                            time.sleep(1)
+                            count += 1
+
+                        load.stop()
+                        if monitor:
+                            monitor.stop()
+                        timeline.add_iteration(i, failover_start, load, monitor, failoverTime, unblock_time, restore_time)
+                        timeline.save()
+                        if not paths_match:
+                            display_operation_status(False, "> 2 mins")
+                            retval = False
+                            raise Exception("The path restoration took more than 2 mins.")
+                        else:
+                            display_operation_status(True, " " + str(count) + " seconds")
+                            report_io_load(load, failover_since)
+                            checkpoint += 1
+                    finally:
+                        if load:
+                            load.stop()
+                        if monitor:
+                            monitor.stop()
 
 
             printout("- Test succeeded.")
@@ -431,6 +481,9 @@ class StorageHandler(object):
             display_operation_status(False)
             retval = False
 
+        if timeline and timeline.iterations:
+            printout("- The IO timeline of each path failover is in %s and %s" % (timeline.json_file, timeline.csv_file))
+
         try:
             # Try cleaning up here
             self.vbd_ref_cleanup(vbd_ref, vdi_ref)
@@ -2146,6 +2199,8 @@ class StorageHandlerISCSI(BlockStorageHandler):
         total_checkpoints = 4
         skipped = 0
         time_for_io_tests_in_sec = 0
+        margin_for_io_tests_in_sec = 0
+        lun_estimates = {}
         wildcard = False
 
         try:
@@ -2244,7 +2299,9 @@ class StorageHandlerISCSI(BlockStorageHandler):
                         sectors = util.get_single_entry(filelist[0])
                         size = int(sectors) * 512 / 1024 / 1024
                         printout("     %-23s\t%-4s\t%-34s\t%-10s" % (portal, key, lun_to_scsi[key][0], size))
-                        time_for_io_tests_in_sec += StorageHandlerUtil.find_disk_data_test_estimate(lun_to_scsi[key][1], size)
+                        lun_estimates[lun_to_scsi[key][0]] = \
+                            StorageHandlerUtil.find_disk_data_test_estimate(lun_to_scsi[key][1], size,
+                                                                            lun_to_scsi[key][0])
                         if lun_to_scsi[key][0] in scsi_to_tuple_map:
                             scsi_to_tuple_map[lun_to_scsi[key][0]].append(( portal, iqn, lun_to_scsi[key][1], size))
                         else:
@@ -2270,10 +2327,17 @@ class StorageHandlerISCSI(BlockStorageHandler):
             printout("   that they are writeable and there is no apparent disk corruption.")
             printout("   the tests attempt to write to the LUN over each available path and")
             printout("   reports the number of writable paths to each LUN.")
+            # The paths are tested at once, as the scheduler of the tests will run them
+            estimator = StorageHandlerUtil.DiskIOScheduler()
+            for key in scsi_to_tuple_map:
+                estimator.add_lun(key, [(tuple[2], tuple[0]) for tuple in scsi_to_tuple_map[key]],
+                                  scsi_to_tuple_map[key][0][3])
+            (time_for_io_tests_in_sec, margin_for_io_tests_in_sec) = estimator.estimate(lun_estimates)
             seconds = time_for_io_tests_in_sec
             minutes = 0
             hrs = 0
-            xencert_print("Total estimated time for the disk IO tests in seconds: %d" % time_for_io_tests_in_sec)
+            xencert_print("Total estimated time for the disk IO tests in seconds: %d +/- %d"
+                          % (time_for_io_tests_in_sec, margin_for_io_tests_in_sec))
             if time_for_io_tests_in_sec > 60:
                 minutes = time_for_io_tests_in_sec/60
                 seconds = int(time_for_io_tests_in_sec - (minutes * 60))
@@ -2281,55 +2345,88 @@ class StorageHandlerISCSI(BlockStorageHandler):
                     hrs = int(minutes/60)
                     minutes = int(minutes - (hrs * 60))
                 
+            confidence = StorageHandlerUtil.format_estimate_confidence(time_for_io_tests_in_sec,
+                                                                       margin_for_io_tests_in_sec)
             printout("   START TIME: %s " % (time.asctime(time.localtime())))
             
             if hrs > 0:
-                printout("   APPROXIMATE RUN TIME: %s hours, %s minutes, %s seconds." % (hrs, minutes, seconds))
+                printout("   APPROXIMATE RUN TIME: %s hours, %s minutes, %s seconds%s." % (hrs, minutes, seconds, confidence))
             elif minutes > 0:
-                printout("   APPROXIMATE RUN TIME: %s minutes, %s seconds." % (minutes, seconds))
+                printout("   APPROXIMATE RUN TIME: %s minutes, %s seconds%s." % (minutes, seconds, confidence))
             elif seconds > 0:
-                printout("   APPROXIMATE RUN TIME: %s seconds." % seconds)
+                printout("   APPROXIMATE RUN TIME: %s seconds%s." % (seconds, confidence))
             
             printout("")
             first_portal = True
-            for key in list(scsi_to_tuple_map.keys()):                                
-                try:                    
-                    total_checkpoints += 1
-                    printout("     - Testing LUN with SCSI ID %-30s" % key)
-                    
+            # First check that each path takes a small write, then test the paths that do from a pool of
+            # threads, and report the LUNs one after the other
+            scheduler = StorageHandlerUtil.DiskIOScheduler()
+            lun_checks = {}
+            for key in list(scsi_to_tuple_map.keys()):
+                try:
+                    root_devices = []
+                    failed_paths = []
                     path_no = 0
-                    path_passed = 0
+                    paths_to_test = []
                     for tuple in scsi_to_tuple_map[key]:                        
                         # If this is a root device then skip IO tests for this device.
                         if os.path.realpath(util.getrootdev()) == tuple[2]:
-                            printout("     -> Skipping IO tests on device %s, as it is the root device." % tuple[2])
-                            printout("                                                                                                   SKIP [Completed]")
-                            skipped += 1
+                            root_devices.append(tuple[2])
                             continue
                         
                         path_no += 1
-        
-                        # Execute a disk IO test against each path to the LUN to verify that it is writeable
-                        # and there is no apparent disk corruption
-                        print_on_same_line("        Path num: %d. Device: %s" % (path_no, tuple[2]))
                         try:
                             # First write a small chunk on the device to make sure it works                    
                             xencert_print("First write a small chunk on the device %s to make sure it works." % tuple[2])
                             cmd = self.util_pread_cmd + [self.util_of_param % tuple[2], 'conv=nocreat']
                             util.pread(cmd)
-                            
-                            xencert_print("lun size: %d MB" % tuple[3])
-                            StorageHandlerUtil.disk_data_test(tuple[2], StorageHandlerUtil.get_blocks_num(tuple[3]))
+                            paths_to_test.append((path_no, tuple))
+                        except Exception as e:  
+                            failed_paths.append((path_no, tuple[2], e))
+                            xencert_print("Device %s failed the disk IO test. Please check if the disk is writable." % tuple[2] )
+
+                    # Execute a disk IO test against all the paths to the LUN to verify that each is
+                    # writeable and there is no apparent disk corruption
+                    if paths_to_test:
+                        size = paths_to_test[0][1][3]
+                        xencert_print("lun size: %d MB" % size)
+                        scheduler.add_lun(key, [(tuple[2], tuple[0]) for (path_no, tuple) in paths_to_test], size)
+                    lun_checks[key] = (root_devices, failed_paths, paths_to_test)
+                except Exception as e:
+                    raise Exception("   - Testing failed while testing devices with SCSI ID: %s." % key)
+
+            results = scheduler.run()
+
+            for key in list(scsi_to_tuple_map.keys()):
+                try:                    
+                    total_checkpoints += 1
+                    printout("     - Testing LUN with SCSI ID %-30s" % key)
+                    
+                    path_passed = 0
+                    (root_devices, failed_paths, paths_to_test) = lun_checks[key]
+                    for device in root_devices:
+                        printout("     -> Skipping IO tests on device %s, as it is the root device." % device)
+                        printout("                                                                                                   SKIP [Completed]")
+                        skipped += 1
+
+                    for path_no, device, e in failed_paths:
+                        print_on_same_line("        Path num: %d. Device: %s" % (path_no, device))
+                        printout("        Exception: %s" % str(e))
+                        display_operation_status(False)
 
+                    for path_no, tuple in paths_to_test:
+                        print_on_same_line("        Path num: %d. Device: %s" % (path_no, tuple[2]))
+                        result = results[tuple[2]]
+                        if isinstance(result, Exception):
+                            printout("        Exception: %s" % str(result))
+                            display_operation_status(False)
+                            xencert_print("Device %s failed the disk IO test. Please check if the disk is writable." % tuple[2] )
+                        else:
                             xencert_print("Device %s passed the disk IO test. " % tuple[2])
                             path_passed += 1
                             printout("")
+                            StorageHandlerUtil.report_disk_data_test_telemetry(result[-1])
                             display_operation_status(True)
-                            
-                        except Exception as e:  
-                            printout("        Exception: %s" % str(e))
-                            display_operation_status(False)
-                            xencert_print("Device %s failed the disk IO test. Please check if the disk is writable." % tuple[2] )
                         
                     if path_passed == 0:
                         display_operation_status(False)
@@ -2338,10 +2435,17 @@ class StorageHandlerISCSI(BlockStorageHandler):
                         printout("        SCSI ID: %s Total paths: %d. Writable paths: %d." % (key, len(scsi_to_tuple_map[key]), path_passed))
                         display_operation_status(True)
                         checkpoint += 1                            
+
+                    if self.storage_conf.get('blocksizesweep'):
+                        total_checkpoints += 1
+                        passed = [tuple for (path_no, tuple) in paths_to_test if not isinstance(results[tuple[2]], Exception)]
+                        if self.block_size_sweep(passed[0][2], passed[0][3]):
+                            checkpoint += 1
                                 
                 except Exception as e:                    
                     raise Exception("   - Testing failed while testing devices with SCSI ID: %s." % key)
                 
+            scheduler.report()
             printout("   END TIME: %s " % (time.asctime(time.localtime())))
             
             checkpoint += 1
@@ -2474,6 +2578,7 @@ class StorageHandlerHBA(BlockStorageHandler):
         skipped = 0
         time_for_io_tests_in_sec = 0
         total_time_for_io_tests_in_sec = 0
+        total_margin_for_io_tests_in_sec = 0
         scsi_id_list = self.storage_conf['scsiIDs'].split(",")
 
         try:
@@ -2519,10 +2624,11 @@ class StorageHandlerHBA(BlockStorageHandler):
             printout("")
             first = True
             host_id_to_lun_list = {}
-            # map from SCSI id -> list of devices
+            # map from SCSI id -> list of (device, size, host id)
             scsi_to_tuple_map = {}
-            # Create a map of the format SCSIid -> [size, time]
-            # this is used to store size of the disk and the calculated time it takes to perform disk IO tests
+            # Create a map of the format SCSIid -> [size, time, margin]
+            # this is used to store size of the disk and the calculated time it takes to perform disk IO tests,
+            # with the half width of its 95% confidence interval
             scsi_info = {}
             for map in list_maps:
                 try:
@@ -2592,20 +2698,21 @@ class StorageHandlerHBA(BlockStorageHandler):
                         printout("     %-4s\t%-34s\t%-20s\t%-10s" % (lun['id'], lun['SCSIid'], lun['device'], size))
 
                         time_for_io_tests_in_sec = 0
+                        margin_for_io_tests_in_sec = 0
                         # Estimate test for only specified lun
                         # CA-398895: Only test 10GB for disk IO test for each LUN, because the size of LUN is too large now,
                         # and it will take too long to finish the test (more than 24 hours).
                         if size > TESTED_SIZE_MB:
                             size = TESTED_SIZE_MB
                         if lun['SCSIid'] in scsi_id_list:
-                            time_for_io_tests_in_sec = StorageHandlerUtil.find_disk_data_test_estimate(lun['device'], size)
+                            (time_for_io_tests_in_sec, margin_for_io_tests_in_sec) = \
+                                StorageHandlerUtil.find_disk_data_test_estimate(lun['device'], size, lun['SCSIid'])
                         if lun['SCSIid'] in scsi_to_tuple_map:
-                            scsi_to_tuple_map[lun['SCSIid']].append((lun['device'], size))
-                            scsi_info[lun['SCSIid']][0] += size
-                            scsi_info[lun['SCSIid']][1] += time_for_io_tests_in_sec
+                            scsi_to_tuple_map[lun['SCSIid']].append((lun['device'], size, map['id']))
                         else:
-                            scsi_to_tuple_map[lun['SCSIid']] = [(lun['device'], size)]
-                            scsi_info[lun['SCSIid']] = [size,time_for_io_tests_in_sec]
+                            scsi_to_tuple_map[lun['SCSIid']] = [(lun['device'], size, map['id'])]
+                            # The estimate is for the whole LUN over one path, see DiskIOScheduler.estimate()
+                            scsi_info[lun['SCSIid']] = (time_for_io_tests_in_sec, margin_for_io_tests_in_sec)
         
 
                 except Exception as e:
@@ -2624,12 +2731,15 @@ class StorageHandlerHBA(BlockStorageHandler):
             printout("   To reduce the time taken to run the tests, only test up to 10GB for disk IO test for each LUN.")
 
             scsi_ids_to_test = {}
+            estimator = StorageHandlerUtil.DiskIOScheduler()
 
             # Create a pruned list which conatins only those SCSIids to be tested
             for key,value in list(scsi_to_tuple_map.items()):
                 if key in scsi_id_list:
                     scsi_ids_to_test[key] = value
-                    total_time_for_io_tests_in_sec += scsi_info[key][1]
+                    estimator.add_lun(key, [(device, host_id) for (device, size, host_id) in value], value[0][1])
+            # The paths are tested at once, as the scheduler of the tests will run them
+            (total_time_for_io_tests_in_sec, total_margin_for_io_tests_in_sec) = estimator.estimate(scsi_info)
 
             # Check if the entered list contains invalid SCSIid entries
             if len(scsi_ids_to_test) != len(scsi_id_list):
@@ -2638,7 +2748,8 @@ class StorageHandlerHBA(BlockStorageHandler):
             seconds = total_time_for_io_tests_in_sec
             minutes = 0
             hrs = 0
-            xencert_print("Total estimated time for the disk IO tests in seconds: %d" % total_time_for_io_tests_in_sec)
+            xencert_print("Total estimated time for the disk IO tests in seconds: %d +/- %d"
+                          % (total_time_for_io_tests_in_sec, total_margin_for_io_tests_in_sec))
             if total_time_for_io_tests_in_sec > 60:
                 minutes = int(total_time_for_io_tests_in_sec/60)
                 seconds = int(total_time_for_io_tests_in_sec - (minutes * 60))
@@ -2646,54 +2757,88 @@ class StorageHandlerHBA(BlockStorageHandler):
                     hrs = int(minutes/60)
                     minutes = int(minutes - (hrs * 60))
                 
+            confidence = StorageHandlerUtil.format_estimate_confidence(total_time_for_io_tests_in_sec,
+                                                                       total_margin_for_io_tests_in_sec)
             printout("   START TIME: %s " % (time.asctime(time.localtime())))
             if hrs > 0:
-                printout("   APPROXIMATE RUN TIME: %s hours, %s minutes, %s seconds." % (hrs, minutes, seconds))
+                printout("   APPROXIMATE RUN TIME: %s hours, %s minutes, %s seconds%s." % (hrs, minutes, seconds, confidence))
             elif minutes > 0:
-                printout("   APPROXIMATE RUN TIME: %s minutes, %s seconds." % (minutes, seconds))
+                printout("   APPROXIMATE RUN TIME: %s minutes, %s seconds%s." % (minutes, seconds, confidence))
             elif seconds > 0:
-                printout("   APPROXIMATE RUN TIME: %s seconds." % seconds)
+                printout("   APPROXIMATE RUN TIME: %s seconds%s." % (seconds, confidence))
             
             printout("")
             total_checkpoints += 1
+            # First check that each path takes a small write, then test the paths that do from a pool of
+            # threads, and report the LUNs one after the other
+            scheduler = StorageHandlerUtil.DiskIOScheduler()
+            lun_checks = {}
             for key in list(scsi_ids_to_test.keys()):
                 try:
-                    total_checkpoints += 1
-                    printout("     - Testing LUN with SCSI ID %-30s" % key)
-
+                    root_devices = []
+                    failed_paths = []
                     path_no = 0
-                    path_passed = 0
-                    for device,size in scsi_ids_to_test[key]:
+                    paths_to_test = []
+                    for device, size, host_id in scsi_ids_to_test[key]:
                         # If this is a root device then skip IO tests for this device.
                         if os.path.realpath(util.getrootdev()) == device:
-                            printout("     -> Skipping IO tests on device %s, as it is the root device." % device)
-                            printout("                                                                                                   SKIP [Completed]")
-                            skipped += 1
+                            root_devices.append(device)
                             continue
 
                         path_no += 1
-                        
-                        # Execute a disk IO test against each path to the LUN to verify that it is writeable
-                        # and there is no apparent disk corruption
-                        print_on_same_line("        Path num: %d. Device: %s" % (path_no, device))
                         try:
                             # First write a small chunk on the device to make sure it works
                             xencert_print("First write a small chunk on the device %s to make sure it works." % device)
                             cmd = self.util_pread_cmd + [self.util_of_param % device, 'conv=nocreat']
                             util.pread(cmd)
-                            
-                            xencert_print("lun size: %d MB" % size)
-                            StorageHandlerUtil.disk_data_test(device, StorageHandlerUtil.get_blocks_num(size))
-                            
+                            paths_to_test.append((path_no, device, size, host_id))
+                        except Exception as e:
+                            failed_paths.append((path_no, device, e))
+                            xencert_print("Device %s failed the disk IO test. Please check if the disk is writable." % device )
+
+                    # Execute a disk IO test against all the paths to the LUN to verify that each is
+                    # writeable and there is no apparent disk corruption
+                    if paths_to_test:
+                        size = paths_to_test[0][2]
+                        xencert_print("lun size: %d MB" % size)
+                        scheduler.add_lun(key, [(device, host_id) for (path_no, device, size, host_id) in paths_to_test],
+                                          size)
+                    lun_checks[key] = (root_devices, failed_paths, paths_to_test)
+                except Exception as e:
+                    raise Exception("   - Testing failed while testing devices with SCSI ID: %s." % key)
+
+            results = scheduler.run()
+
+            for key in list(scsi_ids_to_test.keys()):
+                try:
+                    total_checkpoints += 1
+                    printout("     - Testing LUN with SCSI ID %-30s" % key)
+
+                    path_passed = 0
+                    (root_devices, failed_paths, paths_to_test) = lun_checks[key]
+                    for device in root_devices:
+                        printout("     -> Skipping IO tests on device %s, as it is the root device." % device)
+                        printout("                                                                                                   SKIP [Completed]")
+                        skipped += 1
+
+                    for path_no, device, e in failed_paths:
+                        print_on_same_line("        Path num: %d. Device: %s" % (path_no, device))
+                        printout("        Exception: %s" % str(e))
+                        display_operation_status(False)
+
+                    for path_no, device, size, host_id in paths_to_test:
+                        print_on_same_line("        Path num: %d. Device: %s" % (path_no, device))
+                        result = results[device]
+                        if isinstance(result, Exception):
+                            printout("        Exception: %s" % str(result))
+                            display_operation_status(False)
+                            xencert_print("Device %s failed the disk IO test. Please check if the disk is writable." % device )
+                        else:
                             xencert_print("Device %s passed the disk IO test. " % device)
                             path_passed += 1
                             printout("")
+                            StorageHandlerUtil.report_disk_data_test_telemetry(result[-1])
                             display_operation_status(True)
-
-                        except Exception as e:
-                            printout("        Exception: %s" % str(e))
-                            display_operation_status(False)
-                            xencert_print("Device %s failed the disk IO test. Please check if the disk is writable." % device )
                     if path_passed == 0:
                         display_operation_status(False)
                         raise Exception("     - LUN with SCSI ID %-30s. Failed the IO test, none of the paths were writable." % key)                        
@@ -2702,9 +2847,16 @@ class StorageHandlerHBA(BlockStorageHandler):
                         display_operation_status(True)
                         checkpoint += 1
 
+                    if self.storage_conf.get('blocksizesweep'):
+                        total_checkpoints += 1
+                        passed = [(device, size) for (path_no, device, size, host_id) in paths_to_test if not isinstance(results[device], Exception)]
+                        if self.block_size_sweep(passed[0][0], passed[0][1]):
+                            checkpoint += 1
+
                 except Exception as e:
                     raise Exception("   - Testing failed while testing devices with SCSI ID: %s." % key)
 
+            scheduler.report()
             printout("   END TIME: %s " % (time.asctime(time.localtime())))
             checkpoint += 1
 
@@ -3175,9 +3327,10 @@ class StorageHandlerCIFS(StorageHandler):
             printout("Attached the VDI to dom0")
             checkpoint += 1
 
-            #4) Write known pattern to VDI
-            StorageHandlerUtil.write_data_to_vdi(self.session, vbd_ref, 0, 3)
-            printout("Wrote data to VDI")
+            #4) Write known pattern to VDI, recording a digest of every block
+            manifest = bytearray()
+            (size, elapsed) = StorageHandlerUtil.write_data_to_vdi(self.session, vbd_ref, 0, 3, manifest)
+            printout("Wrote data to VDI, %d MiB at %.1f MB/s" % (size // StorageHandlerUtil.MiB, size / StorageHandlerUtil.MiB / elapsed))
             checkpoint += 1
 
             #5) Detach VDI
@@ -3197,8 +3350,8 @@ class StorageHandlerCIFS(StorageHandler):
             checkpoint += 1
 
             #8) Write known pattern to second 4GB chunk
-            StorageHandlerUtil.write_data_to_vdi(self.session, vbd_ref, 4, 7)
-            printout("Wrote data onto grown portion of the VDI")
+            (size, elapsed) = StorageHandlerUtil.write_data_to_vdi(self.session, vbd_ref, 4, 7, manifest)
+            printout("Wrote data onto grown portion of the VDI, %d MiB at %.1f MB/s" % (size // StorageHandlerUtil.MiB, size / StorageHandlerUtil.MiB / elapsed))
             checkpoint += 1
 
             #9) Detach VDI
@@ -3212,9 +3365,9 @@ class StorageHandlerCIFS(StorageHandler):
             printout("VDI attached again to Dom0")
             checkpoint += 1
 
-            #11) Validate pattern on first and second 4GB chunks
-            StorageHandlerUtil.verify_data_on_vdi(self.session, vbd_ref, 0, 7)
-            printout("Verified data on complete VDI")
+            #11) Validate the digests of the first and second 4GB chunks
+            (size, elapsed) = StorageHandlerUtil.verify_data_on_vdi(self.session, vbd_ref, 0, 7, manifest)
+            printout("Verified data on complete VDI, %d MiB at %.1f MB/s" % (size // StorageHandlerUtil.MiB, size / StorageHandlerUtil.MiB / elapsed))
             checkpoint += 1
 
         except Exception as e:
@@ -17,11 +17,30 @@
 """Storage handler classes for various storage drivers"""
 import os
 import re
+import mmap
 import time
 import glob
+import json
+import csv
 import random
+import tempfile
+import errno
+import fcntl
+import ctypes
+import struct
+import socket
+import select
+import zlib
+import hashlib
+import math
+import statistics
+from array import array
 import xml.dom.minidom
-from XenCertLog import printout, print_on_same_line, xencert_print
+from threading import Thread, Condition, Event
+import TimedWrite
+import IOLoad
+from Progress import ProgressTracker
+from XenCertLog import printout, print_on_same_line, print_to_log, get_log_file_name, xencert_print
 from XenCertCommon import display_operation_status, get_config_with_hidden_password
 from sm import scsiutil, util, lvutil, vhdutil, iscsilib, mpath_dmp, mpath_cli, xs_errors
 
@@ -33,6 +52,8 @@ speedOfCopy = ''
 timeLimitControlInSec = 18000
 
 MAX_TIMEOUT = 15
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_KERNEL_GROUP = 1  # multicast group of the uevents as the kernel sends them, before udev
 
 KiB = 1024
 MiB = KiB * KiB
@@ -48,6 +69,44 @@ BUF_ZEROS = "\0" * 512
 DISKDATATEST = '/opt/xensource/debug/XenCert/diskdatatest'
 DDT_SECTOR_SIZE = 512  # one sector size: 512 bytes
 DDT_DEFAULT_BLOCK_SIZE = 512  # one block size: 512 sectors, 256KB
+DDT_DEFAULT_ENGINE = 'auto'  # io_uring, falling back to native AIO, then sync IO
+DDT_DEFAULT_QUEUE_DEPTH = 32  # blocks kept in flight by the async engines
+DDT_DEFAULT_VERIFY_LAG = 64  # blocks written before writeverify reads one back
+DDT_DEFAULT_ORDER = 'seq'  # block order: 'seq', 'random' (seeded permutation) or 'stride'
+DDT_DEFAULT_WORKERS = max(1, min(4, (os.cpu_count() or 1) // 2))  # threads per device, each on a part of it
+DDT_SWEEP_MAX_BLOCK_SIZE = 8192  # the block size sweep goes from 8 sectors, 4KB, to 8192 sectors, 4MB
+DDT_SWEEP_SIZE = 1024  # MB of the device written and read back at each block size
+DDT_SWEEP_BURST_TIME = 5  # seconds each block size is written, and then read, at most
+DDT_DISCARD_GRANULARITIES = [128, 2048, 32768]  # sectors of one discard: 64KB, 1MB and 16MB
+DDT_DISCARD_SIZE = 256  # MB written, then discarded, at each granularity at most
+DDT_DISCARD_SETTLE_TIME = 30  # seconds to wait for the discarded blocks to read back as zeros
+DDT_PROGRESS_POLL = 1  # seconds between two reads of the telemetry of a running diskdatatest for progress
+DDT_SAMPLE_POINTS = 4  # offsets across the LUN sampled to estimate the run time
+DDT_SAMPLE_SIZE = 32  # MB written and verified at each of them at most
+DDT_SAMPLE_TIME = 1  # seconds spent at each of them at most
+DDT_T_95 = {1: 12.706, 2: 4.303, 3: 3.182, 4: 2.776, 5: 2.571, 6: 2.447, 7: 2.365}  # Student's t, 95%, by dof
+DDT_THROUGHPUT_CACHE = '/var/lib/xencert/throughput.json'  # throughputs measured by earlier runs
+DDT_THROUGHPUT_MAX_AGE = 7 * 24 * 3600  # seconds after which a cached throughput is measured again
+
+ddt_rate_limit = 0  # MB/s cap of each diskdatatest run, 0 means none
+ddt_iops_limit = 0  # IOPS cap of each diskdatatest run, 0 means none
+ddt_max_paths = 8  # paths the disk IO tests run at once, over all the LUNs
+ddt_max_paths_per_lun = 0  # paths of one LUN tested at once, 0 means all of them
+ddt_max_paths_per_group = 0  # paths through one HBA adapter or iSCSI portal tested at once, 0 means no limit
+ddt_sampled_rates = {}  # seconds per MB and margin sampled in this run by SCSI ID, shared by the paths to a LUN
+
+BLKZEROOUT = 0x127f  # _IO(0x12, 127) from linux/fs.h
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_ZERO_RANGE = 0x10
+ZERO_ALIGNMENT = 4096  # the zeroing engine handles the unaligned edges with buffered writes
+ZERO_CHUNK_SIZE = 256 * MiB  # bytes zeroed per call, progress is checked between two calls
+ZERO_BUFFER_SIZE = 4 * MiB  # buffer of the direct IO writes, when the device cannot zero by itself
+
+VDI_CHUNK_SIZE = 4 * MiB  # bytes written or read back at a time by the VDI data integrity checks
+VDI_PATTERN_FILL = bytes(range(256)) * 2  # one sector of filler, under the offset and seed words
+VDI_MANIFEST_BLOCK = MiB  # bytes covered by one digest of a VDI manifest
+VDI_DIGEST_SIZE = 16  # bytes of BLAKE2b digest kept per block
+VDI_VERIFY_WORKERS = 4  # threads re-hashing the VDI against its manifest
 
 MSIZE_MB = 2 * 1024 * 1024  # max virt size for fast resize
 MSIZE = int(MSIZE_MB * 1024 * 1024)
@@ -458,7 +517,7 @@ def destroy_sr(session, sr_ref):
         raise Exception(str(e))
 
 
-def create_max_size_vdi_and_vbd(session, sr_ref):
+def create_max_size_vdi_and_vbd(session, sr_ref, sm_config=None):
     vdi_ref = None
     vbd_ref = None
     retval = True
@@ -484,7 +543,7 @@ def create_max_size_vdi_and_vbd(session, sr_ref):
             args['sharable'] = False
             args['read_only'] = False
             args['other_config'] = {}
-            args['sm_config'] = {}
+            args['sm_config'] = dict(sm_config or {})
             args['xenstore_data'] = {}
             args['tags'] = []
             xencert_print("The VDI create parameters are %s" % args)
@@ -587,22 +646,90 @@ def detach_vdi(session, vbd_ref):
 
 
 def find_time_to_write_data(devicename, size_in_mib):
-    dd_out_file = 'of=' + devicename
     xencert_print(
-        "Now copy %dMiB data from /dev/zero to this device and record the time taken to copy it." % size_in_mib)
-    cmd = ['dd', 'if=/dev/zero', dd_out_file, 'bs=4096', 'count=%d' % (size_in_mib * 256)]
-    try:
-        (rc, stdout, stderr) = util.doexec(cmd, '')
-        list = stderr.split('\n')
-        time_taken = list[2].split(',')[1]
-        data_copy_time = int(float(time_taken.split()[0]))
-        xencert_print("The IO test returned rc: %s stdout: %s, stderr: %s" % (rc, stdout, stderr))
-        xencert_print("Time taken to copy %dMiB to the device %s is %d" % (size_in_mib, devicename, data_copy_time))
-        return data_copy_time
+        "Now write %dMiB of zeros to this device and record the time taken to write it." % size_in_mib)
+    try:
+        progress = ProgressTracker("Written", size_in_mib * MiB)
+        try:
+            result = TimedWrite.timed_write(devicename, size_in_mib * MiB, chunk_size=ZERO_BUFFER_SIZE,
+                                            progress=progress.add)
+        finally:
+            progress.finish()
+        xencert_print("Time taken to write %dMiB to the device %s is %.3f seconds, the slowest %dMiB chunk took %.3f seconds"
+                      % (size_in_mib, devicename, result.elapsed, ZERO_BUFFER_SIZE // MiB,
+                         max(result.latencies) / 1e9))
+        return result.elapsed
     except Exception as e:
         raise Exception(str(e))
 
 
+def _zero_range_blkzeroout(fd, offset, length):
+    # BLKZEROOUT never unmaps, so the space really gets allocated on a thin provisioned array
+    fcntl.ioctl(fd, BLKZEROOUT, struct.pack('QQ', offset, length))
+
+
+def _zero_range_fallocate(fd, offset, length):
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    if libc.fallocate(fd, FALLOC_FL_ZERO_RANGE | FALLOC_FL_KEEP_SIZE, offset, length) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+
+def zero_out(path, from_byte, length):
+    # Write length zeros to path from from_byte, with the fastest method the device supports: BLKZEROOUT,
+    # then fallocate(FALLOC_FL_ZERO_RANGE), then direct writes, with a live progress line. Returns True if all
+    # the range was zeroed.
+    start = time.perf_counter()
+    direct_writer = None
+    progress = ProgressTracker("Zeroed", length)
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        # Unaligned edges, if any, go through the page cache
+        aligned_from = min(-(-from_byte // ZERO_ALIGNMENT) * ZERO_ALIGNMENT, from_byte + length)
+        aligned_to = max((from_byte + length) // ZERO_ALIGNMENT * ZERO_ALIGNMENT, aligned_from)
+        for offset, size in [(from_byte, aligned_from - from_byte), (aligned_to, from_byte + length - aligned_to)]:
+            if size:
+                os.pwrite(fd, bytes(size), offset)
+        os.fsync(fd)
+
+        methods = [('BLKZEROOUT', _zero_range_blkzeroout), ('fallocate', _zero_range_fallocate)]
+        progress.add(length - (aligned_to - aligned_from))
+        offset = aligned_from
+        used = 'buffered IO'
+        while offset < aligned_to:
+            size = min(ZERO_CHUNK_SIZE, aligned_to - offset)
+            try:
+                methods[0][1](fd, offset, size)
+            except (OSError, IOError) as e:
+                if e.errno not in (errno.ENOTTY, errno.EOPNOTSUPP, errno.EINVAL, errno.ENODEV) or \
+                        methods[0][0] == 'direct IO':
+                    raise
+                xencert_print("Zeroing %s with %s is not supported: %s" % (path, methods[0][0], str(e)))
+                methods.pop(0)
+                if not methods:
+                    direct_writer = TimedWrite.TimedWriter(path, ZERO_BUFFER_SIZE)
+                    methods.append(('direct IO', lambda fd, offset, length: direct_writer.write(length, offset)))
+                continue
+            offset += size
+            used = methods[0][0]
+            progress.add(size)
+
+        progress.finish()
+        elapsed = time.perf_counter() - start
+        printout("   Zeroed %d MiB in %.1f seconds, %.1f MB/s with %s" %
+                 (length // MiB, elapsed, length / MiB / elapsed if elapsed else 0, used))
+        return True
+    except Exception as e:
+        xencert_print("Could not zero %d bytes of %s from %d. Exception: %s" % (length, path, from_byte, str(e)))
+        return False
+    finally:
+        progress.finish()
+        if direct_writer:
+            direct_writer.close()
+        os.close(fd)
+
+
 def perform_sr_control_path_tests(session, sr_ref):
     e = None
     try:
@@ -646,7 +773,7 @@ def perform_sr_control_path_tests(session, sr_ref):
         elif time_to_write > 0:
             printout("   APPROXIMATE RUN TIME: %s seconds." % (time_to_write))
 
-        if not util.zeroOut(devicename, 0, int(vdi_size)):
+        if not zero_out(devicename, 0, int(vdi_size)):
             raise Exception(
                 "   - Could not write through the allocated disk space on test disk, please check the log for the exception details.")
 
@@ -679,6 +806,55 @@ def perform_sr_control_path_tests(session, sr_ref):
     return (checkpoint, retval)
 
 
+def perform_sr_discard_tests(session, sr_ref):
+    # Measure space reclamation on a raw test VDI: discard it through its VBD in dom0 at each granularity of
+    # DDT_DISCARD_GRANULARITIES and report the discard throughput and latency, and how long the array took
+    # to read the discarded space back as zeros. The VDI is raw so that the writes and discards from offset 0
+    # do not overwrite any VHD metadata.
+    checkpoint = 0
+    vdi_ref = None
+    vbd_ref = None
+    retval = True
+
+    try:
+        (retval, vdi_ref, vbd_ref, vdi_size) = create_max_size_vdi_and_vbd(session, sr_ref, {'type': 'raw'})
+        if not retval:
+            raise Exception("Failed to create max size VDI and VBD.")
+        checkpoint += 2
+
+        # The discards go through the datapath of the VDI, as those of a guest would
+        device = '/dev/' + session.xenapi.VBD.get_device(vbd_ref)
+        printout("   Write, then discard, the VDI through %s at each granularity." % device)
+
+        region_size = min(DDT_DISCARD_SIZE, int(vdi_size) // MiB // len(DDT_DISCARD_GRANULARITIES))
+        discards = disk_data_test_discard(device, region_size)
+        report_disk_data_test_discard(discards)
+        display_operation_status(True)
+        checkpoint += 1
+    except Exception as e:
+        printout("There was an exception performing the discard tests. Exception: %s" % str(e))
+        display_operation_status(False)
+        retval = False
+
+    try:
+        if vbd_ref is not None:
+            session.xenapi.VBD.unplug(vbd_ref)
+            xencert_print("Unplugged VBD %s" % vbd_ref)
+            session.xenapi.VBD.destroy(vbd_ref)
+            xencert_print("Destroyed VBD %s" % vbd_ref)
+
+        if vdi_ref is not None:
+            session.xenapi.VDI.destroy(vdi_ref)
+            xencert_print("Destroyed VDI %s" % vdi_ref)
+    except Exception as e:
+        printout(
+            "- Could not cleanup the objects created during testing, please destroy the vbd %s and vdi %s manually." % (
+            vbd_ref, vdi_ref))
+        printout("  Exception: %s" % str(e))
+
+    return (checkpoint, retval)
+
+
 def get_lun_scsiid_devicename_mapping(target_iqn, portal):
     iscsilib.refresh_luns(target_iqn, portal)
     lun_to_scsi_id = {}
@@ -758,11 +934,7 @@ def parse_multipathd_config(lines):
 def parse_config(vendor, product):
     device_config = None
     try:
-        cmd = "show config"
-        xencert_print("mpath cmd: %s" % cmd)
-        (rc, stdout, stderr) = util.doexec(mpath_cli.mpathcmd, cmd)
-        xencert_print("mpath output: %s" % stdout)
-        d = parse_multipathd_config([line + '\n' for line in stdout.split('\n')])
+        d = parse_multipathd_config([line + '\n' for line in mpath_cli.command("show config").split('\n')])
         xencert_print("mpath config to dict: %s" % d)
 
         for _, device_value in d["devices"]:
@@ -855,6 +1027,148 @@ def get_path_status(scsi_id, only_active=False):
     return (retval, list)
 
 
+class PathEventMonitor(Thread):
+    """Follows the path failures and reinstatements of the multipath map of a LUN as they happen.
+
+    dm-multipath sends a uevent for the map whenever it fails or reinstates a path, with the number of valid
+    paths left. They are read from the kernel's netlink uevent socket, and stamped with the monotonic clock
+    as they arrive. Raises OSError if the socket cannot be opened.
+    """
+
+    def __init__(self, scsi_id):
+        Thread.__init__(self)
+        self.daemon = True
+        self.scsi_id = scsi_id
+        self.events = []  # (monotonic time, 'PATH_FAILED' or 'PATH_REINSTATED', path major:minor, valid paths)
+        self.cond = Condition()
+        self.stopping = False
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, MiB)
+            self.sock.bind((0, UEVENT_KERNEL_GROUP))
+        except Exception:
+            self.sock.close()
+            raise
+
+    def _parse(self, data):
+        # '<action>@<devpath>\0KEY=value\0...'
+        env = dict(field.split('=', 1) for field in data.decode('utf-8', 'replace').split('\0') if '=' in field)
+        if env.get('DM_ACTION') not in ('PATH_FAILED', 'PATH_REINSTATED'):
+            return None
+        if env.get('DM_NAME') != self.scsi_id and env.get('DM_UUID') != 'mpath-' + self.scsi_id:
+            return None
+        return env['DM_ACTION'], env.get('DM_PATH', ''), int(env.get('DM_NR_VALID_PATHS', -1))
+
+    def run(self):
+        while not self.stopping:
+            readable, _, _ = select.select([self.sock], [], [], 0.5)
+            if not readable:
+                continue
+            try:
+                data = self.sock.recv(65536)
+            except OSError as e:
+                # ENOBUFS: uevents were dropped, the waiters recheck with multipathd
+                xencert_print("Reading uevents for %s failed: %s" % (self.scsi_id, str(e)))
+                continue
+            now = time.monotonic()
+            event = self._parse(data)
+            if event:
+                xencert_print("Path event on %s at %.3f: %s %s, %d valid paths" % ((self.scsi_id, now) + event))
+                with self.cond:
+                    self.events.append((now,) + event)
+                    self.cond.notify_all()
+
+    def wait_for(self, check, deadline):
+        """Wait until an event satisfies check(valid paths) or until the monotonic deadline, whichever comes
+        first. Returns the time of the event, or None."""
+        seen = 0
+        with self.cond:
+            while True:
+                for event in self.events[seen:]:
+                    if event[3] >= 0 and check(event[3]):
+                        return event[0]
+                seen = len(self.events)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+
+    def stop(self):
+        self.stopping = True
+        self.join()
+        self.sock.close()
+
+
+class FailoverTimeline(object):
+    """Timeline of each path block and restore iteration of the multipath tests, saved next to the XenCert log.
+
+    The events of an iteration are timed in seconds from when its paths were blocked: the block and the unblock,
+    the path failures and reinstatements seen by the PathEventMonitor, the failover and the restoration seen by
+    multipathd, and the first IO stall of the load and when the IOs resumed. The IO load is summed up every
+    LOAD_SERIES_INTERVAL seconds. save() rewrites the JSON and CSV files with all the iterations so far.
+    """
+
+    def __init__(self):
+        base = os.path.splitext(get_log_file_name())[0]
+        self.json_file = base + '-failover.json'
+        self.csv_file = base + '-failover.csv'
+        self.iterations = []
+
+    def add_iteration(self, iteration, block_time, load, monitor=None, failover_time=None, unblock_time=None,
+                      restore_time=None):
+        # block_time, unblock_time and restore_time are on the monotonic clock, failover_time is relative to
+        # block_time
+        def at(t):
+            return round(t - block_time, 6)
+
+        events = [{'time': 0.0, 'event': 'block issued'}]
+        if failover_time is not None:
+            events.append({'time': round(failover_time, 6), 'event': 'failover complete'})
+        for (t, action, path, valid) in (monitor.events if monitor else []):
+            events.append({'time': at(t), 'event': 'path failed' if action == 'PATH_FAILED' else 'path restored',
+                           'path': path, 'valid_paths': valid})
+        since = block_time - load.start_time
+        stalls = [stall for stall in load.stalls() if stall[0] + stall[1] >= since]
+        if stalls:
+            events.append({'time': at(load.start_time + stalls[0][0]), 'event': 'first IO stall'})
+            events.append({'time': at(load.start_time + stalls[0][0] + stalls[0][1]), 'event': 'IO resumed'})
+        if unblock_time is not None:
+            events.append({'time': at(unblock_time), 'event': 'unblock issued'})
+        if restore_time is not None:
+            events.append({'time': at(restore_time), 'event': 'restoration complete'})
+        events.sort(key=lambda event: event['time'])
+
+        (ios, nbytes, longest) = load.series()
+        interval = IOLoad.LOAD_SERIES_INTERVAL
+        self.iterations.append({
+            'iteration': iteration,
+            'events': events,
+            'io': {'interval': interval,
+                   'time': [at(load.start_time + i * interval) for i in range(len(ios))],
+                   'ios': list(ios),
+                   'mb_per_s': [round(b / MiB / interval, 3) for b in nbytes],
+                   'max_latency_ms': [round(l / 1e6, 3) for l in longest]}})
+
+    def save(self):
+        try:
+            with open(self.json_file, 'w') as f:
+                json.dump({'iterations': self.iterations}, f, indent=1)
+            with open(self.csv_file, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['iteration', 'time', 'event', 'path', 'valid_paths', 'ios', 'mb_per_s',
+                                 'max_latency_ms'])
+                for it in self.iterations:
+                    rows = [(e['time'], e['event'], e.get('path', ''), e.get('valid_paths', ''), '', '', '')
+                            for e in it['events']]
+                    io = it['io']
+                    rows += [(t, 'io', '', '', n, mbps, lat) for (t, n, mbps, lat) in
+                             zip(io['time'], io['ios'], io['mb_per_s'], io['max_latency_ms'])]
+                    rows.sort(key=lambda row: row[0])
+                    writer.writerows([(it['iteration'],) + row for row in rows])
+        except (IOError, OSError) as e:
+            xencert_print("Failed to save the failover timeline: %s" % str(e))
+
+
 def _get_localhost_uuid():
     filename = '/etc/xensource-inventory'
     try:
@@ -868,52 +1182,637 @@ def _get_localhost_uuid():
     return domid
 
 
-def disk_data_test(device, test_blocks, sect_of_block=DDT_DEFAULT_BLOCK_SIZE, test_time=0):
+def _read_disk_data_test_telemetry(telemetry_file):
+    # Interval lines go to the log, the per-op summaries of each device are handed back
+    summary = {}
+    with open(telemetry_file, 'r') as f:
+        for line in f:
+            record = json.loads(line)
+            if record['type'] == 'summary':
+                summary.setdefault(record['device'], {})[record['op']] = record
+            else:
+                xencert_print("diskdatatest %(device)s %(op)s at %(t).1fs: %(mbps).2f MB/s, %(iops).1f IOPS, "
+                              "latency p50 %(p50_us).1f us, p99 %(p99_us).1f us, p99.9 %(p999_us).1f us, "
+                              "max %(max_us).1f us" % record)
+    return summary
+
+
+def _read_bad_sector_map(map_file):
+    # Lines are '<device> <start> <count> <expected sect> <expected iter> <found sect> <found iter>',
+    # or '# <device>: <note>' when the map of the device is incomplete. Returns a dict of device to its
+    # list of ranges, and a dict of device to its list of notes.
+    bad_map = {}
+    notes = {}
+    with open(map_file, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('#'):
+                (device, _, note) = line[1:].partition(':')
+                notes.setdefault(device.strip(), []).append(note.strip())
+            else:
+                device = line.split()[0]
+                bad_map.setdefault(device, []).append(line[len(device):].strip())
+    return bad_map, notes
+
+
+def _bad_sectors_error(device, sector_errors, bad_ranges, notes=()):
+    # Attach the map of bad sectors to the XenCert report, the exception only carries the totals
+    xencert_print("Device %s has %d bad sectors in %d ranges" % (device, sector_errors, len(bad_ranges)))
+    print_to_log("\nBad sector ranges on %s (start sectors expected_sect expected_iter found_sect found_iter):\n"
+                 % device)
+    for bad_range in bad_ranges:
+        print_to_log("    %s\n" % bad_range)
+    for note in notes:
+        print_to_log("    (%s)\n" % note)
+    return Exception("Disk test verify error on %d sectors in %s%d ranges, the bad sector map is in %s!"
+                     % (sector_errors, "more than " if notes else "", len(bad_ranges), get_log_file_name()))
+
+
+def set_disk_data_test_limits(rate_limit, iops_limit):
+    # Cap every diskdatatest run of the disk IO tests, so that they take a bounded share of an array that
+    # also serves live pools. The caps hold for a whole run, across all the paths and workers it tests.
+    global ddt_rate_limit
+    global ddt_iops_limit
+    try:
+        ddt_rate_limit = float(rate_limit or 0)
+        ddt_iops_limit = float(iops_limit or 0)
+    except ValueError:
+        raise Exception("The disk IO test rate limits must be numbers.")
+    if ddt_rate_limit < 0 or ddt_iops_limit < 0:
+        raise Exception("The disk IO test rate limits must not be negative.")
+
+
+def _disk_data_test_limit_opts(share=1.0):
+    # share is the part of the caps given to this run, when several of them share the caps
+    opts = []
+    if ddt_rate_limit:
+        opts += ['-r', str(ddt_rate_limit * share)]
+    if ddt_iops_limit:
+        opts += ['-R', str(ddt_iops_limit * share)]
+    return opts
+
+
+def set_disk_data_test_concurrency(max_paths, max_paths_per_lun, max_paths_per_group):
+    # How many paths the disk IO tests of the iSCSI and HBA functional tests run at once, see DiskIOScheduler
+    global ddt_max_paths
+    global ddt_max_paths_per_lun
+    global ddt_max_paths_per_group
+    try:
+        ddt_max_paths = int(max_paths or ddt_max_paths)
+        ddt_max_paths_per_lun = int(max_paths_per_lun or 0)
+        ddt_max_paths_per_group = int(max_paths_per_group or 0)
+    except ValueError:
+        raise Exception("The disk IO test concurrency limits must be integers.")
+    if ddt_max_paths < 1 or ddt_max_paths_per_lun < 0 or ddt_max_paths_per_group < 0:
+        raise Exception("The disk IO test concurrency limits must be positive.")
+
+
+class _TelemetryFollower(Thread):
+    # Feeds the bytes of the interval records a running diskdatatest appends to its telemetry file to a
+    # ProgressTracker
+    def __init__(self, telemetry_file, progress):
+        Thread.__init__(self)
+        self.daemon = True
+        self.telemetry_file = telemetry_file
+        self.progress = progress
+        self.stopping = Event()
+
+    def run(self):
+        pending = ''
+        with open(self.telemetry_file, 'r') as f:
+            while True:
+                stopped = self.stopping.wait(DDT_PROGRESS_POLL)
+                lines = (pending + f.read()).split('\n')
+                pending = lines.pop()
+                for line in lines:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if record.get('type') == 'interval':
+                        self.progress.add(record.get('bytes', 0))
+                if stopped:
+                    break
+
+    def stop(self):
+        self.stopping.set()
+        self.join()
+
+
+def _run_disk_data_test(engine_opts, op, devices, sect_of_block, test_blocks, test_time, iter_start, limit_share=1.0,
+                        progress=None):
+    # Returns the summary numbers, telemetry and (bad sector map, notes) of the devices that completed the op.
+    # The IO done is fed to the progress tracker as it goes, if given.
+    fd, telemetry_file = tempfile.mkstemp(prefix='diskdatatest-', suffix='.json')
+    os.close(fd)
+    fd, map_file = tempfile.mkstemp(prefix='diskdatatest-', suffix='.map')
+    os.close(fd)
+    try:
+        cmd = [DISKDATATEST] + engine_opts
+        cmd.extend(_disk_data_test_limit_opts(limit_share))
+        cmd.extend(['-T', telemetry_file, '-m', map_file])
+        cmd.extend([op, ','.join(devices), str(sect_of_block), str(test_blocks), str(test_time), iter_start])
+        xencert_print("The command to be fired is: %s" % cmd)
+        follower = None
+        if progress:
+            follower = _TelemetryFollower(telemetry_file, progress)
+            follower.start()
+        try:
+            (rc, stdout, stderr) = util.doexec(cmd)
+        finally:
+            if follower:
+                follower.stop()
+        xencert_print("diskdatatest returned %d: %s" % (rc, stdout))
+        if rc != 0:
+            xencert_print("Disk test %s error: %s" % (op, stderr))
+
+        results = {}
+        lines = stdout.strip().splitlines()
+        if len(devices) == 1:
+            if rc == 0:
+                results[devices[0]] = lines[-1].split()
+        else:
+            # One line per device that passed: <device> <max_blocks> <op_blocks> <op_elapsed> <sect_errors>
+            for line in lines:
+                fields = line.split()
+                if len(fields) == 5 and fields[0] in devices:
+                    results[fields[0]] = fields[1:]
+        for device in results:
+            total_blocks, op_blocks, op_elapsed, sector_errors = results[device]
+            results[device] = int(total_blocks), int(op_blocks), float(op_elapsed), int(sector_errors)
+
+        telemetry = _read_disk_data_test_telemetry(telemetry_file)
+        bad_map = _read_bad_sector_map(map_file)
+    finally:
+        os.unlink(telemetry_file)
+        os.unlink(map_file)
+
+    return results, telemetry, bad_map
+
+
+def disk_data_test_devices(devices, test_blocks, sect_of_block=DDT_DEFAULT_BLOCK_SIZE, test_time=0,
+                           engine=DDT_DEFAULT_ENGINE, queue_depth=DDT_DEFAULT_QUEUE_DEPTH, direct=True, fused=True,
+                           order=DDT_DEFAULT_ORDER, stride=1, start_block=0, shard=(0, 1), shard_per_device=False,
+                           workers=DDT_DEFAULT_WORKERS, limit_share=1.0, progress=None):
+    # Test the devices concurrently, in one diskdatatest process with <workers> threads per device. All the
+    # devices get the same pattern, so they may be paths to the same LUN. Returns a dict of device to the
+    # results of disk_data_test(), or to the Exception the device failed with. The run gets limit_share of
+    # the rate caps, and feeds the bytes it writes and reads to the progress tracker, if given.
+    # The test_blocks from start_block can be split in shard[1] parts to be tested by separate calls, the
+    # pattern depends only on the sector so each part verifies on its own. With shard_per_device the i-th
+    # device tests part shard[0] + i instead, so paths to the same LUN only verify the blocks they wrote.
+    # Direct IO by default, so the verify pass reads back from the array and not from dom0's page cache
     iter_start = str(random.randint(0, 100000))  # NOSONAR
+    if not fused and test_time:
+        # The verify can only replay where a timed write stopped for a single worker
+        workers = 1
+    engine_opts = ['-e', engine, '-q', str(queue_depth), '-w', str(workers), '-o', str(start_block),
+                   '-k', '%d/%d' % shard]
+    if shard_per_device:
+        engine_opts.append('-P')
+    if direct:
+        engine_opts.append('-d')
+    # 'random' and 'stride' orders are replayed by the verify with the same seed and stride
+    engine_opts += ['-p', order, '-s', str(random.randint(0, 2 ** 32)), '-S', str(stride)]  # NOSONAR
+
+    test_results = {}
+    if fused:
+        # One pass: every block is read back DDT_DEFAULT_VERIFY_LAG blocks after it was written
+        results, telemetry, (bad_map, bad_notes) = \
+            _run_disk_data_test(engine_opts + ['-l', str(DDT_DEFAULT_VERIFY_LAG)], 'writeverify', devices,
+                                sect_of_block, test_blocks, test_time, iter_start, limit_share,
+                                progress)
+        for device in devices:
+            if device not in results:
+                test_results[device] = Exception("Disk test write/verify error!")
+                continue
+            total_blocks, op_blocks, op_elapsed, sector_errors = results[device]
+            if sector_errors != 0:
+                test_results[device] = _bad_sectors_error(device, sector_errors, bad_map.get(device, []),
+                                                          bad_notes.get(device, []))
+            else:
+                # The verify reads overlap the writes, so both phases took the whole pass. The two elapsed
+                # times are the same seconds and do not add up.
+                test_results[device] = (total_blocks, op_blocks, op_elapsed, op_blocks, op_elapsed,
+                                        telemetry.get(device, {}))
+        return test_results
+
+    write_results, telemetry, _ = \
+        _run_disk_data_test(engine_opts, 'write', devices, sect_of_block, test_blocks, test_time, iter_start,
+                            limit_share, progress)
+
+    # Devices that stopped at the same block after a timed write are verified together
+    verify_groups = {}
+    for device in devices:
+        if device not in write_results:
+            test_results[device] = Exception("Disk test write error!")
+        else:
+            verify_groups.setdefault(write_results[device][1], []).append(device)
+
+    for write_blocks, group in verify_groups.items():
+        # Same <mass> as the write so the order is the same, -n stops where a timed write stopped
+        verify_results, verify_telemetry, (bad_map, bad_notes) = \
+            _run_disk_data_test(engine_opts + ['-n', str(write_blocks)], 'verify', group, sect_of_block,
+                                test_blocks, test_time, iter_start, limit_share, progress)
+        for device in group:
+            if device not in verify_results:
+                test_results[device] = Exception("Disk test verify error!")
+                continue
+            total_blocks, _, write_elapsed, _ = write_results[device]
+            _, verify_blocks, verify_elapsed, sector_errors = verify_results[device]
+            if sector_errors != 0:
+                test_results[device] = _bad_sectors_error(device, sector_errors, bad_map.get(device, []),
+                                                          bad_notes.get(device, []))
+            else:
+                device_telemetry = telemetry.get(device, {})
+                device_telemetry.update(verify_telemetry.get(device, {}))
+                test_results[device] = (total_blocks, write_blocks, write_elapsed, verify_blocks, verify_elapsed,
+                                        device_telemetry)
 
-    cmd = [DISKDATATEST, 'write', device, str(sect_of_block), str(test_blocks), str(test_time), iter_start]
-    xencert_print("The command to be fired is: %s" % cmd)
-    (rc, stdout, stderr) = util.doexec(cmd)
-    if rc != 0:
-        raise Exception("Disk test write error!")
+    return test_results
+
+
+def disk_data_test(device, test_blocks, **kwargs):
+    result = disk_data_test_devices([device], test_blocks, **kwargs)[device]
+    if isinstance(result, Exception):
+        raise result
+    return result
 
-    xencert_print("diskdatatest returned : %s" % stdout)
-    last_string = stdout.strip().splitlines()[-1]
-    total_blocks, write_blocks, write_elapsed, _ = last_string.split()
-    total_blocks, write_blocks, write_elapsed = int(total_blocks), int(write_blocks), float(write_elapsed)
 
-    cmd = [DISKDATATEST, 'verify', device, str(sect_of_block), str(write_blocks), str(test_time), iter_start]
+class DiskIOScheduler(object):
+    """Runs the disk IO tests of many LUNs from a pool of threads, with bounded concurrency.
+
+    The paths of a LUN are tested together by one disk_data_test_devices() run, split in several runs if
+    there are more of them than ddt_max_paths_per_lun or ddt_max_paths allow. Each path of a LUN tests its
+    own equal part of it, so a path only verifies blocks it wrote itself. The runs of one LUN never
+    overlap, to keep ddt_max_paths_per_lun paths at most on it. Runs of different LUNs go at once as long as at most
+    ddt_max_paths paths are being tested, and at most ddt_max_paths_per_group through each group, the HBA
+    adapter or iSCSI portal of a path. The rate caps are shared by the runs in proportion to their paths.
+    """
+
+    def __init__(self):
+        self.jobs = []
+        self.results = {}
+        self.elapsed = 0.0
+        self.lock = Condition()
+
+    def add_lun(self, scsi_id, paths, size):
+        """Schedule the paths, a list of (device, group), to the LUN scsi_id for a test of size MB"""
+        # A job is the LUN, its paths tested by one run, the size and the parts of the LUN the paths test:
+        # the first, out of one per path of the LUN
+        job = []
+        groups = {}
+        first = 0
+        for device, group in paths:
+            if len(job) >= ddt_max_paths or (ddt_max_paths_per_lun and len(job) >= ddt_max_paths_per_lun) \
+                    or (ddt_max_paths_per_group and groups.get(group, 0) >= ddt_max_paths_per_group):
+                self.jobs.append((scsi_id, job, size, (first, len(paths))))
+                first += len(job)
+                job = []
+                groups = {}
+            job.append((device, group))
+            groups[group] = groups.get(group, 0) + 1
+        if job:
+            self.jobs.append((scsi_id, job, size, (first, len(paths))))
+
+    def estimate(self, lun_estimates):
+        """Returns the seconds the scheduled tests should take and their margin, from lun_estimates, a dict of
+        SCSI ID to the estimate and margin of find_disk_data_test_estimate() for the whole LUN over one path"""
+        # The paths of a run test their parts at once and the runs of a LUN go one after the other, while
+        # the runs of different LUNs share the ddt_max_paths paths tested at once
+        lun_times = {}
+        lun_margins = {}
+        path_seconds = 0.0
+        for scsi_id, paths, _, (_, parts) in self.jobs:
+            estimate, margin = lun_estimates[scsi_id]
+            lun_times[scsi_id] = lun_times.get(scsi_id, 0.0) + estimate / parts
+            lun_margins[scsi_id] = lun_margins.get(scsi_id, 0.0) + margin / parts
+            path_seconds += len(paths) * estimate / parts
+        if not lun_times or not sum(lun_times.values()):
+            return 0, 0
+        total = max(max(lun_times.values()), path_seconds / ddt_max_paths)
+        # The margins of the LUNs are added up, as their samplings are not independent, and scaled with the
+        # estimate
+        return total, total * sum(lun_margins.values()) / sum(lun_times.values())
+
+    def _fits(self, job, busy_luns, active, active_groups):
+        scsi_id, paths, _, _ = job
+        if scsi_id in busy_luns:
+            return False
+        if active == 0:
+            # Always start a run on its own, whatever the limits
+            return True
+        if active + len(paths) > ddt_max_paths:
+            return False
+        if ddt_max_paths_per_group:
+            for group in set(group for (_, group) in paths):
+                if active_groups.get(group, 0) + len([1 for path in paths if path[1] == group]) \
+                        > ddt_max_paths_per_group:
+                    return False
+        return True
+
+    def _run_job(self, job, limit_share, done, progress):
+        scsi_id, paths, size, shard = job
+        devices = [device for (device, _) in paths]
+        try:
+            results = disk_data_test_devices(devices, get_blocks_num(size), shard=shard, shard_per_device=True,
+                                             limit_share=limit_share, progress=progress)
+        except Exception as e:
+            results = dict((device, e) for device in devices)
+        with self.lock:
+            self.results.update(results)
+            done.append(job)
+            self.lock.notify()
+
+    def run(self):
+        """Run all the scheduled tests, returns a dict of device to the result of disk_data_test_devices()"""
+        total_paths = sum(len(job[1]) for job in self.jobs)
+        # Every block of the LUNs is written and read back, once over all their paths
+        progress = ProgressTracker("Disk IO tests", sum(2 * job[2] * MiB * len(job[1]) / job[3][1]
+                                                        for job in self.jobs))
+        pending = list(self.jobs)
+        done = []
+        busy_luns = set()
+        active = 0
+        active_groups = {}
+        threads = []
+        start = time.time()
+        with self.lock:
+            while True:
+                # Release what the finished runs held
+                while done:
+                    scsi_id, paths, _, _ = done.pop()
+                    busy_luns.discard(scsi_id)
+                    active -= len(paths)
+                    for _, group in paths:
+                        active_groups[group] -= 1
+                if not pending and not active:
+                    break
+                job = next((job for job in pending if self._fits(job, busy_luns, active, active_groups)), None)
+                if job is None:
+                    self.lock.wait()
+                    continue
+                pending.remove(job)
+                busy_luns.add(job[0])
+                active += len(job[1])
+                for _, group in job[1]:
+                    active_groups[group] = active_groups.get(group, 0) + 1
+                xencert_print("Starting the disk IO test of SCSI ID %s on %s, %d paths under test"
+                              % (job[0], [path[0] for path in job[1]], active))
+                limit_share = min(1.0, len(job[1]) / float(min(ddt_max_paths, total_paths)))
+                thread = Thread(target=self._run_job, args=(job, limit_share, done, progress))
+                thread.start()
+                threads.append(thread)
+        for thread in threads:
+            thread.join()
+        progress.finish()
+        self.elapsed = time.time() - start
+        return self.results
+
+    def report(self):
+        """Print the aggregate throughput of the paths that passed"""
+        block_mb = DDT_DEFAULT_BLOCK_SIZE * DDT_SECTOR_SIZE / float(MiB)
+        passed = [result for result in self.results.values() if not isinstance(result, Exception)]
+        tested_mb = sum(result[1] * block_mb for result in passed)
+        if passed and self.elapsed > 0:
+            printout("     Disk IO tests: %d MB written and verified over %d paths in %d seconds, %.1f MB/s aggregate."
+                     % (tested_mb, len(passed), self.elapsed, tested_mb / self.elapsed))
+
+
+def report_disk_data_test_telemetry(telemetry):
+    for op in sorted(telemetry.keys(), reverse=True):
+        printout("          %-5s: %.1f MB/s, %d IOPS, latency p50 %.2f ms, p99 %.2f ms, p99.9 %.2f ms, max %.2f ms"
+                 % (op, telemetry[op]['mbps'], telemetry[op]['iops'], telemetry[op]['p50_us'] / 1000.0,
+                    telemetry[op]['p99_us'] / 1000.0, telemetry[op]['p999_us'] / 1000.0,
+                    telemetry[op]['max_us'] / 1000.0))
+    limits = []
+    if ddt_rate_limit:
+        limits.append("%g MB/s" % ddt_rate_limit)
+    if ddt_iops_limit:
+        limits.append("%g IOPS" % ddt_iops_limit)
+    if telemetry and limits:
+        printout("          rate limited to %s" % " and ".join(limits))
+
+
+def disk_data_test_sweep(device, size, engine=DDT_DEFAULT_ENGINE, queue_depth=DDT_DEFAULT_QUEUE_DEPTH,
+                         workers=DDT_DEFAULT_WORKERS):
+    # Write and read back the first min(size, DDT_SWEEP_SIZE) MB of the device with each block size from 4KB to
+    # 4MB, in bursts of DDT_SWEEP_BURST_TIME seconds. Returns a list with one dict per block size and op, ordered
+    # by block size, with the throughput, IOPS and latency percentiles of the burst.
+    sweep_size = min(size, DDT_SWEEP_SIZE)
+    cmd = [DISKDATATEST, '-d', '-e', engine, '-q', str(queue_depth), '-w', str(workers)] + _disk_data_test_limit_opts()
+    cmd += ['sweep', device, str(DDT_SWEEP_MAX_BLOCK_SIZE),
+            str(int(get_blocks_num(sweep_size, DDT_SWEEP_MAX_BLOCK_SIZE))), str(DDT_SWEEP_BURST_TIME),
+            str(random.randint(0, 100000))]  # NOSONAR
     xencert_print("The command to be fired is: %s" % cmd)
     (rc, stdout, stderr) = util.doexec(cmd)
+    xencert_print("diskdatatest returned %d: %s" % (rc, stdout))
     if rc != 0:
-        raise Exception("Disk test verify error!")
-
-    xencert_print("diskdatatest returned : %s" % stdout)
-    last_string = stdout.strip().splitlines()[-1]
-    _, verify_blocks, verify_elapsed, sector_errors = last_string.split()
-    verify_blocks, verify_elapsed, sector_errors = int(verify_blocks), float(verify_elapsed), int(sector_errors)
+        raise Exception("Block size sweep error on %s: %s" % (device, stderr.strip()))
 
+    # <device> <block_bytes> <write|read> <op_blocks> <op_elapsed> <MB/s> <IOPS> <p50> <p99> <p99.9> <max> <errors>
+    sweep = []
+    for line in stdout.strip().splitlines():
+        fields = line.split()
+        if len(fields) != 12 or fields[0] != device:
+            continue
+        sweep.append({'block_bytes': int(fields[1]), 'op': fields[2], 'blocks': int(fields[3]),
+                      'elapsed': float(fields[4]), 'mbps': float(fields[5]), 'iops': float(fields[6]),
+                      'p50_us': float(fields[7]), 'p99_us': float(fields[8]), 'p999_us': float(fields[9]),
+                      'max_us': float(fields[10]), 'sector_errors': int(fields[11])})
+    sector_errors = sum(point['sector_errors'] for point in sweep)
     if sector_errors != 0:
-        raise Exception("Disk test verify error on %d sectors!", sector_errors)
-
-    return total_blocks, write_blocks, write_elapsed, verify_blocks, verify_elapsed
+        raise Exception("Block size sweep verify error on %d sectors of %s!" % (sector_errors, device))
+    return sweep
+
+
+def report_disk_data_test_sweep(sweep):
+    printout("          %-10s %12s %12s %14s %14s" % ("block size", "write MB/s", "read MB/s", "write p99 ms",
+                                                      "read p99 ms"))
+    points = {}
+    for point in sweep:
+        points.setdefault(point['block_bytes'], {})[point['op']] = point
+    for block_bytes in sorted(points.keys()):
+        write = points[block_bytes].get('write', {})
+        read = points[block_bytes].get('read', {})
+        printout("          %-10s %12.1f %12.1f %14.2f %14.2f"
+                 % ("%dK" % (block_bytes // KiB), write.get('mbps', 0), read.get('mbps', 0),
+                    write.get('p99_us', 0) / 1000.0, read.get('p99_us', 0) / 1000.0))
+
+
+def disk_data_test_discard(device, region_size):
+    # For each granularity, write region_size MB of the device then discard it one range of the granularity at
+    # a time, each granularity in its own region after the previous one. Returns a list with one dict per
+    # granularity: the discard throughput, IOPS and latency percentiles, and the seconds the discarded space
+    # took to read back as zeros, -1 if it did not within DDT_DISCARD_SETTLE_TIME.
+    region_blocks = int(get_blocks_num(region_size, DDT_DISCARD_GRANULARITIES[-1]))
+    if region_blocks == 0:
+        raise Exception("%s is too small for the discard tests." % device)
+
+    discards = []
+    for i, granularity in enumerate(DDT_DISCARD_GRANULARITIES):
+        # Fill the region first, so there is allocated space to reclaim
+        blocks = region_blocks * DDT_DISCARD_GRANULARITIES[-1] // granularity
+        engine_opts = ['-d', '-e', DDT_DEFAULT_ENGINE, '-q', str(DDT_DEFAULT_QUEUE_DEPTH), '-o', str(i * blocks)]
+        results, _, _ = _run_disk_data_test(engine_opts, 'write', [device], granularity, blocks, 0,
+                                            str(random.randint(0, 100000)))  # NOSONAR
+        if device not in results:
+            raise Exception("Could not write %s before discarding it." % device)
+
+        cmd = [DISKDATATEST, '-d', '-o', str(i * blocks), 'discard', device, str(granularity), str(blocks),
+               str(DDT_DISCARD_SETTLE_TIME), '0']
+        xencert_print("The command to be fired is: %s" % cmd)
+        (rc, stdout, stderr) = util.doexec(cmd)
+        xencert_print("diskdatatest returned %d: %s" % (rc, stdout))
+        if rc != 0:
+            raise Exception("Discard error on %s: %s" % (device, stderr.strip()))
+
+        # <block_bytes> discard <op_blocks> <op_elapsed> <MB/s> <IOPS> <p50> <p99> <p99.9> <max> <zeroed_s>
+        fields = stdout.strip().splitlines()[-1].split()
+        discards.append({'block_bytes': int(fields[0]), 'blocks': int(fields[2]), 'elapsed': float(fields[3]),
+                         'mbps': float(fields[4]), 'iops': float(fields[5]), 'p50_us': float(fields[6]),
+                         'p99_us': float(fields[7]), 'p999_us': float(fields[8]), 'max_us': float(fields[9]),
+                         'zeroed': float(fields[10])})
+    return discards
+
+
+def report_disk_data_test_discard(discards):
+    printout("          %-11s %12s %12s %14s %14s %16s" % ("granularity", "MB/s", "discards/s", "p99 ms", "max ms",
+                                                          "reads as zeros"))
+    for discard in discards:
+        if discard['zeroed'] < 0:
+            zeroed = "not in %ds" % DDT_DISCARD_SETTLE_TIME
+        else:
+            zeroed = "after %.3fs" % discard['zeroed']
+        printout("          %-11s %12.1f %12.1f %14.2f %14.2f %16s"
+                 % ("%dK" % (discard['block_bytes'] // KiB), discard['mbps'], discard['iops'],
+                    discard['p99_us'] / 1000.0, discard['max_us'] / 1000.0, zeroed))
 
 
 def get_blocks_num(size, sect_of_block=DDT_DEFAULT_BLOCK_SIZE):
     return size * MiB / (sect_of_block * DDT_SECTOR_SIZE)
 
 
-def find_disk_data_test_estimate(device, size):
-    # Run diskdatatest in a report mode
-    xencert_print("Run diskdatatest in a report mode with device %s to find the estimated time." % device)
+def _load_throughput_cache():
+    try:
+        with open(DDT_THROUGHPUT_CACHE) as f:
+            cache = json.load(f)
+        if isinstance(cache, dict):
+            return cache
+    except (IOError, OSError, ValueError) as e:
+        xencert_print("No usable throughput cache %s: %s" % (DDT_THROUGHPUT_CACHE, str(e)))
+    return {}
+
+
+def _save_throughput_cache(cache):
+    # Written to a temporary file and renamed, so an interrupted run never leaves a truncated cache
+    try:
+        os.makedirs(os.path.dirname(DDT_THROUGHPUT_CACHE), exist_ok=True)
+        tmp = DDT_THROUGHPUT_CACHE + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(cache, f, indent=2, sort_keys=True)
+        os.rename(tmp, DDT_THROUGHPUT_CACHE)
+    except (IOError, OSError) as e:
+        xencert_print("Failed to save the throughput cache %s: %s" % (DDT_THROUGHPUT_CACHE, str(e)))
+
+
+def _throughput_cache_keys(scsi_id):
+    # The throughput of a LUN is cached under its SCSI ID, and under its vendor and model for the other LUNs
+    # of the same array that have not been measured yet
+    keys = []
+    if scsi_id:
+        keys.append(('scsi', scsi_id))
+        (retval, config_map) = get_config(scsi_id)
+        if retval and config_map.get('ID_VENDOR'):
+            keys.append(('model', "%s/%s" % (config_map['ID_VENDOR'], config_map.get('ID_MODEL', ''))))
+    return keys
+
+
+def sample_disk_data_test_rate(device, size):
+    # Write and verify a little of the size MB of the device at DDT_SAMPLE_POINTS offsets spread across it, the
+    # same way the disk IO test does. Returns the mean seconds per MB and the half width of its 95% confidence
+    # interval, from the spread between the offsets.
+    block_mb = DDT_DEFAULT_BLOCK_SIZE * DDT_SECTOR_SIZE / float(MiB)
+    total_blocks = int(get_blocks_num(size))
+    sample_blocks = max(1, min(int(get_blocks_num(DDT_SAMPLE_SIZE)), total_blocks // DDT_SAMPLE_POINTS))
+    samples = []
+    for i in range(DDT_SAMPLE_POINTS):
+        start_block = (total_blocks - sample_blocks) * i // (DDT_SAMPLE_POINTS - 1)
+        _, blocks, elapsed, _, _, _ = disk_data_test(device, sample_blocks, start_block=start_block,
+                                                     test_time=DDT_SAMPLE_TIME)
+        xencert_print("Sampled %d blocks of device %s from block %d in %.3f seconds"
+                      % (blocks, device, start_block, elapsed))
+        if blocks:
+            samples.append(elapsed / (blocks * block_mb))
+    if not samples:
+        raise Exception("No block of device %s could be sampled" % device)
+
+    mean = statistics.mean(samples)
+    if len(samples) < 2:
+        return mean, mean
+    return mean, DDT_T_95[min(len(samples) - 1, max(DDT_T_95))] * statistics.stdev(samples) / math.sqrt(len(samples))
+
+
+def _usable_throughput_entry(entry, now):
+    # An entry written by an older or interrupted run may lack fields, it is then a cache miss
+    if not isinstance(entry, dict):
+        return False
+    if not all(isinstance(entry.get(field), (int, float)) for field in ('sec_per_mb', 'margin', 'time')):
+        return False
+    return 0 <= now - entry['time'] < DDT_THROUGHPUT_MAX_AGE
+
+
+def _find_disk_data_test_rate(device, size, scsi_id):
+    if scsi_id in ddt_sampled_rates:
+        return ddt_sampled_rates[scsi_id]
+
+    keys = [] if ddt_rate_limit or ddt_iops_limit else _throughput_cache_keys(scsi_id)
+    cache = _load_throughput_cache() if keys else {}
+    now = time.time()
+    for (kind, key) in keys:
+        entries = cache.get(kind)
+        entry = entries.get(key) if isinstance(entries, dict) else None
+        if _usable_throughput_entry(entry, now):
+            xencert_print("Using the throughput of %s %s measured %d hours ago for device %s"
+                          % (kind, key, (now - entry['time']) / 3600, device))
+            rate = (entry['sec_per_mb'], entry['margin'])
+            break
+    else:
+        xencert_print("Sample device %s to find the estimated time." % device)
+        rate = sample_disk_data_test_rate(device, size)
+        entry = {'sec_per_mb': rate[0], 'margin': rate[1], 'time': now}
+        for (kind, key) in keys:
+            if not isinstance(cache.get(kind), dict):
+                cache[kind] = {}
+            cache[kind][key] = entry
+        if keys:
+            _save_throughput_cache(cache)
 
-    total_blocks, write_blocks, write_elapsed, verify_blocks, verify_elapsed = \
-        disk_data_test(device, get_blocks_num(size), test_time=15)
+    if scsi_id:
+        ddt_sampled_rates[scsi_id] = rate
+    return rate
 
-    estimated_time = total_blocks * (write_elapsed / write_blocks + verify_elapsed / verify_blocks)
 
-    xencert_print("Total estimated time for testing IO with the device %s as %d" % (device, estimated_time))
-    return estimated_time
+def find_disk_data_test_estimate(device, size, scsi_id=None):
+    # Estimate how long the disk IO test of size MB of the device takes. The rate is sampled once per LUN, or
+    # taken from the cache of an earlier run, and measurements taken while the IO is rate limited are neither
+    # cached nor reused by other runs. Returns the estimated seconds and the half width of their 95% confidence
+    # interval.
+    sec_per_mb, margin = _find_disk_data_test_rate(device, size, scsi_id)
+    estimated_time = size * sec_per_mb
+
+    xencert_print("Total estimated time for testing IO with the device %s as %d +/- %d"
+                  % (device, estimated_time, size * margin))
+    return estimated_time, size * margin
+
+
+def format_estimate_confidence(estimated_time, margin):
+    # Suffix of the APPROXIMATE RUN TIME line
+    if not estimated_time:
+        return ''
+    return " (95%% confidence: %d to %d seconds)" % (max(0, estimated_time - margin), estimated_time + margin)
 
 
 def _find_lun(svid):
@@ -949,27 +1848,177 @@ def _find_lun(svid):
         return [device]
 
 
-def write_data_to_vdi(session, vbd_ref, start_sec, end_sec):
+def _vdi_pattern_seed(session, vbd_ref):
+    # Each VDI gets its own pattern, so data left on the storage by another one never verifies
+    return zlib.crc32(session.xenapi.VDI.get_uuid(session.xenapi.VBD.get_VDI(vbd_ref)).encode())
+
+
+def _new_vdi_pattern_buffer(seed):
+    # The first two 64 bit words of each 512 byte sector hold its byte offset in the VDI and the seed. The
+    # seed is the same in every chunk, _fill_vdi_pattern() only updates the offsets.
+    buf = bytearray(VDI_PATTERN_FILL * (VDI_CHUNK_SIZE // len(VDI_PATTERN_FILL)))
+    words = memoryview(buf).cast('Q')
+    words[1::64] = array('Q', [seed]) * (len(words) // 64)
+    return buf, words
+
+
+def _fill_vdi_pattern(words, offset):
+    words[0::64] = array('Q', range(offset, offset + len(words) // 64 * 512, 512))
+
+
+def _read_direct(fd, view, offset):
+    # Fill view, page aligned, from offset of fd opened with O_DIRECT
+    got = 0
+    while got < len(view):
+        n = os.preadv(fd, [view[got:]], offset + got)
+        if not n:
+            raise Exception('unexpected end of device at %d' % (offset + got))
+        got += n
+
+
+def _vdi_block_digest(data):
+    return hashlib.blake2b(data, digest_size=VDI_DIGEST_SIZE).digest()
+
+
+def _record_vdi_digests(manifest, buf, offset):
+    # The manifest is a flat bytearray, the digest of block n at n * VDI_DIGEST_SIZE
+    first = offset // VDI_MANIFEST_BLOCK * VDI_DIGEST_SIZE
+    end = first + len(buf) // VDI_MANIFEST_BLOCK * VDI_DIGEST_SIZE
+    if len(manifest) < end:
+        manifest.extend(bytes(end - len(manifest)))
+    with memoryview(buf) as view:
+        for i in range(0, len(buf), VDI_MANIFEST_BLOCK):
+            pos = first + i // VDI_MANIFEST_BLOCK * VDI_DIGEST_SIZE
+            manifest[pos:pos + VDI_DIGEST_SIZE] = _vdi_block_digest(view[i:i + VDI_MANIFEST_BLOCK])
+
+
+def _verify_vdi_digests(device, manifest, offset, end, errors, progress):
+    # Worker of verify_vdi_manifest(): re-hash [offset, end) of device and record the first bad block in errors.
+    # The reads bypass the page cache, which still holds what write_data_to_vdi() wrote.
+    buf = mmap.mmap(-1, VDI_CHUNK_SIZE)
+    view = memoryview(buf)
+    fd = -1
+    try:
+        fd = os.open(device, os.O_RDONLY | os.O_DIRECT)
+        while offset < end:
+            size = min(VDI_CHUNK_SIZE, end - offset)
+            _read_direct(fd, view[:size], offset)
+            for i in range(0, size, VDI_MANIFEST_BLOCK):
+                pos = (offset + i) // VDI_MANIFEST_BLOCK * VDI_DIGEST_SIZE
+                if _vdi_block_digest(view[i:i + VDI_MANIFEST_BLOCK]) != manifest[pos:pos + VDI_DIGEST_SIZE]:
+                    raise Exception('digest mismatch in the %d MiB block at byte %d' \
+                                    % (VDI_MANIFEST_BLOCK // MiB, offset + i))
+            offset += size
+            progress.add(size)
+    except Exception as e:
+        errors.append((offset, str(e)))
+    finally:
+        if fd != -1:
+            os.close(fd)
+        view.release()
+        buf.close()
+
+
+def verify_vdi_manifest(device, manifest, start, end, workers=VDI_VERIFY_WORKERS):
+    # Re-hash the bytes [start, end) of device in parallel threads, which is where hashlib drops the GIL,
+    # and compare them to the manifest recorded by write_data_to_vdi(). Raises on the first bad block.
+    if end > len(manifest) // VDI_DIGEST_SIZE * VDI_MANIFEST_BLOCK:
+        raise Exception('the manifest only covers %d bytes, not %d' \
+                        % (len(manifest) // VDI_DIGEST_SIZE * VDI_MANIFEST_BLOCK, end))
+    # There are only digests of whole blocks, so a partial block at either end cannot be verified
+    if start % VDI_MANIFEST_BLOCK or end % VDI_MANIFEST_BLOCK or end < start:
+        raise Exception('cannot verify bytes %d to %d against the digests of whole %d MiB blocks' \
+                        % (start, end, VDI_MANIFEST_BLOCK // MiB))
+    blocks = (end - start) // VDI_MANIFEST_BLOCK
+    if not blocks:
+        return
+    per_worker = -(-blocks // workers)
+    errors = []
+    threads = []
+    progress = ProgressTracker("Verified", end - start)
+    for first in range(0, blocks, per_worker):
+        last = min(first + per_worker, blocks)
+        t = Thread(target=_verify_vdi_digests,
+                   args=(device, manifest, start + first * VDI_MANIFEST_BLOCK, start + last * VDI_MANIFEST_BLOCK,
+                         errors, progress))
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    progress.finish()
+    if errors:
+        raise Exception(min(errors)[1])
+
+
+def write_data_to_vdi(session, vbd_ref, start_sec, end_sec, manifest=None):
+    # Write the pattern over every byte of the GiB "sectors" start_sec to end_sec of the VDI, in chunks of
+    # VDI_CHUNK_SIZE from one reused buffer. Returns the bytes written and the seconds it took. If manifest
+    # is a bytearray, the digest of every VDI_MANIFEST_BLOCK written is recorded in it.
     xencert_print('write_data_to_vdi(vbd_ref=%s, start_sec=%s, end_sec=%s, ->Enter)' \
                   % (vbd_ref, start_sec, end_sec))
     try:
         device = os.path.join(dev_path, session.xenapi.VBD.get_device(vbd_ref))
+        seed = _vdi_pattern_seed(session, vbd_ref)
 
         xencert_print('about to write onto device: %s' % device)
 
-        with open(device, 'wb') as f:
-            while start_sec <= end_sec:
-                f.seek(start_sec * SECTOR_SIZE)
-                f.write(BUF_PATTERN)
-                start_sec += 1
+        buf, words = _new_vdi_pattern_buffer(seed)
+        start = time.perf_counter()
+        offset = start_sec * SECTOR_SIZE
+        end = (end_sec + 1) * SECTOR_SIZE
+        progress = ProgressTracker("Written", end - offset)
+        try:
+            with open(device, 'r+b', buffering=0) as f:
+                f.seek(offset)
+                while offset < end:
+                    _fill_vdi_pattern(words, offset)
+                    written = f.write(buf)
+                    if written != len(buf):
+                        raise Exception('short write of %s bytes at %d' % (written, offset))
+                    if manifest is not None:
+                        _record_vdi_digests(manifest, buf, offset)
+                    progress.add(written)
+                    offset += written
+                os.fsync(f.fileno())
+        finally:
+            progress.finish()
+        elapsed = time.perf_counter() - start
     except Exception as e:
         raise Exception('Writing data into VDI:%s Failed. Error: %s' \
                         % (vbd_ref, e))
 
     xencert_print('write_data_to_vdi() -> Exit')
+    return end - start_sec * SECTOR_SIZE, elapsed
 
 
-def verify_data_on_vdi(session, vbd_ref, start_sec, end_sec):
+def _verify_vdi_pattern(device, seed, offset, end):
+    # Compare [offset, end) of device, chunk by chunk, to the pattern regenerated in one reused buffer. The
+    # reads bypass the page cache, which still holds what write_data_to_vdi() wrote.
+    expect, words = _new_vdi_pattern_buffer(seed)
+    actual = mmap.mmap(-1, VDI_CHUNK_SIZE)
+    progress = ProgressTracker("Verified", end - offset)
+    fd = os.open(device, os.O_RDONLY | os.O_DIRECT)
+    try:
+        with memoryview(actual) as actual_view:
+            while offset < end:
+                _read_direct(fd, actual_view, offset)
+                _fill_vdi_pattern(words, offset)
+                if expect != actual:
+                    bad = next(i for i in range(VDI_CHUNK_SIZE) if actual[i] != expect[i])
+                    raise Exception('expected:%s != actual:%s at byte %d' \
+                                    % (bytes(expect[bad:bad + 16]), bytes(actual[bad:bad + 16]), offset + bad))
+                offset += VDI_CHUNK_SIZE
+                progress.add(VDI_CHUNK_SIZE)
+    finally:
+        os.close(fd)
+        actual.close()
+        progress.finish()
+
+
+def verify_data_on_vdi(session, vbd_ref, start_sec, end_sec, manifest=None):
+    # Read back and check every byte of the GiB "sectors" start_sec to end_sec of the VDI, as written by
+    # write_data_to_vdi(). With the manifest it recorded, the VDI is re-hashed in parallel instead of being
+    # compared to a regenerated pattern. Returns the bytes read and the seconds it took.
     xencert_print('verify_data_on_vdi(vdi_ref=%s, start_sec=%s, end_sec=%s ->Enter)' \
                   % (vbd_ref, start_sec, end_sec))
     try:
@@ -977,18 +2026,17 @@ def verify_data_on_vdi(session, vbd_ref, start_sec, end_sec):
 
         xencert_print('about to read from device: %s' % device)
 
-        expect = BUF_PATTERN
-
-        with open(device, 'rb') as f:
-            while start_sec <= end_sec:
-                f.seek(start_sec * SECTOR_SIZE)
-                actual = f.read(len(expect))
-                if actual != expect:
-                    raise Exception('expected:%s != actual:%s' \
-                                    % (expect, actual))
-                start_sec += 1
+        start = time.perf_counter()
+        offset = start_sec * SECTOR_SIZE
+        end = (end_sec + 1) * SECTOR_SIZE
+        if manifest is not None:
+            verify_vdi_manifest(device, manifest, offset, end)
+        else:
+            _verify_vdi_pattern(device, _vdi_pattern_seed(session, vbd_ref), offset, end)
+        elapsed = time.perf_counter() - start
     except Exception as e:
         raise Exception('Verification of data in VDI:%s Failed. Error:%s' \
                         % (vbd_ref, e))
 
     xencert_print('verify_data_on_vdi() -> Exit')
+    return end - start_sec * SECTOR_SIZE, elapsed
@@ -0,0 +1,80 @@
+# Copyright (c) 2005-2022 Citrix Systems Inc.
+# Copyright (c) 2022-2023 Cloud Software Group, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Timed writes of zeros to a device, in process, with the time of each chunk"""
+import os
+import mmap
+import time
+from array import array
+from collections import namedtuple
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024  # bytes written by one pwritev
+
+# bytes written, elapsed seconds and the latency of each chunk in nanoseconds
+TimedWriteResult = namedtuple('TimedWriteResult', ['bytes', 'elapsed', 'latencies'])
+
+
+class TimedWriter(object):
+    """Writes zeros to a device from one preallocated buffer, timing every chunk.
+
+    The buffer is mmap'ed, so it is page aligned and satisfies O_DIRECT on 512e and 4Kn devices. With
+    direct=True the offsets and sizes must be multiples of the device's logical block size.
+    """
+
+    def __init__(self, path, chunk_size=DEFAULT_CHUNK_SIZE, direct=True):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.buf = mmap.mmap(-1, chunk_size)
+        try:
+            self.fd = os.open(path, os.O_WRONLY | (os.O_DIRECT if direct else 0))
+        except Exception:
+            self.buf.close()
+            raise
+
+    def write(self, size, offset=0, progress=None):
+        """Write size bytes from offset, returns a TimedWriteResult. progress is called with the bytes of each
+        chunk written, if given"""
+        latencies = array('Q')
+        done = 0
+        start = time.perf_counter_ns()
+        with memoryview(self.buf) as view:
+            while done < size:
+                chunk = min(self.chunk_size, size - done)
+                submit = time.perf_counter_ns()
+                written = os.pwritev(self.fd, [view[:chunk]], offset + done)
+                latencies.append(time.perf_counter_ns() - submit)
+                if written <= 0:
+                    raise Exception("Short write of %s at %d" % (self.path, offset + done))
+                done += written
+                if progress:
+                    progress(written)
+        return TimedWriteResult(done, (time.perf_counter_ns() - start) / 1e9, latencies)
+
+    def close(self):
+        os.close(self.fd)
+        self.buf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def timed_write(path, size, offset=0, chunk_size=DEFAULT_CHUNK_SIZE, direct=True, progress=None):
+    """Write size bytes of zeros to path from offset, returns a TimedWriteResult"""
+    with TimedWriter(path, chunk_size, direct) as writer:
+        return writer.write(size, offset, progress)
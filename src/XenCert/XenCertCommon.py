@@ -62,6 +62,8 @@ __common__ = [
     ["pool", "perform pool verification tests",                         " : ", None, "optional", "-o", ""],
     ["data", "perform data verification tests",                         " : ", None, "optional", "-d", ""],
     ["metadata", "perform metadata tests",                              " : ", None, "optional", "-M", ""],
+    ["blocksizesweep", "sweep the block size from 4KB to 4MB on each LUN during the functional tests",
+                                                                        " : ", None, "optional", "-B", ""],
     ["help",    "show this help message and exit",                                  " : ", None,        "optional", "-h", "" ]]
 
 __commonparams__ = [
@@ -73,6 +75,16 @@ __commonparams__ = [
     ["count", "count of iterations to perform in case of multipathing failover testing",
                                                                                     " : ", None, "optional", "-g", ""]]
 
+__diskioparams__ = [
+    ["ratelimit", "cap the throughput of the disk IO tests in MB/s, for arrays that also serve live pools",
+                                                                                    " : ", None, "optional", "-R", ""],
+    ["iopslimit", "cap the disk IO tests in IOs per second",                       " : ", None, "optional", "-I", ""],
+    ["iopaths", "number of paths the iSCSI and HBA disk IO tests run at once, 8 by default",
+                                                                                    " : ", None, "optional", "-J", ""],
+    ["iopathsperlun", "number of paths to one LUN tested at once, all by default", " : ", None, "optional", "-L", ""],
+    ["iopathspergroup", "number of paths through one HBA adapter or iSCSI portal tested at once, no limit by default",
+                                                                                    " : ", None, "optional", "-P", ""]]
+
 def parse_args(version_string):
     """Parses the command line arguments"""
     
@@ -102,7 +114,7 @@ def parse_args(version_string):
                        help=element[1],
                        dest=element[0])
 
-    for element in __commonparams__:
+    for element in __commonparams__ + __diskioparams__:
         opt.add_option(element[5], element[6],
                        default=element[3],
                        help=element[1],
@@ -121,6 +133,7 @@ def store_configuration(g_storage_conf, options):
     """Stores the command line arguments in a class"""
 
     g_storage_conf["storage_type"] = options.storage_type
+    g_storage_conf["blocksizesweep"] = options.blocksizesweep
     try:
         g_storage_conf["slavehostname"] = options.slavehostname
     except:
@@ -132,7 +145,7 @@ def valid_arguments(options, g_storage_conf):
         printout("Error: storage type (hba, nfs, cifs, or iscsi) is required")
         return 0
 
-    for element in __commonparams__:
+    for element in __commonparams__ + __diskioparams__:
         if not getattr(options, element[0]):
             if element[4] == "required":
                 printout("Error: %s argument (%s: %s) for storage type %s" \
@@ -196,6 +209,10 @@ def display_test_specific_options():
     printout("Multipathing test options (-m above):\n")
     for item in __commonparams__:
         print_help_item(item)
+    printout("")
+    printout("Disk IO test options (-f above):\n")
+    for item in __diskioparams__:
+        print_help_item(item)
 
 def display_storage_specific_usage(storage_type):
     if storage_type == 'iscsi':
@@ -18,6 +18,9 @@
 import util
 import re
 import time
+import socket
+import struct
+import threading
 
 
 class MPathCLIFail(Exception):
@@ -28,13 +31,102 @@ class MPathCLIFail(Exception):
         print("", "MPath CLI failed")
 
 mpathcmd = ["/usr/sbin/multipathd", "-k"]
+MULTIPATHD_SOCKET = "\0/org/kernel/linux/storage/multipathd"  # abstract unix socket of the multipathd cli
+SOCKET_TIMEOUT = 60  # seconds for multipathd to answer one command
+PACKET_LEN = struct.Struct("N")  # packets are prefixed with their length as a native size_t
+
+
+class MultipathdClient(object):
+    """Sends commands to multipathd over its unix socket, as "multipathd -k" does.
+
+    One connection is kept open and reused by all the commands, and reopened once if multipathd closed it.
+    The replies are the raw output of the commands, without the prompts of "multipathd -k".
+    """
+
+    def __init__(self, address=MULTIPATHD_SOCKET, timeout=SOCKET_TIMEOUT):
+        self.address = address
+        self.timeout = timeout
+        self.sock = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.address)
+        except Exception:
+            sock.close()
+            raise
+        self.sock = sock
+
+    def _recv_all(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise EOFError("multipathd closed the connection")
+            data += chunk
+        return data
+
+    def _exchange(self, cmd):
+        payload = cmd.encode("utf-8") + b"\0"
+        self.sock.sendall(PACKET_LEN.pack(len(payload)) + payload)
+        (size,) = PACKET_LEN.unpack(self._recv_all(PACKET_LEN.size))
+        return self._recv_all(size).rstrip(b"\0").decode("utf-8", "replace")
+
+    def command(self, cmd):
+        """Run cmd in multipathd, returns its output"""
+        with self.lock:
+            for attempt in (1, 2):
+                try:
+                    if self.sock is None:
+                        self._connect()
+                    return self._exchange(cmd)
+                except (EOFError, socket.error):
+                    self.close_locked()
+                    if attempt == 2:
+                        raise
+
+    def close_locked(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def close(self):
+        with self.lock:
+            self.close_locked()
+
+
+client = MultipathdClient()
+
+
+def _fork_command(cmd):
+    # Run cmd through "multipathd -k", and strip its prompts and the echo of the command from the output
+    (rc, stdout, stderr) = util.doexec(mpathcmd, cmd)
+    prompt = "multipathd> "
+    if stdout.endswith(prompt):
+        stdout = stdout[:-len(prompt)]
+    if stdout.startswith(prompt):
+        stdout = stdout[len(prompt):]
+    if stdout.startswith(cmd + "\n"):
+        stdout = stdout[len(cmd) + 1:]
+    return stdout
+
+
+def command(cmd):
+    """Run cmd in multipathd over its socket, or through "multipathd -k" if the socket cannot be used"""
+    util.SMlog("mpath cmd: %s" % cmd)
+    try:
+        output = client.command(cmd)
+    except (EOFError, socket.error) as e:
+        util.SMlog("multipathd socket failed: %s, forking multipathd -k instead" % str(e))
+        output = _fork_command(cmd)
+    util.SMlog("mpath output: %s" % output)
+    return output
 
 
 def mpexec(cmd):
-    util.SMlog("mpath cmd: %s" % cmd)
-    (rc, stdout, stderr) = util.doexec(mpathcmd, cmd)
-    if stdout != "multipathd> ok\nmultipathd> " \
-            and stdout != "multipathd> " + cmd + "\nok\nmultipathd> ":
+    if command(cmd).strip() != "ok":
         raise MPathCLIFail
 
 
@@ -47,15 +139,13 @@ def resize_map(m):
 
 
 regex = re.compile("[0-9]+:[0-9]+:[0-9]+:[0-9]+\s*([a-z]*)")
-regex2 = re.compile("multipathd>(\s*[^:]*:)?\s+(.*)")
 regex3 = re.compile("switchgroup")
 
 
 def is_working():
     cmd = "help"
     try:
-        (rc, stdout, stderr) = util.doexec(mpathcmd, cmd)
-        m = regex3.search(stdout)
+        m = regex3.search(command(cmd))
         if m:
             return True
         else:
@@ -65,14 +155,7 @@ def is_working():
 
 
 def do_get_topology(cmd):
-    util.SMlog("mpath cmd: %s" % cmd)
-    (rc, stdout, stderr) = util.doexec(mpathcmd, cmd)
-    util.SMlog("mpath output: %s" % stdout)
-    lines = stdout.split('\n')[:-1]
-    if len(lines):
-        m = regex2.search(lines[0])
-        lines[0] = str(m.group(2))
-    return lines
+    return command(cmd).splitlines()
 
 
 def get_topology(scsi_id):
@@ -91,11 +174,8 @@ def list_paths(scsi_id):
 
 
 def list_maps():
-    cmd = "list maps"
-    util.SMlog("mpath cmd: %s" % cmd)
-    (rc, stdout, stderr) = util.doexec(mpathcmd, cmd)
-    util.SMlog("mpath output: %s" % stdout)
-    return [x.split(' ')[0] for x in stdout.split('\n')[2:-1]]
+    # The first line is the "name sysfs uuid" header
+    return [x.split(' ')[0] for x in command("list maps").splitlines()[1:]]
 
 
 def ensure_map_gone(scsi_id):
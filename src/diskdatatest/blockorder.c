@@ -0,0 +1,93 @@
+/*
+ * XenRT: Block visiting orders for diskdatatest.
+ *
+ * The random order is a full-period linear congruential generator
+ * modulo the power of two m >= n: with c odd and a = 1 mod 4 it visits
+ * every value in [0, m) once per period (Hull-Dobell). Values >= n are
+ * skipped, which costs less than one extra step per block on average
+ * since m < 2n. No index table is needed whatever the device size.
+ *
+ * Copyright (c) 2007 XenSource, Inc. All use and distribution of this
+ * copyrighted material is governed by and subject to terms and
+ * conditions as licensed by XenSource, Inc. All other rights reserved.
+ *
+ */
+
+#include <string.h>
+#include "blockorder.h"
+
+bool block_order_type(const char *name, enum block_order_type *type)
+{
+    if (!strcmp(name, "seq"))
+        *type = ORDER_SEQ;
+    else if (!strcmp(name, "random"))
+        *type = ORDER_RANDOM;
+    else if (!strcmp(name, "stride"))
+        *type = ORDER_STRIDE;
+    else
+        return false;
+    return true;
+}
+
+/* splitmix64, spreads a small seed over all 64 bits */
+static unsigned long long mix_seed(unsigned long long *s)
+{
+    unsigned long long z = (*s += 0x9e3779b97f4a7c15ULL);
+
+    z = (z ^ (z >> 30)) * 0xbf58476d1ce4e5b9ULL;
+    z = (z ^ (z >> 27)) * 0x94d049bb133111ebULL;
+    return z ^ (z >> 31);
+}
+
+void block_order_init(struct block_order *o, enum block_order_type type,
+                      unsigned long long n, unsigned long long seed,
+                      unsigned long long stride)
+{
+    memset(o, 0, sizeof(*o));
+    o->type = type;
+    o->n = n;
+    o->stride = stride ? stride : 1;
+
+    if (type == ORDER_RANDOM) {
+        o->m = 1;
+        while (o->m < n)
+            o->m <<= 1;
+        o->a = (mix_seed(&seed) << 2 | 1) & (o->m - 1);
+        if (o->a == 1 && o->m > 4)
+            o->a = 5;   // keep the walk from degenerating into x + c
+        o->c = (mix_seed(&seed) | 1) & (o->m - 1);
+        o->x = mix_seed(&seed) & (o->m - 1);
+    }
+}
+
+static unsigned long long stride_block(const struct block_order *o, unsigned long long i)
+{
+    /*
+     * Residue classes r = 0 .. stride-1 are walked one after the other.
+     * The first n % stride classes hold one block more than the others.
+     */
+    unsigned long long q = o->n / o->stride, rem = o->n % o->stride;
+    unsigned long long big = rem * (q + 1);
+
+    if (i < big)
+        return i / (q + 1) + (i % (q + 1)) * o->stride;
+    i -= big;
+    return rem + i / q + (i % q) * o->stride;
+}
+
+unsigned long long block_order_next(struct block_order *o)
+{
+    unsigned long long i = o->pos++;
+
+    switch (o->type) {
+    case ORDER_RANDOM:
+        do {
+            o->x = (o->a * o->x + o->c) & (o->m - 1);
+        } while (o->x >= o->n);
+        return o->x;
+    case ORDER_STRIDE:
+        return stride_block(o, i);
+    default:
+        return i;
+    }
+}
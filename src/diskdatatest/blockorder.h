@@ -0,0 +1,42 @@
+/*
+ * XenRT: Block visiting orders for diskdatatest. An order walks every
+ * block index in [0, n) exactly once, so a run can be verified by
+ * walking the same order again with the same parameters.
+ *
+ * Copyright (c) 2007 XenSource, Inc. All use and distribution of this
+ * copyrighted material is governed by and subject to terms and
+ * conditions as licensed by XenSource, Inc. All other rights reserved.
+ *
+ */
+
+#ifndef _BLOCKORDER_H
+#define _BLOCKORDER_H
+
+#include <stdbool.h>
+
+enum block_order_type {
+    ORDER_SEQ,          // 0, 1, 2, ...
+    ORDER_RANDOM,       // seeded permutation
+    ORDER_STRIDE,       // 0, S, 2S, ..., then 1, 1+S, ...
+};
+
+struct block_order {
+    enum block_order_type type;
+    unsigned long long    n;        // blocks in the order
+    unsigned long long    pos;      // blocks handed out so far
+
+    /* ORDER_STRIDE */
+    unsigned long long    stride;
+
+    /* ORDER_RANDOM: x = (a * x + c) mod m, m the power of two above n */
+    unsigned long long    m, a, c, x;
+};
+
+bool block_order_type(const char *name, enum block_order_type *type);
+void block_order_init(struct block_order *o, enum block_order_type type,
+                      unsigned long long n, unsigned long long seed,
+                      unsigned long long stride);
+/* Next block index, must be called at most n times. */
+unsigned long long block_order_next(struct block_order *o);
+
+#endif
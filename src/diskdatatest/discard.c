@@ -0,0 +1,106 @@
+/*
+ * XenRT: Discard benchmark for diskdatatest.
+ *
+ * The discards are synchronous and issued one at a time, so each one
+ * is timed on its own and the throughput is what the device achieves
+ * at the given granularity. Reading discarded blocks back as zeros is
+ * only guaranteed by devices that report LBPRZ, the others may never
+ * settle and are reported as such.
+ *
+ * Copyright (c) 2007 XenSource, Inc. All use and distribution of this
+ * copyrighted material is governed by and subject to terms and
+ * conditions as licensed by XenSource, Inc. All other rights reserved.
+ *
+ */
+
+#ifndef _GNU_SOURCE
+  #define _GNU_SOURCE
+#endif
+#include <errno.h>
+#include <fcntl.h>
+#include <stdbool.h>
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+#include <unistd.h>
+#include <sys/ioctl.h>
+#include <sys/stat.h>
+#include <linux/fs.h>
+#include "discard.h"
+
+#define DISCARD_SAMPLES         64          // blocks read back by discard_settle()
+#define DISCARD_SAMPLE_SIZE     4096        // bytes read at the start of each of them
+#define DISCARD_POLL_NS         10000000ULL // 10ms between two rounds of reads
+#define DISCARD_ALIGNMENT       4096        // satisfies O_DIRECT on 512e and 4Kn devices
+
+static int discard_range(int fd, bool blkdev, unsigned long long off, unsigned long long len)
+{
+    uint64_t range[2] = {off, len};
+
+    if (blkdev)
+        return ioctl(fd, BLKDISCARD, &range) ? -errno : 0;
+    return fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, off, len) ? -errno : 0;
+}
+
+long long discard_run(int fd, unsigned long long first_blk, unsigned long long nblocks,
+                      size_t block_size, unsigned long long max_time, struct telemetry *t,
+                      double *elapsed)
+{
+    unsigned long long blk, start_ns, submit_ns, now;
+    struct stat st;
+    int ret;
+
+    if (fstat(fd, &st))
+        return -errno;
+
+    start_ns = telemetry_now();
+    for (blk = 0; blk < nblocks; blk++) {
+        submit_ns = telemetry_now();
+        if (max_time && submit_ns - start_ns >= max_time * 1000000000ULL)
+            break;
+        ret = discard_range(fd, S_ISBLK(st.st_mode), (first_blk + blk) * block_size, block_size);
+        if (ret)
+            return ret;
+        now = telemetry_now();
+        telemetry_record(t, TELEMETRY_DISCARD, block_size, now - submit_ns);
+        telemetry_tick(t, now);
+    }
+    *elapsed = (telemetry_now() - start_ns) / 1e9;
+    return blk;
+}
+
+static bool all_zero(const char *buf, size_t len)
+{
+    return buf[0] == 0 && !memcmp(buf, buf + 1, len - 1);
+}
+
+double discard_settle(int fd, unsigned long long first_blk, unsigned long long nblocks,
+                      size_t block_size, unsigned long long max_time)
+{
+    struct timespec poll = {0, DISCARD_POLL_NS};
+    unsigned long long start_ns, i, step, blk;
+    size_t len = block_size < DISCARD_SAMPLE_SIZE ? block_size : DISCARD_SAMPLE_SIZE;
+    bool zeroed = false;
+    char *buf;
+
+    if (nblocks == 0 || posix_memalign((void **)&buf, DISCARD_ALIGNMENT, len))
+        return -1;
+
+    step = nblocks > DISCARD_SAMPLES ? nblocks / DISCARD_SAMPLES : 1;
+    start_ns = telemetry_now();
+    do {
+        zeroed = true;
+        for (i = 0; i < nblocks && zeroed; i += step) {
+            blk = first_blk + i;
+            if (pread(fd, buf, len, blk * block_size) != (ssize_t)len || !all_zero(buf, len))
+                zeroed = false;
+        }
+        if (zeroed)
+            break;
+        nanosleep(&poll, NULL);
+    } while (telemetry_now() - start_ns < max_time * 1000000000ULL);
+
+    free(buf);
+    return zeroed ? (telemetry_now() - start_ns) / 1e9 : -1;
+}
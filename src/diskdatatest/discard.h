@@ -0,0 +1,37 @@
+/*
+ * XenRT: Discard benchmark for diskdatatest. Blocks are discarded one
+ * at a time with BLKDISCARD (or a punched hole in a regular file) and
+ * every discard is timed, then the discarded blocks are read until the
+ * device returns zeros for them, to time how long the space takes to
+ * show as freed.
+ *
+ * Copyright (c) 2007 XenSource, Inc. All use and distribution of this
+ * copyrighted material is governed by and subject to terms and
+ * conditions as licensed by XenSource, Inc. All other rights reserved.
+ *
+ */
+
+#ifndef _DISCARD_H
+#define _DISCARD_H
+
+#include <stddef.h>
+#include "telemetry.h"
+
+/*
+ * Discard the blocks [first_blk, first_blk + nblocks) of fd, for at most
+ * max_time seconds (0 means no limit). Each discard is recorded in t as
+ * TELEMETRY_DISCARD. Returns the number of blocks discarded, with the
+ * time it took in *elapsed, or -errno.
+ */
+long long discard_run(int fd, unsigned long long first_blk, unsigned long long nblocks,
+                      size_t block_size, unsigned long long max_time, struct telemetry *t,
+                      double *elapsed);
+
+/*
+ * Seconds until a sample of the first nblocks discarded blocks all read
+ * back as zeros, or -1 if they did not within max_time seconds.
+ */
+double discard_settle(int fd, unsigned long long first_blk, unsigned long long nblocks,
+                      size_t block_size, unsigned long long max_time);
+
+#endif
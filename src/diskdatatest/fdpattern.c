@@ -27,7 +27,12 @@
 #include <string.h>
 #include <time.h>
 #include <sys/time.h>
-#include "atomicio.h"
+#include <pthread.h>
+#include "ioengine.h"
+#include "telemetry.h"
+#include "blockorder.h"
+#include "throttle.h"
+#include "discard.h"
 
 /* This tool is able to write test pattern to disk and verify it.
  * One sector, 512 bytes, is split to mutiple slices. And there 
@@ -56,35 +61,145 @@ struct sector_slice {
 #define DEFAULT_SECTOR_SIZE 512
 #define SECTOR_SHIFT 9
 #define HEADERS_OF_SECTION (DEFAULT_SECTOR_SIZE / sizeof(struct sector_slice))
+#define BUFFER_ALIGNMENT 4096  // satisfies O_DIRECT on 512e and 4Kn devices
 
 unsigned long long sects_of_block = 0;  // input: sector count of one block
 unsigned long long max_blocks = 0;      // input: max blocks to write/read
 unsigned long long max_time = 0;        // input: max time to test, in second
 unsigned long long total_sects = 0;     // total secters
 unsigned long long block_size = 0;      // block size in bytes
-char *block_buf = NULL;                 // buffer of one block to each write/read
-struct fd_state state = {0};            // device size info
+const char *engine_name = "sync";       // input: IO engine
+unsigned queue_depth = 1;               // input: max blocks in flight
+bool direct_io = false;                 // input: bypass the page cache with O_DIRECT
+unsigned long long verify_lag = 64;     // input: blocks written before 'writeverify' reads one back
+const char *telemetry_file = NULL;      // input: JSON lines telemetry output
+FILE *telemetry_out = NULL;             // telemetry output shared by the devices
+unsigned long telemetry_interval = 1000; // input: telemetry interval, in milliseconds
+enum block_order_type order_type = ORDER_SEQ; // input: block visiting order
+unsigned long long order_seed = 0;      // input: seed of the random order
+unsigned long long order_stride = 1;    // input: stride of the stride order, in blocks
+unsigned long long op_count = 0;        // input: blocks of each worker's order to test, 0 means all
+unsigned long long start_block = 0;     // input: first block to test
+unsigned long long shard_index = 0;     // input: part of <mass> tested by this process ...
+unsigned long long shard_count = 1;     // input: ... out of shard_count equal parts
+bool shard_per_device = false;          // input: the i-th device tests part shard_index + i
+unsigned workers = 1;                   // input: threads per device
+const char *bad_map_file = NULL;        // input: bad sector range map output
+double rate_mbps = 0;                   // input: MB/s cap of the whole run, 0 means none
+double rate_iops = 0;                   // input: IOPS cap of the whole run, 0 means none
+struct throttle throttle;               // shared by all the workers
+const char *op_name = NULL;             // input: op
+const char *devices = NULL;             // input: comma separated device files
 
-unsigned long long sect = 0;            // current sector in writing/reading
-unsigned long long iter = 0;            // input: current iterater for sector_slice(s)
-unsigned long long sect_errors = 0;     // total verify errors of sectors
+unsigned long long iter = 0;            // input: initial value of iterator for sector_slice(s)
+
+enum test_op {
+    OP_WRITE,
+    OP_VERIFY,
+    OP_WRITEVERIFY,     // write, and read back each block <lag> blocks later
+    OP_SWEEP,           // timed write and verify bursts at each block size
+    OP_DISCARD,         // timed discard of every block
+};
+
+#define SWEEP_MIN_SECTS 8               // 4 KiB
+#define DISCARD_SETTLE_TIME 60          // seconds 'discard' waits for zeros when <time> is 0
+
+/* A run of consecutive bad sectors, with what the first one should and did hold */
+struct bad_range {
+    unsigned long long start;           // first sector
+    unsigned long long count;           // number of sectors
+    struct sector_slice expected;
+    struct sector_slice found;
+};
+
+#define BAD_RANGES_MAX (1 << 16)        // per worker, further ranges are only counted
+
+/* One range of blocks of a device under test, each runs in its own thread */
+struct test_worker {
+    const char         *device;
+    enum test_op        op;
+    unsigned long long  first_blk;      // first block of the range
+    unsigned long long  nblocks;        // blocks in the range
+    unsigned long long  limit;          // blocks of the order to test, 0 means all
+    struct telemetry   *telemetry;      // shared by the workers of a device
+    struct fd_state     state;          // device size info
+    char               *block_bufs;     // one buffer per in-flight block write/read
+    char               *expect_buf;     // the pattern a verified block should hold
+    unsigned long long  op_blocks;      // total blocks op-ed in practice
+    double              op_elapsed;     // total elapsed time in practice
+    unsigned long long  sect_errors;    // total verify errors of sectors
+    struct bad_range   *bad_ranges;     // sorted by start, when bad_map_file is set
+    unsigned long       nbad_ranges;
+    bool                bad_truncated;  // more than BAD_RANGES_MAX ranges
+    int                 ret;
+    pthread_t           thread;
+};
 
 
 void usage(const char *cmd)
 {
-    fprintf(stderr, "usage: %s <op> <device> <block> <mass> <time> <iter>\n"
-            "  op:     'write' or 'verify' test\n"
-            "  device: device file\n"
+    fprintf(stderr, "usage: %s [-d] [-e engine] [-q depth] [-l lag] [-T file] [-I interval]\n"
+            "       [-p order] [-s seed] [-S stride] [-n count] [-o start] [-k index/count] [-P]\n"
+            "       [-w workers] [-m mapfile] [-r MB/s] [-R IOPS] <op> <device>[,<device>...] <block> <mass> <time> <iter>\n"
+            "  op:     'write', 'verify', 'writeverify', 'sweep' or 'discard' test\n"
+            "          'writeverify' writes the pattern and reads every block back\n"
+            "          in the same pass, <lag> blocks behind the writes\n"
+            "          'sweep' writes then verifies for <time> seconds at each block size\n"
+            "          from 4 KiB up to <block>, within the first <mass> * <block> sectors\n"
+            "          'discard' discards the <mass> blocks of a single device one by one,\n"
+            "          then reads them until they read as zeros, for <time> seconds each\n"
+            "  device: device file, or a comma separated list of device files tested\n"
+            "          concurrently, one thread per device\n"
             "  block:  number of sectors for one block, greater than 0. Note: one sector size is 512 bytes\n"
             "  mass:   max number of blocks for test, greater than 0\n"
             "  time:   max elapsed time to test, in seconds, 0 means unlimit\n"
             "  iter:   initial value for iterator\n"
             "\n"
+            "options:\n"
+            "  -d:        direct IO, open <device> with O_DIRECT so that verify reads come\n"
+            "             from the device instead of the page cache\n"
+            "  -e engine: IO engine, 'sync' (default), 'aio', 'uring' or 'auto'\n"
+            "             'auto' tries io_uring, then native AIO, then sync IO\n"
+            "  -q depth:  number of blocks kept in flight by 'aio'/'uring', 1 to %d (default 1)\n"
+            "  -l lag:    number of blocks written before 'writeverify' reads a block back (default 64)\n"
+            "  -T file:   write JSON lines telemetry to <file>: per interval and op the bytes,\n"
+            "             MB/s, IOPS and p50/p99/p99.9/max latency in us, then a summary per op\n"
+            "  -I interval: telemetry interval in milliseconds (default 1000)\n"
+            "  -p order:  block order, 'seq' (default), 'random' or 'stride'. Verify with the\n"
+            "             same <order>, <seed>, <stride> and <mass> as the write\n"
+            "  -s seed:   seed of the 'random' order, a permutation of the <mass> blocks\n"
+            "  -S stride: distance between blocks of the 'stride' order, in blocks (default 1)\n"
+            "  -n count:  test only the first <count> blocks of the order of each worker, used\n"
+            "             to verify a write that was stopped by <time> (default all)\n"
+            "  -o start:  first block to test, the <mass> blocks from <start> are tested\n"
+            "  -k index/count: test only part <index> (from 0) of <count> equal parts of the\n"
+            "             <mass> blocks. The pattern only depends on the sector and <iter>,\n"
+            "             so each part can be written and verified on its own\n"
+            "  -P:        the devices test consecutive parts, the first part <index> and\n"
+            "             the next devices the next parts, so paths to the same LUN each\n"
+            "             only verify the blocks they wrote\n"
+            "  -w workers: threads per device, each tests an equal part of the blocks\n"
+            "             (default 1)\n"
+            "  -m mapfile: write the ranges of bad sectors found by the verify to <mapfile>,\n"
+            "             one line per range of consecutive sectors:\n"
+            "             <device> <start> <count> <expected sect> <expected iter> <found sect> <found iter>\n"
+            "             where expected and found are the first unmatched slice of the first sector\n"
+            "  -r MB/s:   cap the throughput of the whole run, all devices and workers together\n"
+            "  -R IOPS:   cap the block IOs per second of the whole run\n"
+            "\n"
             "return 0 when op executed successfully and output numbers:\n"
-            "  max_blocks:  same to input <block>\n"
+            "  max_blocks:  same to input <mass>\n"
             "  op_blocks:   total number of blocks op-ed in practice\n"
             "  op_elapsed:  total elapsed time in practice\n"
             "  sect_errors: number of sectors with verify error\n"
+            "with several devices there is one line per device that passed, starting with\n"
+            "the device file, and 1 is returned if any device failed\n"
+            "'sweep' outputs one line per device, block size and op ('write' or 'read'):\n"
+            "  <device> <block_bytes> <op> <op_blocks> <op_elapsed> <MB/s> <IOPS> <p50_us> <p99_us>\n"
+            "  <p999_us> <max_us> <sect_errors>\n"
+            "'discard' outputs one line, <zeroed_s> is -1 if the blocks did not read as zeros:\n"
+            "  <block_bytes> discard <op_blocks> <op_elapsed> <MB/s> <IOPS> <p50_us> <p99_us>\n"
+            "  <p999_us> <max_us> <zeroed_s>\n"
             "\n"
             "examples:\n"
             "  # diskdatatest write /dev/sdb 512 1228956 15 1000\n"
@@ -95,23 +210,142 @@ void usage(const char *cmd)
             "  # diskdatatest write /dev/sdb 512 1228956 0 2000\n"
             "  1228956 1228956 3109.534673 0\n"
             "  # diskdatatest verify /dev/sdb 512 1228956 0 2000\n"
-            "  1228956 1228956 2462.567301 0\n",
-            cmd);
+            "  1228956 1228956 2462.567301 0\n"
+            "\n"
+            "  # diskdatatest -e auto -q 32 write /dev/sdb 512 1228956 0 2000\n"
+            "  1228956 1228956 402.118807 0\n"
+            "  # diskdatatest -e auto -q 32 writeverify /dev/sdb 512 1228956 0 3000\n"
+            "  1228956 1228956 611.904316 0\n"
+            "\n"
+            "  # diskdatatest -d -e auto -q 32 sweep /dev/sdb 8192 512 5 4000\n"
+            "  /dev/sdb 4096 write 286402 5.000017 223.75 57280.2 421.9 1163.3 2818.0 5123.4 0\n"
+            "  /dev/sdb 4096 read 286402 3.120534 358.52 91780.6 294.9 860.2 1966.1 3011.6 0\n"
+            "  ...\n"
+            "\n"
+            "  # diskdatatest -d discard /dev/sdb 2048 1024 0 0\n"
+            "  1048576 discard 1024 2.531190 404.55 404.6 2211.8 5767.2 9961.5 9961.5 0.012\n",
+            cmd, IOENGINE_MAX_DEPTH);
 }
 
 void init_params(int argc, char *argv[])
 {
+    int opt;
+
+    while ((opt = getopt(argc, argv, "de:q:l:T:I:p:s:S:n:o:k:Pw:m:r:R:")) != -1) {
+        switch (opt) {
+        case 'd':
+            direct_io = true;
+            break;
+        case 'e':
+            engine_name = optarg;
+            if (!ioengine_valid_name(engine_name)) {
+                fprintf(stderr, "Unknown engine %s\n", engine_name);
+                usage(argv[0]);
+                exit(1);
+            }
+            break;
+        case 'q':
+            queue_depth = strtoul(optarg, NULL, 10);
+            if (queue_depth < 1 || queue_depth > IOENGINE_MAX_DEPTH) {
+                fprintf(stderr, "<depth> is incorrect\n");
+                usage(argv[0]);
+                exit(1);
+            }
+            break;
+        case 'l':
+            verify_lag = strtoull(optarg, NULL, 10);
+            break;
+        case 'T':
+            telemetry_file = optarg;
+            break;
+        case 'I':
+            telemetry_interval = strtoul(optarg, NULL, 10);
+            if (telemetry_interval < 1) {
+                fprintf(stderr, "<interval> is incorrect\n");
+                usage(argv[0]);
+                exit(1);
+            }
+            break;
+        case 'p':
+            if (!block_order_type(optarg, &order_type)) {
+                fprintf(stderr, "Unknown order %s\n", optarg);
+                usage(argv[0]);
+                exit(1);
+            }
+            break;
+        case 's':
+            order_seed = strtoull(optarg, NULL, 10);
+            break;
+        case 'S':
+            order_stride = strtoull(optarg, NULL, 10);
+            if (order_stride < 1) {
+                fprintf(stderr, "<stride> is incorrect\n");
+                usage(argv[0]);
+                exit(1);
+            }
+            break;
+        case 'n':
+            op_count = strtoull(optarg, NULL, 10);
+            break;
+        case 'o':
+            start_block = strtoull(optarg, NULL, 10);
+            break;
+        case 'k':
+            if (sscanf(optarg, "%llu/%llu", &shard_index, &shard_count) != 2 ||
+                shard_count < 1 || shard_index >= shard_count) {
+                fprintf(stderr, "<index/count> is incorrect\n");
+                usage(argv[0]);
+                exit(1);
+            }
+            break;
+        case 'P':
+            shard_per_device = true;
+            break;
+        case 'm':
+            bad_map_file = optarg;
+            break;
+        case 'r':
+        case 'R':
+            if (opt == 'r')
+                rate_mbps = strtod(optarg, NULL);
+            else
+                rate_iops = strtod(optarg, NULL);
+            if (rate_mbps < 0 || rate_iops < 0) {
+                fprintf(stderr, "<%s> is incorrect\n", opt == 'r' ? "MB/s" : "IOPS");
+                usage(argv[0]);
+                exit(1);
+            }
+            break;
+        case 'w':
+            workers = strtoul(optarg, NULL, 10);
+            if (workers < 1) {
+                fprintf(stderr, "<workers> is incorrect\n");
+                usage(argv[0]);
+                exit(1);
+            }
+            break;
+        default:
+            usage(argv[0]);
+            exit(1);
+        }
+    }
+    argc -= optind - 1;
+    argv += optind - 1;
+
     if (argc != 7) {
         fprintf(stderr, "Parameter count is incorrect\n");
         usage(argv[0]);
         exit(1);
     }
-    if (strcmp(argv[1], "write") && strcmp(argv[1], "verify")) {
+    if (strcmp(argv[1], "write") && strcmp(argv[1], "verify") && strcmp(argv[1], "writeverify") &&
+        strcmp(argv[1], "sweep") && strcmp(argv[1], "discard")) {
         fprintf(stderr, "Unknown <op>\n");
         usage(argv[0]);
         exit(1);
     }
     
+    op_name         = argv[1];
+    devices         = argv[2];
     sects_of_block  = strtoull(argv[3], NULL, 10);
     max_blocks      = strtoull(argv[4], NULL, 10);
     max_time        = strtoull(argv[5], NULL, 10);
@@ -126,90 +360,176 @@ void init_params(int argc, char *argv[])
         usage(argv[0]);
         exit(1);
     }
+    if (!strcmp(op_name, "sweep") && (sects_of_block < SWEEP_MIN_SECTS || max_time == 0)) {
+        fprintf(stderr, "'sweep' needs <block> of at least %d sectors and a <time>\n", SWEEP_MIN_SECTS);
+        usage(argv[0]);
+        exit(1);
+    }
+    if (!strcmp(op_name, "discard") && strchr(devices, ',')) {
+        fprintf(stderr, "'%s' takes a single <device>\n", op_name);
+        usage(argv[0]);
+        exit(1);
+    }
     
     block_size = sects_of_block * DEFAULT_SECTOR_SIZE;
-    total_sects = max_blocks * sects_of_block;
+    total_sects = (start_block + max_blocks) * sects_of_block;
 }
 
-void alloc_block_buf()
+void alloc_block_buf(struct test_worker *t)
 {
-    block_buf = malloc(block_size);
-    if (!block_buf) 
+    if (posix_memalign((void **)&t->block_bufs, BUFFER_ALIGNMENT, block_size * queue_depth))
+        t->block_bufs = NULL;
+    if (posix_memalign((void **)&t->expect_buf, BUFFER_ALIGNMENT, block_size))
+        t->expect_buf = NULL;
+    if (!t->block_bufs || !t->expect_buf) 
     {
         fprintf(stderr, "Malloc block buffer failed\n");
         exit(1);
     }
 }
 
-void free_block_buf()
+void free_block_buf(struct test_worker *t)
 {
-    if (block_buf)
-        free(block_buf);
-    block_buf = NULL;
+    if (t->block_bufs)
+        free(t->block_bufs);
+    if (t->expect_buf)
+        free(t->expect_buf);
+    if (t->bad_ranges)
+        free(t->bad_ranges);
+    t->block_bufs = NULL;
+    t->expect_buf = NULL;
+    t->bad_ranges = NULL;
 }
 
-static inline void update_sect(char *sect_buf)
+/*
+ * The pattern of a block depends only on its index: sector ids count up
+ * from 0 at the start of the device and the iterator counts up over the
+ * slices of the entire disk, starting at <iter>. So blocks can be written
+ * and verified in any order.
+ */
+static inline unsigned long long block_first_iter(unsigned long long blk)
 {
-    struct sector_slice *hdr = NULL;
-    unsigned long long i = 0;
-    for (; i < HEADERS_OF_SECTION; i++) {
-        hdr = (struct sector_slice *)sect_buf + i;
-        hdr->sect = sect;
-        hdr->iter = iter++;
+    return iter + blk * sects_of_block * HEADERS_OF_SECTION;
+}
+
+/*
+ * Fill a whole block with its pattern. The inner loop has a constant trip
+ * count and no branches, so the compiler unrolls and vectorizes it.
+ */
+static inline void fill_block(char *block_buf, unsigned long long blk)
+{
+    struct sector_slice *restrict hdr = (struct sector_slice *)block_buf;
+    unsigned long long sect = blk * sects_of_block;
+    unsigned long long sect_iter = block_first_iter(blk);
+    unsigned long long i, j;
+    for (i = 0; i < sects_of_block; i++, sect++, hdr += HEADERS_OF_SECTION) {
+        for (j = 0; j < HEADERS_OF_SECTION; j++) {
+            hdr[j].sect = sect;
+            hdr[j].iter = sect_iter + j;
+        }
+        sect_iter += HEADERS_OF_SECTION;
     }
 }
 
-static inline void update_block()
+static inline void log_progress(const char *action, unsigned long long blk)
 {
-    unsigned long long i = 0;
-    for (; i < sects_of_block; i++) {
-        update_sect(block_buf + i*DEFAULT_SECTOR_SIZE);
-        
-        if (!(sect % (512*1024*1024/DEFAULT_SECTOR_SIZE))) // logging per 512MB
-        {
-            printf("Writing sector %llx of %llx\n", sect, total_sects);
+    const unsigned long long log_sects = 512*1024*1024/DEFAULT_SECTOR_SIZE; // logging per 512MB
+    unsigned long long sect = blk * sects_of_block;
+    unsigned long long end = sect + sects_of_block;
+    for (sect = (sect + log_sects - 1) / log_sects * log_sects; sect < end; sect += log_sects)
+        printf("%s sector %llx of %llx\n", action, sect, total_sects);
+}
+
+static inline void update_block(char *block_buf, unsigned long long blk)
+{
+    fill_block(block_buf, blk);
+    log_progress("Writing", blk);
+}
+
+static void record_bad_sect(struct test_worker *t, unsigned long long sect,
+                            const struct sector_slice *expected,
+                            const struct sector_slice *found)
+{
+    struct bad_range *last = t->nbad_ranges ? &t->bad_ranges[t->nbad_ranges - 1] : NULL;
+
+    if (!bad_map_file)
+        return;
+    if (last && last->start + last->count == sect) {
+        last->count++;
+        return;
+    }
+    if (t->nbad_ranges == BAD_RANGES_MAX) {
+        t->bad_truncated = true;
+        return;
+    }
+    if (!t->bad_ranges) {
+        t->bad_ranges = malloc(BAD_RANGES_MAX * sizeof(struct bad_range));
+        if (!t->bad_ranges) {
+            t->bad_truncated = true;
+            return;
         }
-        sect++;
     }
+    last = &t->bad_ranges[t->nbad_ranges++];
+    last->start = sect;
+    last->count = 1;
+    last->expected = *expected;
+    last->found = *found;
 }
 
-static inline void verify_sect(const char *sect_buf)
+static inline void verify_sect(struct test_worker *t, const char *sect_buf,
+                               unsigned long long sect, unsigned long long sect_iter)
 {
     const struct sector_slice *hdr = NULL;
-    bool sect_error = false;
+    const struct sector_slice *bad_hdr = NULL;
+    struct sector_slice bad_expected = {0};
     unsigned long long i = 0;
     for (; i < HEADERS_OF_SECTION; i++) {
         hdr = (const struct sector_slice *)sect_buf + i;
+        if (hdr->sect != sect || hdr->iter != sect_iter) {
+            if (!bad_hdr) {
+                bad_hdr = hdr;
+                bad_expected.sect = sect;
+                bad_expected.iter = sect_iter;
+            }
+        }
         if (hdr->sect != sect) {
-            sect_error = true;
-            if (sect_errors < 5) {     // only logging first 5 details
+            if (t->sect_errors < 5) {  // only logging first 5 details
                 fprintf(stderr, "Unmatched sector %llu for %llu:\n", hdr->sect, sect);
             }
         }
-        if (hdr->iter != iter) {
-            sect_error = true;
-            if (sect_errors < 5) {     // only logging first 5 details
-                fprintf(stderr, "Unmatched iter %llu for %llu:\n", hdr->iter, iter);
+        if (hdr->iter != sect_iter) {
+            if (t->sect_errors < 5) {  // only logging first 5 details
+                fprintf(stderr, "Unmatched iter %llu for %llu:\n", hdr->iter, sect_iter);
             }
         }
-        iter++;
+        sect_iter++;
     }
     
-    if (sect_error)
-        sect_errors++;
+    if (bad_hdr) {
+        t->sect_errors++;
+        record_bad_sect(t, sect, &bad_expected, bad_hdr);
+    }
 }
 
-static inline void verify_block()
+static inline void verify_block(struct test_worker *t, const char *block_buf,
+                                unsigned long long blk)
 {
+    unsigned long long sect = blk * sects_of_block;
+    unsigned long long sect_iter = block_first_iter(blk);
     unsigned long long i = 0;
-    for (; i < sects_of_block; i++) {
-        verify_sect(block_buf + i*DEFAULT_SECTOR_SIZE);
 
-        if (!(sect % (512*1024*1024/DEFAULT_SECTOR_SIZE))) // logging per 512MB
-        {
-            printf("Verifying sector %llx of %llx\n", sect, total_sects);
-        }
+    log_progress("Verifying", blk);
+    fill_block(t->expect_buf, blk);
+    if (!memcmp(block_buf, t->expect_buf, block_size))
+        return;
+
+    /* Only diagnose the sectors that differ */
+    for (; i < sects_of_block; i++) {
+        if (memcmp(block_buf + i*DEFAULT_SECTOR_SIZE, t->expect_buf + i*DEFAULT_SECTOR_SIZE,
+                   DEFAULT_SECTOR_SIZE))
+            verify_sect(t, block_buf + i*DEFAULT_SECTOR_SIZE, sect, sect_iter);
         sect++;
+        sect_iter += HEADERS_OF_SECTION;
     }
 }
 
@@ -262,14 +582,14 @@ static int getsize(int fd, struct fd_state *s)
     return 0;
 }
 
-bool check_file_size(int fd)
+bool check_file_size(int fd, struct fd_state *state)
 {
     unsigned long long file_blocks = 0;
-    if (getsize(fd, &state) != 0)
+    if (getsize(fd, state) != 0)
         return false;
-    file_blocks = state.size_sects / sects_of_block;
-    if (max_blocks > file_blocks) {
-        fprintf(stderr, "Total blocks to test %llx exceeds file had %llx\n", max_blocks, file_blocks);
+    file_blocks = state->size_sects / sects_of_block;
+    if (start_block + max_blocks > file_blocks) {
+        fprintf(stderr, "Total blocks to test %llx exceeds file had %llx\n", start_block + max_blocks, file_blocks);
         return false;
     }
     return true;
@@ -282,77 +602,554 @@ static inline double get_op_elapsed(const struct timeval *start)
     return (current_time.tv_sec - start->tv_sec) + (current_time.tv_usec - start->tv_usec) / 1000000.0;
 }
 
-int op_testpattern(const char *file, bool op_write)
+/* One block buffer and the block IO it currently holds */
+struct io_slot {
+    char               *buf;
+    unsigned long long  idx;    // position in the block order
+    unsigned long long  blk;
+    int                 io;     // IOENGINE_READ or IOENGINE_WRITE
+    unsigned long long  submit_ns;
+};
+
+int op_testpattern(struct test_worker *t)
 {
+    const char *file = t->device;
+    enum test_op op = t->op;
     int fd = -1;
+    int ret = 0;
     mode_t mode = O_LARGEFILE;
-    unsigned long long pos, len, i, op_blocks;
-    double op_elapsed;
+    unsigned long long next_idx = 0, i, wait_ns;
+    unsigned long long verify_next = 0;   // next order position to read back
+    unsigned long long write_done = 0;    // order positions [0, write_done) are on disk
+    unsigned long long window;            // max writes ahead of write_done
+    bool *written = NULL;                 // completed writes above write_done
     struct timeval start_time;
+    struct block_order write_order, verify_order;
+    struct io_engine engine;
+    unsigned long long count = t->limit && t->limit < t->nblocks ? t->limit : t->nblocks;
+    struct io_slot slots[IOENGINE_MAX_DEPTH];
+    struct io_slot *free_slots[IOENGINE_MAX_DEPTH];
+    struct io_done done[IOENGINE_MAX_DEPTH];
+    unsigned nfree, inflight = 0;
+    bool stop = false, failed = false, writes_finished;
+    int n, j;
     
-    mode |= op_write ? O_RDWR : O_RDONLY;
+    mode |= op == OP_VERIFY ? O_RDONLY : O_RDWR;
+    if (direct_io)
+        mode |= O_DIRECT;
     fd = open(file, mode);
     if (fd == -1) {
         fprintf(stderr, "Unable to open %s, errno %d\n", file, errno);
         return 1;
     }
     
-    if (!check_file_size(fd)) {
+    if (!check_file_size(fd, &t->state)) {
         close(fd);
         return 1;
     }
+
+    if (direct_io && block_size % t->state.sector_size) {
+        fprintf(stderr, "Block size %llu is not a multiple of sector size %lu required by direct IO\n",
+                block_size, t->state.sector_size);
+        close(fd);
+        return 1;
+    }
+
+    if (ioengine_open(&engine, engine_name, fd, queue_depth) != 0) {
+        fprintf(stderr, "Unable to set up %s IO engine, errno %d\n", engine_name, errno);
+        close(fd);
+        return 1;
+    }
+
+    for (i = 0; i < engine.depth; i++) {
+        slots[i].buf = t->block_bufs + i * block_size;
+        free_slots[i] = &slots[i];
+    }
+    nfree = engine.depth;
+
+    window = 2 * engine.depth;
+    written = calloc(window, sizeof(bool));
+    if (!written) {
+        fprintf(stderr, "Malloc write window failed\n");
+        ioengine_close(&engine);
+        close(fd);
+        return 1;
+    }
+    if (op == OP_VERIFY)
+        write_done = count;         // everything was written by an earlier run
+    block_order_init(&write_order, order_type, t->nblocks, order_seed, order_stride);
+    block_order_init(&verify_order, order_type, t->nblocks, order_seed, order_stride);
     
     gettimeofday(&start_time, NULL);
 
-    for(i = 0; i < max_blocks; i++) {
-        pos = i * block_size;
-        if (lseek(fd, pos, SEEK_SET) == (off_t)-1) {
-            fprintf(stderr, "Unable to seek to offset %llx\n", pos);
-            close(fd);
-            return 1;
-        }
+    for (;;) {
+        while (!failed && nfree > 0) {
+            struct io_slot *slot;
+            bool read_ready;
+
+            writes_finished = (stop || next_idx >= count) && write_done == next_idx;
+            if (op == OP_VERIFY)
+                read_ready = !stop && verify_next < count;
+            else
+                read_ready = op == OP_WRITEVERIFY && verify_next < write_done &&
+                             (verify_next + verify_lag < write_done || writes_finished);
+
+            if (!read_ready && (op == OP_VERIFY || stop || next_idx >= count ||
+                                next_idx - write_done >= window))
+                break;
 
-        if (op_write) {
-            update_block();
-            len = atomicio(vwrite, fd, block_buf, block_size);
-            if (len < block_size) {
-                fprintf(stderr, "Write block %llx failed\n", i);
-                close(fd);
-                return 1;
+            if (!throttle_take(&throttle, block_size, &wait_ns)) {
+                if (inflight > 0)
+                    break;      // reap meanwhile, a waiting IO is not timed
+                throttle_sleep(wait_ns);
+                continue;
             }
-        } else {
-            len = atomicio(read, fd, block_buf, block_size);
-            if (len < block_size) {
-                fprintf(stderr, "Read block %llx failed\n", i);
-                close(fd);
-                return 1;
+
+            slot = free_slots[nfree - 1];
+            if (read_ready) {
+                slot->idx = verify_next++;
+                slot->blk = t->first_blk + block_order_next(&verify_order);
+                slot->io = IOENGINE_READ;
+            } else {
+                slot->idx = next_idx++;
+                slot->blk = t->first_blk + block_order_next(&write_order);
+                slot->io = IOENGINE_WRITE;
+                update_block(slot->buf, slot->blk);
             }
-            verify_block();
+
+            slot->submit_ns = telemetry_now();
+            if (ioengine_submit(&engine, slot->io, slot->buf, block_size,
+                                slot->blk * block_size, slot)) {
+                fprintf(stderr, "Unable to queue block %llx\n", slot->blk);
+                failed = true;
+                ret = 1;
+                break;
+            }
+            nfree--;
+            inflight++;
         }
+        if (inflight == 0)
+            break;
 
-        op_blocks = i + 1;
-        op_elapsed = get_op_elapsed(&start_time);
-        if (max_time > 0 && op_elapsed >= max_time)
+        n = ioengine_reap(&engine, 1, done, engine.depth);
+        if (n < 0) {
+            fprintf(stderr, "IO failure: [%d]\n", -n);
+            ret = 1;
             break;
+        }
+
+        for (j = 0; j < n; j++) {
+            struct io_slot *slot = done[j].tag;
+
+            inflight--;
+            free_slots[nfree++] = slot;
+            if (done[j].res != (long long)block_size) {
+                if (done[j].res < 0)
+                    fprintf(stderr, "IO failure: [%lld]\n", -done[j].res);
+                fprintf(stderr, "%s block %llx failed\n",
+                        slot->io == IOENGINE_WRITE ? "Write" : "Read", slot->blk);
+                failed = true;
+                ret = 1;
+                continue;
+            }
+            telemetry_record(t->telemetry, slot->io, block_size, telemetry_now() - slot->submit_ns);
+            if (slot->io == IOENGINE_WRITE) {
+                written[slot->idx % window] = true;
+                while (written[write_done % window]) {
+                    written[write_done % window] = false;
+                    write_done++;
+                }
+                if (op == OP_WRITE)
+                    t->op_blocks++;
+            } else {
+                verify_block(t, slot->buf, slot->blk);
+                t->op_blocks++;
+            }
+        }
+
+        telemetry_tick(t->telemetry, telemetry_now());
+        t->op_elapsed = get_op_elapsed(&start_time);
+        if (max_time > 0 && t->op_elapsed >= max_time)
+            stop = true;
     }
-    
-    printf("%llu %llu %f %llu\n", max_blocks, op_blocks, op_elapsed, sect_errors);
-    
+
+    free(written);
+    ioengine_close(&engine);
     close(fd);
+
+    return ret;
+}
+
+static void *test_worker_thread(void *arg)
+{
+    struct test_worker *t = arg;
+
+    t->ret = op_testpattern(t);
+    return NULL;
+}
+
+
+static int cmp_bad_range(const void *a, const void *b)
+{
+    const struct bad_range *ra = a, *rb = b;
+
+    return ra->start < rb->start ? -1 : ra->start > rb->start;
+}
+
+/*
+ * Write the bad ranges of the workers of one device, sorted and with the
+ * runs that cross from one block to the next merged. Each worker records
+ * its blocks in order, but a random order or several workers interleave them.
+ */
+static void write_bad_map(FILE *out, struct test_worker *tests, unsigned nworkers)
+{
+    struct bad_range *all, *r, *last = NULL;
+    unsigned long n = 0, i;
+    bool truncated = false;
+    unsigned w;
+
+    for (w = 0; w < nworkers; w++) {
+        n += tests[w].nbad_ranges;
+        truncated |= tests[w].bad_truncated;
+    }
+    if (truncated)
+        fprintf(out, "# %s: more than %d bad ranges in a worker, the map is incomplete\n",
+                tests[0].device, BAD_RANGES_MAX);
+    if (n == 0)
+        return;
+
+    all = malloc(n * sizeof(struct bad_range));
+    if (!all) {
+        fprintf(out, "# %s: unable to sort %lu bad ranges\n", tests[0].device, n);
+        return;
+    }
+    for (n = 0, w = 0; w < nworkers; w++) {
+        memcpy(all + n, tests[w].bad_ranges, tests[w].nbad_ranges * sizeof(struct bad_range));
+        n += tests[w].nbad_ranges;
+    }
+    qsort(all, n, sizeof(struct bad_range), cmp_bad_range);
+
+    for (i = 0; i <= n; i++) {
+        r = i < n ? &all[i] : NULL;
+        if (r && last && last->start + last->count == r->start) {
+            last->count += r->count;
+            continue;
+        }
+        if (last)
+            fprintf(out, "%s %llu %llu %llu %llu %llu %llu\n", tests[0].device,
+                    last->start, last->count, last->expected.sect, last->expected.iter,
+                    last->found.sect, last->found.iter);
+        last = r;
+    }
+    free(all);
+}
+
+/* Split this process' part of the blocks of each device, with -P its own part, between its workers */
+static void split_workers(struct test_worker *tests, int ndevs, enum test_op op)
+{
+    unsigned long long shard_first, shard_blocks, part;
+    int i;
+    unsigned w;
+
+    for (i = 0; i < ndevs; i++) {
+        part = shard_per_device ? shard_index + i : shard_index;
+        shard_first = start_block + max_blocks * part / shard_count;
+        shard_blocks = start_block + max_blocks * (part + 1) / shard_count - shard_first;
+        for (w = 0; w < workers; w++) {
+            struct test_worker *t = &tests[i * workers + w];
+
+            t->op = op;
+            t->first_blk = shard_first + shard_blocks * w / workers;
+            t->nblocks = shard_first + shard_blocks * (w + 1) / workers - t->first_blk;
+            t->limit = op_count;
+            t->op_blocks = 0;
+            t->op_elapsed = 0;
+            t->sect_errors = 0;
+            t->ret = 0;
+            free_block_buf(t);
+            alloc_block_buf(t);
+        }
+    }
+}
+
+static void run_workers(struct test_worker *tests, int nworkers)
+{
+    int i;
+
+    if (nworkers == 1) {
+        tests[0].ret = op_testpattern(&tests[0]);
+        return;
+    }
+    for (i = 0; i < nworkers; i++) {
+        if (pthread_create(&tests[i].thread, NULL, test_worker_thread, &tests[i])) {
+            fprintf(stderr, "Unable to start test thread for %s\n", tests[i].device);
+            exit(1);
+        }
+    }
+    for (i = 0; i < nworkers; i++)
+        pthread_join(tests[i].thread, NULL);
+}
+
+/* Totals of the workers of one device, returns false if any failed */
+static bool sum_workers(struct test_worker *tests, unsigned long long *op_blocks,
+                        double *op_elapsed, unsigned long long *sect_errors)
+{
+    bool failed = false;
+    unsigned w;
+
+    *op_blocks = *sect_errors = 0;
+    *op_elapsed = 0;
+    for (w = 0; w < workers; w++) {
+        failed |= tests[w].ret != 0;
+        *op_blocks += tests[w].op_blocks;
+        *sect_errors += tests[w].sect_errors;
+        if (tests[w].op_elapsed > *op_elapsed)
+            *op_elapsed = tests[w].op_elapsed;
+    }
+    return !failed;
+}
+
+static void print_sweep_line(struct test_worker *tests, struct telemetry *telemetry, int io)
+{
+    struct telemetry_summary sum;
+    unsigned long long op_blocks, sect_errors;
+    double op_elapsed;
+
+    sum_workers(tests, &op_blocks, &op_elapsed, &sect_errors);
+    telemetry_summarize(telemetry, io, op_elapsed, &sum);
+    printf("%s %llu %s %llu %f %.2f %.1f %.1f %.1f %.1f %.1f %llu\n", tests[0].device, block_size,
+           io == IOENGINE_WRITE ? "write" : "read", op_blocks, op_elapsed, sum.mbps, sum.iops,
+           sum.p50_us, sum.p99_us, sum.p999_us, sum.max_us, sect_errors);
+}
+
+static int discard(const char *file)
+{
+    struct fd_state state;
+    struct telemetry telemetry;
+    struct telemetry_summary sum;
+    long long done;
+    double elapsed = 0, zeroed;
+    int fd, mode = O_RDWR;
+
+    if (direct_io)
+        mode |= O_DIRECT;
+    fd = open(file, mode);
+    if (fd == -1) {
+        fprintf(stderr, "Unable to open %s, errno %d\n", file, errno);
+        return 1;
+    }
+    if (!check_file_size(fd, &state)) {
+        close(fd);
+        return 1;
+    }
+
+    telemetry_open(&telemetry, telemetry_out, file, telemetry_interval);
+    done = discard_run(fd, start_block, max_blocks, block_size, max_time, &telemetry, &elapsed);
+    if (done < 0) {
+        fprintf(stderr, "Discard of %s failed, errno %lld\n", file, -done);
+        telemetry_close(&telemetry);
+        close(fd);
+        return 1;
+    }
+    telemetry_summarize(&telemetry, TELEMETRY_DISCARD, elapsed, &sum);
+    telemetry_close(&telemetry);
+
+    zeroed = discard_settle(fd, start_block, done, block_size,
+                            max_time ? max_time : DISCARD_SETTLE_TIME);
+    close(fd);
+
+    printf("%llu discard %lld %f %.2f %.1f %.1f %.1f %.1f %.1f %.3f\n", block_size, done, elapsed,
+           sum.mbps, sum.iops, sum.p50_us, sum.p99_us, sum.p999_us, sum.max_us, zeroed);
     return 0;
 }
 
+/*
+ * Timed write then verify bursts at every block size from 4 KiB up to
+ * <block>, over the same area of the devices.
+ */
+static int sweep(struct test_worker *tests, struct telemetry *telemetries, int ndevs)
+{
+    unsigned long long max_sects = sects_of_block;
+    unsigned long long area_sects = max_blocks * sects_of_block;
+    unsigned long long op_blocks, sect_errors;
+    double op_elapsed;
+    bool *write_failed;
+    int ret = 0, i;
+
+    write_failed = calloc(ndevs, sizeof(bool));
+    if (!write_failed) {
+        fprintf(stderr, "Unable to allocate the sweep state\n");
+        return 1;
+    }
+    for (sects_of_block = SWEEP_MIN_SECTS; sects_of_block <= max_sects; sects_of_block *= 2) {
+        block_size = sects_of_block * DEFAULT_SECTOR_SIZE;
+        max_blocks = area_sects / sects_of_block;
+        total_sects = (start_block + max_blocks) * sects_of_block;
+
+        split_workers(tests, ndevs, OP_WRITE);
+        for (i = 0; i < ndevs; i++)
+            telemetry_open(&telemetries[i], telemetry_out, tests[i * workers].device, telemetry_interval);
+        run_workers(tests, ndevs * workers);
+        for (i = 0; i < ndevs; i++) {
+            write_failed[i] = !sum_workers(&tests[i * workers], &op_blocks, &op_elapsed, &sect_errors);
+            if (write_failed[i]) {
+                fprintf(stderr, "Write sweep of %s failed at block size %llu\n", tests[i * workers].device,
+                        block_size);
+                ret = 1;
+            } else {
+                print_sweep_line(&tests[i * workers], &telemetries[i], IOENGINE_WRITE);
+            }
+            telemetry_close(&telemetries[i]);
+        }
+
+        /* Read back what each worker managed to write, on the devices whose writes all succeeded */
+        for (i = 0; i < ndevs * (int)workers; i++) {
+            tests[i].op = OP_VERIFY;
+            tests[i].limit = tests[i].op_blocks;
+            if (tests[i].op_blocks == 0 || write_failed[i / workers])
+                tests[i].nblocks = 0;
+            tests[i].op_blocks = 0;
+        }
+        for (i = 0; i < ndevs; i++)
+            telemetry_open(&telemetries[i], telemetry_out, tests[i * workers].device, telemetry_interval);
+        run_workers(tests, ndevs * workers);
+        for (i = 0; i < ndevs; i++) {
+            if (write_failed[i]) {
+                telemetry_close(&telemetries[i]);
+                continue;
+            }
+            if (sum_workers(&tests[i * workers], &op_blocks, &op_elapsed, &sect_errors)) {
+                print_sweep_line(&tests[i * workers], &telemetries[i], IOENGINE_READ);
+            } else {
+                fprintf(stderr, "Verify sweep of %s failed at block size %llu\n", tests[i * workers].device,
+                        block_size);
+                ret = 1;
+            }
+            telemetry_close(&telemetries[i]);
+        }
+        fflush(stdout);
+    }
+    free(write_failed);
+    return ret;
+}
 
 int main(int argc, char *argv[])
 {
-    int ret;
+    struct test_worker *tests;
+    struct telemetry *telemetries;
+    FILE *bad_map_out = NULL;
+    char *dev_list, *dev, *saveptr = NULL;
+    enum test_op op;
+    unsigned long long op_blocks, sect_errors;
+    double op_elapsed;
+    int ndevs = 0, max_devs, i, ret = 0;
+    unsigned w;
     
     init_params(argc, argv);
-    alloc_block_buf();
 
-    ret = op_testpattern(argv[2], !strcmp(argv[1], "write"));
-    
-    free_block_buf();
+    if (!strcmp(op_name, "write"))
+        op = OP_WRITE;
+    else if (!strcmp(op_name, "verify"))
+        op = OP_VERIFY;
+    else if (!strcmp(op_name, "writeverify"))
+        op = OP_WRITEVERIFY;
+    else if (!strcmp(op_name, "sweep"))
+        op = OP_SWEEP;
+    else
+        op = OP_DISCARD;
+
+    /* This process tests part shard_index of <mass>, split again between the workers */
+    if (workers > max_blocks / shard_count)
+        workers = max_blocks / shard_count ? max_blocks / shard_count : 1;
+
+    dev_list = strdup(devices);
+    max_devs = strlen(devices) / 2 + 1;
+    tests = calloc(max_devs * workers, sizeof(struct test_worker));
+    telemetries = calloc(max_devs, sizeof(struct telemetry));
+    if (!dev_list || !tests || !telemetries) {
+        fprintf(stderr, "Malloc device list failed\n");
+        exit(1);
+    }
+
+    throttle_init(&throttle, rate_mbps, rate_iops, block_size);
+
+    if (telemetry_file) {
+        telemetry_out = fopen(telemetry_file, "w");
+        if (!telemetry_out) {
+            fprintf(stderr, "Unable to open %s, errno %d\n", telemetry_file, errno);
+            exit(1);
+        }
+    }
+
+    for (dev = strtok_r(dev_list, ",", &saveptr); dev; dev = strtok_r(NULL, ",", &saveptr)) {
+        for (w = 0; w < workers; w++) {
+            tests[ndevs * workers + w].device = dev;
+            tests[ndevs * workers + w].telemetry = &telemetries[ndevs];
+        }
+        ndevs++;
+    }
+    if (ndevs == 0) {
+        fprintf(stderr, "<device> is incorrect\n");
+        usage(argv[0]);
+        exit(1);
+    }
+    if (shard_per_device && shard_index + ndevs > shard_count) {
+        fprintf(stderr, "-P needs a part for each of the %d devices\n", ndevs);
+        usage(argv[0]);
+        exit(1);
+    }
+
+    if (op == OP_DISCARD) {
+        ret = discard(devices);
+        goto out;
+    }
+
+    if (op == OP_SWEEP) {
+        ret = sweep(tests, telemetries, ndevs);
+        for (i = 0; i < ndevs * (int)workers; i++)
+            free_block_buf(&tests[i]);
+        goto out;
+    }
+
+    split_workers(tests, ndevs, op);
+    for (i = 0; i < ndevs; i++)
+        telemetry_open(&telemetries[i], telemetry_out, tests[i * workers].device, telemetry_interval);
+    run_workers(tests, ndevs * workers);
+
+    if (bad_map_file) {
+        bad_map_out = fopen(bad_map_file, "w");
+        if (!bad_map_out)
+            fprintf(stderr, "Unable to open %s, errno %d\n", bad_map_file, errno);
+    }
+
+    for (i = 0; i < ndevs; i++) {
+        bool passed = sum_workers(&tests[i * workers], &op_blocks, &op_elapsed, &sect_errors);
+
+        if (bad_map_out)
+            write_bad_map(bad_map_out, &tests[i * workers], workers);
+        for (w = 0; w < workers; w++)
+            free_block_buf(&tests[i * workers + w]);
+        telemetry_close(&telemetries[i]);
+
+        if (!passed) {
+            ret = 1;
+        } else if (ndevs == 1) {
+            printf("%llu %llu %f %llu\n", max_blocks, op_blocks, op_elapsed, sect_errors);
+        } else {
+            printf("%s %llu %llu %f %llu\n", tests[i * workers].device, max_blocks, op_blocks,
+                   op_elapsed, sect_errors);
+        }
+    }
+
+out:
+    throttle_destroy(&throttle);
+    if (telemetry_out)
+        fclose(telemetry_out);
+    if (bad_map_out)
+        fclose(bad_map_out);
+    free(telemetries);
+    free(tests);
+    free(dev_list);
 
     return ret;
 }
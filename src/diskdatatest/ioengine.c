@@ -0,0 +1,408 @@
+/*
+ * XenRT: IO engines for diskdatatest.
+ *
+ * The io_uring and native AIO engines talk to the kernel through raw
+ * system calls so that the tool keeps building and running on hosts
+ * without liburing or libaio installed.
+ *
+ * Copyright (c) 2007 XenSource, Inc. All use and distribution of this
+ * copyrighted material is governed by and subject to terms and
+ * conditions as licensed by XenSource, Inc. All other rights reserved.
+ *
+ */
+
+#ifndef _GNU_SOURCE
+  #define _GNU_SOURCE
+#endif
+#include <errno.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/syscall.h>
+#include <linux/aio_abi.h>
+#include <linux/io_uring.h>
+#include "ioengine.h"
+
+/*
+ * sync: every IO is executed when it is submitted, the completion is
+ * queued and handed back by the next reap.
+ */
+
+struct sync_priv {
+    struct io_done done[IOENGINE_MAX_DEPTH];
+    unsigned       count;
+};
+
+static int sync_setup(struct io_engine *e)
+{
+    e->depth = 1;
+    e->priv = calloc(1, sizeof(struct sync_priv));
+    return e->priv ? 0 : -ENOMEM;
+}
+
+static int sync_submit(struct io_engine *e, int op, void *buf, size_t len,
+                       unsigned long long off, void *tag)
+{
+    struct sync_priv *p = e->priv;
+    char *s = buf;
+    size_t pos = 0;
+    ssize_t res;
+
+    if (p->count >= IOENGINE_MAX_DEPTH)
+        return -EBUSY;
+
+    while (len > pos) {
+        if (op == IOENGINE_WRITE)
+            res = pwrite(e->fd, s + pos, len - pos, off + pos);
+        else
+            res = pread(e->fd, s + pos, len - pos, off + pos);
+        if (res == -1) {
+            if (errno == EINTR || errno == EAGAIN)
+                continue;
+            break;
+        }
+        if (res == 0)
+            break;
+        pos += (size_t)res;
+    }
+
+    p->done[p->count].tag = tag;
+    p->done[p->count].res = (pos == 0 && len > 0) ? -errno : (long long)pos;
+    p->count++;
+    return 0;
+}
+
+static int sync_reap(struct io_engine *e, unsigned min, struct io_done *done,
+                     unsigned max)
+{
+    struct sync_priv *p = e->priv;
+    unsigned n = p->count < max ? p->count : max;
+
+    (void)min;
+    memcpy(done, p->done, n * sizeof(*done));
+    memmove(p->done, p->done + n, (p->count - n) * sizeof(*done));
+    p->count -= n;
+    return n;
+}
+
+static void sync_teardown(struct io_engine *e)
+{
+    free(e->priv);
+}
+
+/*
+ * aio: Linux native AIO, io_submit()/io_getevents().
+ */
+
+struct aio_priv {
+    aio_context_t   ctx;
+    struct iocb     iocbs[IOENGINE_MAX_DEPTH];
+    struct iocb    *queued[IOENGINE_MAX_DEPTH];
+    unsigned        nqueued;
+    unsigned        next;
+    struct io_event events[IOENGINE_MAX_DEPTH];
+};
+
+static int aio_setup(struct io_engine *e)
+{
+    struct aio_priv *p = calloc(1, sizeof(struct aio_priv));
+
+    if (!p)
+        return -ENOMEM;
+    if (syscall(__NR_io_setup, e->depth, &p->ctx) < 0) {
+        free(p);
+        return -errno;
+    }
+    e->priv = p;
+    return 0;
+}
+
+static int aio_submit(struct io_engine *e, int op, void *buf, size_t len,
+                      unsigned long long off, void *tag)
+{
+    struct aio_priv *p = e->priv;
+    struct iocb *cb;
+
+    if (p->nqueued >= e->depth)
+        return -EBUSY;
+
+    cb = &p->iocbs[p->next];
+    p->next = (p->next + 1) % e->depth;
+    memset(cb, 0, sizeof(*cb));
+    cb->aio_data = (unsigned long long)(unsigned long)tag;
+    cb->aio_lio_opcode = op == IOENGINE_WRITE ? IOCB_CMD_PWRITE : IOCB_CMD_PREAD;
+    cb->aio_fildes = e->fd;
+    cb->aio_buf = (unsigned long long)(unsigned long)buf;
+    cb->aio_nbytes = len;
+    cb->aio_offset = off;
+    p->queued[p->nqueued++] = cb;
+    return 0;
+}
+
+static int aio_reap(struct io_engine *e, unsigned min, struct io_done *done,
+                    unsigned max)
+{
+    struct aio_priv *p = e->priv;
+    unsigned i = 0;
+    long n;
+
+    while (i < p->nqueued) {
+        n = syscall(__NR_io_submit, p->ctx, p->nqueued - i, p->queued + i);
+        if (n < 0) {
+            if (errno == EINTR || errno == EAGAIN)
+                continue;
+            return -errno;
+        }
+        i += n;
+    }
+    p->nqueued = 0;
+
+    if (max > IOENGINE_MAX_DEPTH)
+        max = IOENGINE_MAX_DEPTH;
+    do {
+        n = syscall(__NR_io_getevents, p->ctx, min, max, p->events, NULL);
+    } while (n < 0 && errno == EINTR);
+    if (n < 0)
+        return -errno;
+
+    for (i = 0; i < (unsigned)n; i++) {
+        done[i].tag = (void *)(unsigned long)p->events[i].data;
+        done[i].res = p->events[i].res;
+    }
+    return n;
+}
+
+static void aio_teardown(struct io_engine *e)
+{
+    struct aio_priv *p = e->priv;
+
+    syscall(__NR_io_destroy, p->ctx);
+    free(p);
+}
+
+/*
+ * uring: io_uring with IORING_OP_READ/IORING_OP_WRITE (Linux 5.6+).
+ */
+
+struct uring_priv {
+    int                  ring_fd;
+    void                *sq_ptr;
+    void                *cq_ptr;
+    size_t               sq_len;
+    size_t               cq_len;
+    struct io_uring_sqe *sqes;
+    size_t               sqes_len;
+    unsigned            *sq_head;
+    unsigned            *sq_tail;
+    unsigned            *sq_mask;
+    unsigned            *sq_array;
+    unsigned            *cq_head;
+    unsigned            *cq_tail;
+    unsigned            *cq_mask;
+    struct io_uring_cqe *cqes;
+    unsigned             to_submit;
+};
+
+static void uring_unmap(struct uring_priv *p)
+{
+    if (p->sqes && p->sqes != MAP_FAILED)
+        munmap(p->sqes, p->sqes_len);
+    if (p->cq_ptr && p->cq_ptr != MAP_FAILED && p->cq_ptr != p->sq_ptr)
+        munmap(p->cq_ptr, p->cq_len);
+    if (p->sq_ptr && p->sq_ptr != MAP_FAILED)
+        munmap(p->sq_ptr, p->sq_len);
+    if (p->ring_fd >= 0)
+        close(p->ring_fd);
+}
+
+static int uring_setup(struct io_engine *e)
+{
+    struct io_uring_params params;
+    struct uring_priv *p = calloc(1, sizeof(struct uring_priv));
+    int err;
+
+    if (!p)
+        return -ENOMEM;
+
+    memset(&params, 0, sizeof(params));
+    p->ring_fd = syscall(__NR_io_uring_setup, e->depth, &params);
+    if (p->ring_fd < 0) {
+        err = -errno;
+        free(p);
+        return err;
+    }
+    if (!(params.features & IORING_FEAT_RW_CUR_POS)) {
+        /* Older than 5.6, which also means no IORING_OP_READ/WRITE */
+        close(p->ring_fd);
+        free(p);
+        return -ENOSYS;
+    }
+
+    p->sq_len = params.sq_off.array + params.sq_entries * sizeof(unsigned);
+    p->cq_len = params.cq_off.cqes + params.cq_entries * sizeof(struct io_uring_cqe);
+    if (params.features & IORING_FEAT_SINGLE_MMAP) {
+        if (p->cq_len > p->sq_len)
+            p->sq_len = p->cq_len;
+        p->cq_len = p->sq_len;
+    }
+
+    p->sq_ptr = mmap(NULL, p->sq_len, PROT_READ | PROT_WRITE,
+                     MAP_SHARED | MAP_POPULATE, p->ring_fd, IORING_OFF_SQ_RING);
+    if (p->sq_ptr == MAP_FAILED)
+        goto fail;
+    if (params.features & IORING_FEAT_SINGLE_MMAP)
+        p->cq_ptr = p->sq_ptr;
+    else {
+        p->cq_ptr = mmap(NULL, p->cq_len, PROT_READ | PROT_WRITE,
+                         MAP_SHARED | MAP_POPULATE, p->ring_fd, IORING_OFF_CQ_RING);
+        if (p->cq_ptr == MAP_FAILED)
+            goto fail;
+    }
+    p->sqes_len = params.sq_entries * sizeof(struct io_uring_sqe);
+    p->sqes = mmap(NULL, p->sqes_len, PROT_READ | PROT_WRITE,
+                   MAP_SHARED | MAP_POPULATE, p->ring_fd, IORING_OFF_SQES);
+    if (p->sqes == MAP_FAILED)
+        goto fail;
+
+    p->sq_head  = (unsigned *)((char *)p->sq_ptr + params.sq_off.head);
+    p->sq_tail  = (unsigned *)((char *)p->sq_ptr + params.sq_off.tail);
+    p->sq_mask  = (unsigned *)((char *)p->sq_ptr + params.sq_off.ring_mask);
+    p->sq_array = (unsigned *)((char *)p->sq_ptr + params.sq_off.array);
+    p->cq_head  = (unsigned *)((char *)p->cq_ptr + params.cq_off.head);
+    p->cq_tail  = (unsigned *)((char *)p->cq_ptr + params.cq_off.tail);
+    p->cq_mask  = (unsigned *)((char *)p->cq_ptr + params.cq_off.ring_mask);
+    p->cqes     = (struct io_uring_cqe *)((char *)p->cq_ptr + params.cq_off.cqes);
+
+    e->priv = p;
+    return 0;
+
+fail:
+    err = -errno;
+    uring_unmap(p);
+    free(p);
+    return err;
+}
+
+static int uring_submit(struct io_engine *e, int op, void *buf, size_t len,
+                        unsigned long long off, void *tag)
+{
+    struct uring_priv *p = e->priv;
+    unsigned tail = *p->sq_tail;
+    unsigned idx;
+    struct io_uring_sqe *sqe;
+
+    if (tail - __atomic_load_n(p->sq_head, __ATOMIC_ACQUIRE) >= e->depth)
+        return -EBUSY;
+
+    idx = tail & *p->sq_mask;
+    sqe = &p->sqes[idx];
+    memset(sqe, 0, sizeof(*sqe));
+    sqe->opcode = op == IOENGINE_WRITE ? IORING_OP_WRITE : IORING_OP_READ;
+    sqe->fd = e->fd;
+    sqe->addr = (unsigned long long)(unsigned long)buf;
+    sqe->len = len;
+    sqe->off = off;
+    sqe->user_data = (unsigned long long)(unsigned long)tag;
+    p->sq_array[idx] = idx;
+    __atomic_store_n(p->sq_tail, tail + 1, __ATOMIC_RELEASE);
+    p->to_submit++;
+    return 0;
+}
+
+static int uring_reap(struct io_engine *e, unsigned min, struct io_done *done,
+                      unsigned max)
+{
+    struct uring_priv *p = e->priv;
+    unsigned head, n = 0;
+    int ret;
+
+    for (;;) {
+        head = *p->cq_head;
+        while (n < max && head != __atomic_load_n(p->cq_tail, __ATOMIC_ACQUIRE)) {
+            struct io_uring_cqe *cqe = &p->cqes[head & *p->cq_mask];
+            done[n].tag = (void *)(unsigned long)cqe->user_data;
+            done[n].res = cqe->res;
+            n++;
+            head++;
+        }
+        __atomic_store_n(p->cq_head, head, __ATOMIC_RELEASE);
+
+        if (n >= min && !p->to_submit)
+            return n;
+
+        ret = syscall(__NR_io_uring_enter, p->ring_fd, p->to_submit,
+                      n >= min ? 0 : min - n, IORING_ENTER_GETEVENTS, NULL, 0);
+        if (ret < 0) {
+            if (errno == EINTR || errno == EAGAIN)
+                continue;
+            return -errno;
+        }
+        p->to_submit -= ret;
+    }
+}
+
+static void uring_teardown(struct io_engine *e)
+{
+    uring_unmap(e->priv);
+    free(e->priv);
+}
+
+/* ------------------------------------------------------------------------ */
+
+static const struct io_engine engines[] = {
+    { .name = "uring", .setup = uring_setup, .submit = uring_submit,
+      .reap = uring_reap, .teardown = uring_teardown },
+    { .name = "aio",   .setup = aio_setup,   .submit = aio_submit,
+      .reap = aio_reap,   .teardown = aio_teardown },
+    { .name = "sync",  .setup = sync_setup,  .submit = sync_submit,
+      .reap = sync_reap,  .teardown = sync_teardown },
+};
+
+#define ENGINES_COUNT (sizeof(engines) / sizeof(engines[0]))
+
+bool ioengine_valid_name(const char *name)
+{
+    unsigned i;
+
+    if (!strcmp(name, "auto"))
+        return true;
+    for (i = 0; i < ENGINES_COUNT; i++)
+        if (!strcmp(name, engines[i].name))
+            return true;
+    return false;
+}
+
+int ioengine_open(struct io_engine *e, const char *name, int fd, unsigned depth)
+{
+    bool any = !strcmp(name, "auto");
+    unsigned i;
+    int ret = -EINVAL;
+
+    if (depth < 1)
+        depth = 1;
+    if (depth > IOENGINE_MAX_DEPTH)
+        depth = IOENGINE_MAX_DEPTH;
+
+    for (i = 0; i < ENGINES_COUNT; i++) {
+        if (!any && strcmp(name, engines[i].name))
+            continue;
+        *e = engines[i];
+        e->fd = fd;
+        e->depth = depth;
+        ret = e->setup(e);
+        if (ret == 0)
+            return 0;
+        if (!any)
+            break;
+    }
+    return ret;
+}
+
+void ioengine_close(struct io_engine *e)
+{
+    if (e->teardown)
+        e->teardown(e);
+    e->teardown = NULL;
+}
@@ -0,0 +1,66 @@
+/*
+ * XenRT: IO engines for diskdatatest. An engine keeps up to <depth>
+ * block IOs in flight against one file descriptor and hands back the
+ * completions in whatever order the kernel finishes them.
+ *
+ * Copyright (c) 2007 XenSource, Inc. All use and distribution of this
+ * copyrighted material is governed by and subject to terms and
+ * conditions as licensed by XenSource, Inc. All other rights reserved.
+ *
+ */
+
+#ifndef _IOENGINE_H
+#define _IOENGINE_H
+
+#include <stdbool.h>
+#include <stddef.h>
+
+#define IOENGINE_READ   0
+#define IOENGINE_WRITE  1
+
+#define IOENGINE_MAX_DEPTH 256
+
+struct io_done {
+    void      *tag;     // tag given to ioengine_submit()
+    long long  res;     // bytes transferred, or -errno
+};
+
+struct io_engine {
+    const char *name;
+    int         fd;
+    unsigned    depth;
+    void       *priv;
+
+    int  (*setup)(struct io_engine *e);
+    int  (*submit)(struct io_engine *e, int op, void *buf, size_t len,
+                   unsigned long long off, void *tag);
+    int  (*reap)(struct io_engine *e, unsigned min, struct io_done *done,
+                 unsigned max);
+    void (*teardown)(struct io_engine *e);
+};
+
+/*
+ * name is one of 'sync', 'aio', 'uring' or 'auto'. 'auto' tries io_uring,
+ * then Linux native AIO, then falls back to synchronous IO.
+ * Returns 0 on success, and e->name is set to the engine in use.
+ */
+int  ioengine_open(struct io_engine *e, const char *name, int fd, unsigned depth);
+bool ioengine_valid_name(const char *name);
+
+/* Queue one IO, it may not be issued to the kernel before ioengine_reap(). */
+static inline int ioengine_submit(struct io_engine *e, int op, void *buf,
+                                  size_t len, unsigned long long off, void *tag)
+{
+    return e->submit(e, op, buf, len, off, tag);
+}
+
+/* Issue queued IOs and wait for at least <min> completions. */
+static inline int ioengine_reap(struct io_engine *e, unsigned min,
+                                struct io_done *done, unsigned max)
+{
+    return e->reap(e, min, done, max);
+}
+
+void ioengine_close(struct io_engine *e);
+
+#endif
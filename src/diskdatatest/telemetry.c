@@ -0,0 +1,185 @@
+/*
+ * XenRT: Interval telemetry for diskdatatest.
+ *
+ * Output is JSON lines, one object per op and interval:
+ *   {"type": "interval", "device": "/dev/sdb", "op": "write", "t": 1.000, "mbps": 812.41, "iops": 3249.6,
+ *    "p50_us": 9.7, "p99_us": 28.7, "p999_us": 61.4, "max_us": 74.1}
+ * and one summary object per op at the end of the run, with "type": "summary",
+ * the total "bytes" and "ios" and the same rates and percentiles over the run.
+ *
+ * Copyright (c) 2007 XenSource, Inc. All use and distribution of this
+ * copyrighted material is governed by and subject to terms and
+ * conditions as licensed by XenSource, Inc. All other rights reserved.
+ *
+ */
+
+#ifndef _GNU_SOURCE
+  #define _GNU_SOURCE
+#endif
+#include <stdio.h>
+#include <string.h>
+#include <time.h>
+#include "ioengine.h"
+#include "telemetry.h"
+
+static const char *op_names[TELEMETRY_OPS] = {
+    [IOENGINE_READ]  = "read",
+    [IOENGINE_WRITE] = "write",
+    [TELEMETRY_DISCARD] = "discard",
+};
+
+unsigned long long telemetry_now(void)
+{
+    struct timespec ts;
+
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (unsigned long long)ts.tv_sec * 1000000000ULL + ts.tv_nsec;
+}
+
+static unsigned lat_bucket(unsigned long long ns)
+{
+    unsigned msb;
+
+    if (ns < LAT_SUB_BUCKETS)
+        return ns;
+    msb = 63 - __builtin_clzll(ns);
+    return (msb - LAT_SUB_BUCKET_BITS + 1) * LAT_SUB_BUCKETS +
+           ((ns >> (msb - LAT_SUB_BUCKET_BITS)) & (LAT_SUB_BUCKETS - 1));
+}
+
+/* Highest value that falls into bucket b */
+static unsigned long long lat_bucket_top(unsigned b)
+{
+    unsigned shift;
+
+    if (b < LAT_SUB_BUCKETS)
+        return b;
+    shift = b / LAT_SUB_BUCKETS - 1;
+    return (((unsigned long long)LAT_SUB_BUCKETS + b % LAT_SUB_BUCKETS + 1) << shift) - 1;
+}
+
+static double lat_percentile_us(const struct lat_hist *h, double pct)
+{
+    unsigned long long rank, seen = 0;
+    unsigned long long top;
+    unsigned b;
+
+    if (h->count == 0)
+        return 0;
+    rank = (unsigned long long)(h->count * pct / 100.0);
+    if (rank >= h->count)
+        rank = h->count - 1;
+    for (b = 0; b < LAT_BUCKETS; b++) {
+        seen += h->buckets[b];
+        if (seen > rank) {
+            top = lat_bucket_top(b);
+            return (top < h->max_ns ? top : h->max_ns) / 1000.0;
+        }
+    }
+    return h->max_ns / 1000.0;
+}
+
+static void summarize(const struct op_stats *s, double elapsed, struct telemetry_summary *sum)
+{
+    sum->mbps = elapsed > 0 ? s->bytes / elapsed / (1024 * 1024) : 0;
+    sum->iops = elapsed > 0 ? s->hist.count / elapsed : 0;
+    sum->p50_us = lat_percentile_us(&s->hist, 50);
+    sum->p99_us = lat_percentile_us(&s->hist, 99);
+    sum->p999_us = lat_percentile_us(&s->hist, 99.9);
+    sum->max_us = s->hist.max_ns / 1000.0;
+}
+
+static void write_stats(struct telemetry *t, const char *type, int op,
+                        const struct op_stats *s, double t_sec, double elapsed)
+{
+    struct telemetry_summary sum;
+
+    if (s->hist.count == 0 || elapsed <= 0)
+        return;
+
+    summarize(s, elapsed, &sum);
+
+    flockfile(t->out);     // keep the lines of concurrent devices whole
+    fprintf(t->out, "{\"type\": \"%s\", \"device\": \"%s\", \"op\": \"%s\", \"t\": %.3f",
+            type, t->device, op_names[op], t_sec);
+    fprintf(t->out, ", \"bytes\": %llu, \"ios\": %llu", s->bytes, s->hist.count);
+    fprintf(t->out, ", \"mbps\": %.2f, \"iops\": %.1f, \"p50_us\": %.1f, \"p99_us\": %.1f,"
+            " \"p999_us\": %.1f, \"max_us\": %.1f}\n",
+            sum.mbps, sum.iops, sum.p50_us, sum.p99_us, sum.p999_us, sum.max_us);
+    funlockfile(t->out);
+}
+
+void telemetry_open(struct telemetry *t, FILE *out, const char *device,
+                    unsigned long interval_ms)
+{
+    memset(t, 0, sizeof(*t));
+    t->out = out;
+    t->device = device;
+    t->interval_ns = interval_ms * 1000000ULL;
+    t->start_ns = t->last_ns = telemetry_now();
+    pthread_mutex_init(&t->lock, NULL);
+}
+
+void telemetry_record(struct telemetry *t, int op, unsigned long long bytes,
+                      unsigned long long lat_ns)
+{
+    struct op_stats *s[2] = {&t->interval[op], &t->total[op]};
+    int i;
+
+    pthread_mutex_lock(&t->lock);
+    for (i = 0; i < 2; i++) {
+        s[i]->bytes += bytes;
+        s[i]->hist.buckets[lat_bucket(lat_ns)]++;
+        s[i]->hist.count++;
+        if (lat_ns > s[i]->hist.max_ns)
+            s[i]->hist.max_ns = lat_ns;
+    }
+    pthread_mutex_unlock(&t->lock);
+}
+
+static void flush_interval(struct telemetry *t, unsigned long long now)
+{
+    int op;
+
+    for (op = 0; op < TELEMETRY_OPS; op++)
+        write_stats(t, "interval", op, &t->interval[op],
+                    (now - t->start_ns) / 1e9, (now - t->last_ns) / 1e9);
+    memset(t->interval, 0, sizeof(t->interval));
+    t->last_ns = now;
+    fflush(t->out);
+}
+
+void telemetry_tick(struct telemetry *t, unsigned long long now)
+{
+    if (!t->out)
+        return;
+
+    pthread_mutex_lock(&t->lock);
+    if (now - t->last_ns >= t->interval_ns)
+        flush_interval(t, now);
+    pthread_mutex_unlock(&t->lock);
+}
+
+void telemetry_summarize(struct telemetry *t, int op, double elapsed,
+                         struct telemetry_summary *sum)
+{
+    pthread_mutex_lock(&t->lock);
+    summarize(&t->total[op], elapsed, sum);
+    pthread_mutex_unlock(&t->lock);
+}
+
+void telemetry_close(struct telemetry *t)
+{
+    unsigned long long now;
+    int op;
+
+    if (t->out) {
+        now = telemetry_now();
+        flush_interval(t, now);
+        for (op = 0; op < TELEMETRY_OPS; op++)
+            write_stats(t, "summary", op, &t->total[op],
+                        (now - t->start_ns) / 1e9, (now - t->start_ns) / 1e9);
+    }
+    pthread_mutex_destroy(&t->lock);
+    t->out = NULL;
+}
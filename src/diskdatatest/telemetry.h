@@ -0,0 +1,84 @@
+/*
+ * XenRT: Interval telemetry for diskdatatest. Completed IOs are counted
+ * per op into a log-bucketed latency histogram, and every interval one
+ * JSON line per op is written with the throughput, IOPS and latency
+ * percentiles of that interval. A summary line per op closes the run.
+ *
+ * Copyright (c) 2007 XenSource, Inc. All use and distribution of this
+ * copyrighted material is governed by and subject to terms and
+ * conditions as licensed by XenSource, Inc. All other rights reserved.
+ *
+ */
+
+#ifndef _TELEMETRY_H
+#define _TELEMETRY_H
+
+#include <stdio.h>
+#include <pthread.h>
+
+/*
+ * Each power of two is split into 8 linear sub-buckets, so a latency is
+ * known to within 12.5%. 8 + 61 * 8 buckets cover every 64 bit value.
+ */
+#define LAT_SUB_BUCKET_BITS 3
+#define LAT_SUB_BUCKETS     (1 << LAT_SUB_BUCKET_BITS)
+#define LAT_BUCKETS         ((64 - LAT_SUB_BUCKET_BITS + 1) * LAT_SUB_BUCKETS)
+
+#define TELEMETRY_DISCARD 2
+#define TELEMETRY_OPS 3     // indexed by IOENGINE_READ / IOENGINE_WRITE / TELEMETRY_DISCARD
+
+struct lat_hist {
+    unsigned long long buckets[LAT_BUCKETS];
+    unsigned long long count;
+    unsigned long long max_ns;
+};
+
+struct op_stats {
+    unsigned long long bytes;
+    struct lat_hist    hist;
+};
+
+struct telemetry {
+    FILE               *out;            // NULL when telemetry is off
+    const char         *device;
+    pthread_mutex_t     lock;           // the workers of a device share one telemetry
+    unsigned long long  interval_ns;
+    unsigned long long  start_ns;
+    unsigned long long  last_ns;        // start of the current interval
+    struct op_stats     interval[TELEMETRY_OPS];
+    struct op_stats     total[TELEMETRY_OPS];
+};
+
+struct telemetry_summary {
+    double mbps;
+    double iops;
+    double p50_us;
+    double p99_us;
+    double p999_us;
+    double max_us;
+};
+
+/* Monotonic clock in nanoseconds */
+unsigned long long telemetry_now(void);
+
+/*
+ * out NULL turns the JSON lines off, IOs are still counted for
+ * telemetry_summarize(). Several devices may share one output, each
+ * line carries the device file.
+ */
+void telemetry_open(struct telemetry *t, FILE *out, const char *device,
+                    unsigned long interval_ms);
+void telemetry_record(struct telemetry *t, int op, unsigned long long bytes,
+                      unsigned long long lat_ns);
+/* Write the interval lines if the current interval is over. */
+void telemetry_tick(struct telemetry *t, unsigned long long now);
+/* Rates and latency percentiles of an op over the whole run */
+void telemetry_summarize(struct telemetry *t, int op, double elapsed,
+                         struct telemetry_summary *sum);
+/*
+ * Write the last, partial interval and the summary lines, once all the
+ * workers are done. out is left open.
+ */
+void telemetry_close(struct telemetry *t);
+
+#endif
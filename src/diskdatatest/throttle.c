@@ -0,0 +1,102 @@
+/*
+ * XenRT: Token bucket rate limit for diskdatatest.
+ *
+ * The buckets refill continuously at the capped rates and hold up to
+ * THROTTLE_BURST_NS worth of tokens, so a short pause is not made up
+ * by a burst above the cap. An IO only goes out once there are tokens
+ * for all of it: the caller either reaps what it has in flight or
+ * sleeps until then, and no IO is held back while it is timed.
+ *
+ * Copyright (c) 2007 XenSource, Inc. All use and distribution of this
+ * copyrighted material is governed by and subject to terms and
+ * conditions as licensed by XenSource, Inc. All other rights reserved.
+ *
+ */
+
+#ifndef _GNU_SOURCE
+  #define _GNU_SOURCE
+#endif
+#include <string.h>
+#include <time.h>
+#include "telemetry.h"
+#include "throttle.h"
+
+#define THROTTLE_BURST_NS 100000000ULL     // 100ms
+
+void throttle_init(struct throttle *t, double mbps, double iops, unsigned long long max_io)
+{
+    memset(t, 0, sizeof(*t));
+    t->on = mbps > 0 || iops > 0;
+    if (!t->on)
+        return;
+
+    t->byte_rate = mbps * 1024 * 1024 / 1e9;
+    t->io_rate = iops / 1e9;
+    t->byte_burst = t->byte_rate * THROTTLE_BURST_NS;
+    if (t->byte_burst < max_io)
+        t->byte_burst = max_io;
+    t->io_burst = t->io_rate * THROTTLE_BURST_NS;
+    if (t->io_burst < 1)
+        t->io_burst = 1;
+    t->bytes = t->byte_burst;
+    t->ios = t->io_burst;
+    t->last_ns = telemetry_now();
+    pthread_mutex_init(&t->lock, NULL);
+}
+
+static double refill(double tokens, double rate, double burst, unsigned long long ns)
+{
+    tokens += rate * ns;
+    return tokens < burst ? tokens : burst;
+}
+
+/* ns until the bucket holds <need> tokens */
+static unsigned long long shortfall_ns(double tokens, double rate, double need)
+{
+    return tokens >= need ? 0 : (unsigned long long)((need - tokens) / rate) + 1;
+}
+
+bool throttle_take(struct throttle *t, unsigned long long bytes, unsigned long long *wait_ns)
+{
+    unsigned long long now, byte_wait = 0, io_wait = 0;
+    bool ok;
+
+    if (!t->on)
+        return true;
+
+    pthread_mutex_lock(&t->lock);
+    now = telemetry_now();
+    if (t->byte_rate) {
+        t->bytes = refill(t->bytes, t->byte_rate, t->byte_burst, now - t->last_ns);
+        byte_wait = shortfall_ns(t->bytes, t->byte_rate, bytes);
+    }
+    if (t->io_rate) {
+        t->ios = refill(t->ios, t->io_rate, t->io_burst, now - t->last_ns);
+        io_wait = shortfall_ns(t->ios, t->io_rate, 1);
+    }
+    t->last_ns = now;
+
+    ok = byte_wait == 0 && io_wait == 0;
+    if (ok) {
+        t->bytes -= bytes;
+        t->ios -= 1;
+    } else {
+        *wait_ns = byte_wait > io_wait ? byte_wait : io_wait;
+    }
+    pthread_mutex_unlock(&t->lock);
+    return ok;
+}
+
+void throttle_sleep(unsigned long long wait_ns)
+{
+    struct timespec ts = {wait_ns / 1000000000ULL, wait_ns % 1000000000ULL};
+
+    nanosleep(&ts, NULL);
+}
+
+void throttle_destroy(struct throttle *t)
+{
+    if (t->on)
+        pthread_mutex_destroy(&t->lock);
+    t->on = false;
+}
@@ -0,0 +1,40 @@
+/*
+ * XenRT: Token bucket rate limit for diskdatatest. One bucket is shared
+ * by every worker of the process, so the caps hold for the whole run
+ * however many devices and workers it has.
+ *
+ * Copyright (c) 2007 XenSource, Inc. All use and distribution of this
+ * copyrighted material is governed by and subject to terms and
+ * conditions as licensed by XenSource, Inc. All other rights reserved.
+ *
+ */
+
+#ifndef _THROTTLE_H
+#define _THROTTLE_H
+
+#include <stdbool.h>
+#include <pthread.h>
+
+struct throttle {
+    bool                on;
+    pthread_mutex_t     lock;
+    double              byte_rate;      // bytes per ns, 0 means no cap
+    double              io_rate;        // IOs per ns, 0 means no cap
+    double              byte_burst;     // bucket sizes
+    double              io_burst;
+    double              bytes;          // tokens left
+    double              ios;
+    unsigned long long  last_ns;        // last refill
+};
+
+/* mbps and iops 0 mean no cap. max_io is the largest IO the bucket must let through. */
+void throttle_init(struct throttle *t, double mbps, double iops, unsigned long long max_io);
+/*
+ * Take the tokens of one IO of <bytes>. Returns false, and in *wait_ns how
+ * long until the tokens are there, if the IO has to wait.
+ */
+bool throttle_take(struct throttle *t, unsigned long long bytes, unsigned long long *wait_ns);
+void throttle_sleep(unsigned long long wait_ns);
+void throttle_destroy(struct throttle *t);
+
+#endif
@@ -0,0 +1,137 @@
+# Copyright (c) 2022-2023 Cloud Software Group, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Checks mpath_cli.MultipathdClient against a fake multipathd on an abstract unix socket.
+
+Run on a host with the XenAPI module, from the top of the tree:
+    PYTHONPATH=src/XenCert/sm python3 -m unittest tests.test_mpath_cli
+"""
+import os
+import socket
+import threading
+import unittest
+
+import mpath_cli
+
+
+class FakeMultipathd(threading.Thread):
+    """Answers each command with reply(cmd), or closes the connection when it returns None or after the
+    reply if hang_up is set"""
+
+    def __init__(self, reply, hang_up=False):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.address = "\0/xencert/test/multipathd/%d/%d" % (os.getpid(), id(self))
+        self.reply = reply
+        self.hang_up = hang_up
+        self.commands = []
+        self.connections = 0
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.address)
+        self.server.listen(1)
+
+    def _recv_all(self, conn, size):
+        data = b""
+        while len(data) < size:
+            chunk = conn.recv(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def run(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            self.connections += 1
+            with conn:
+                while True:
+                    header = self._recv_all(conn, mpath_cli.PACKET_LEN.size)
+                    if header is None:
+                        break
+                    (size,) = mpath_cli.PACKET_LEN.unpack(header)
+                    cmd = self._recv_all(conn, size)
+                    self.commands.append(cmd)
+                    reply = self.reply(cmd)
+                    if reply is None:
+                        break
+                    conn.sendall(reply)
+                    if self.hang_up:
+                        break
+
+    def close(self):
+        self.server.close()
+
+
+def packet(text):
+    payload = text.encode("utf-8") + b"\0"
+    return mpath_cli.PACKET_LEN.pack(len(payload)) + payload
+
+
+class MultipathdClientTest(unittest.TestCase):
+
+    def start(self, reply, hang_up=False):
+        server = FakeMultipathd(reply, hang_up)
+        server.start()
+        self.addCleanup(server.close)
+        client = mpath_cli.MultipathdClient(server.address, timeout=5)
+        self.addCleanup(client.close)
+        return server, client
+
+    def test_request_and_reply_are_length_prefixed(self):
+        server, client = self.start(lambda cmd: packet("reply to " + cmd.rstrip(b"\0").decode()))
+        self.assertEqual(client.command("show maps"), "reply to show maps")
+        self.assertEqual(server.commands, [b"show maps\0"])
+
+    def test_connection_is_reused(self):
+        server, client = self.start(lambda cmd: packet("ok"))
+        client.command("list maps")
+        client.command("list paths")
+        self.assertEqual(server.connections, 1)
+
+    def test_reconnects_once_when_closed(self):
+        # The first command is dropped, it is sent again on a new connection
+        server, client = self.start(lambda cmd: None if len(server.commands) == 1 else packet("ok"))
+        self.assertEqual(client.command("help"), "ok")
+        self.assertEqual(server.connections, 2)
+
+    def test_fails_when_closed_twice(self):
+        _, client = self.start(lambda cmd: None)
+        self.assertRaises(EOFError, client.command, "help")
+
+    def test_fails_on_a_short_reply(self):
+        _, client = self.start(lambda cmd: mpath_cli.PACKET_LEN.pack(10) + b"ok", hang_up=True)
+        self.assertRaises(EOFError, client.command, "help")
+
+    def test_fails_without_multipathd(self):
+        client = mpath_cli.MultipathdClient("\0/xencert/test/multipathd/none", timeout=5)
+        self.assertRaises(socket.error, client.command, "help")
+
+    def test_command_forks_multipathd_when_the_socket_fails(self):
+        client = mpath_cli.client
+        fork_command = mpath_cli._fork_command
+        mpath_cli.client = mpath_cli.MultipathdClient("\0/xencert/test/multipathd/none", timeout=5)
+        mpath_cli._fork_command = lambda cmd: "forked " + cmd
+        try:
+            self.assertEqual(mpath_cli.command("help"), "forked help")
+        finally:
+            mpath_cli.client = client
+            mpath_cli._fork_command = fork_command
+
+
+if __name__ == "__main__":
+    unittest.main()